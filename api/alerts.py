@@ -1,19 +1,25 @@
+import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from itertools import islice
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
 from itsdangerous import BadSignature
 
-import flask
 from flask import Blueprint, current_app, request
-from sqlalchemy.sql import and_, func, not_, select, tuple_
+from sqlalchemy.sql import and_, func, or_, select, tuple_
 
-from api.auth import login_required
+from api.auth import confirmed_email_set, forget_confirmations, login_required, whitelist_required
 from api.db import engine
+from api.encoding import json_response
 from api.errors import ConfirmationPendingError, abort_json
-from api.mail import send_confirmation, render_alert, BASE_URL, send_alert, read_private_alert_token, build_db_url
+from api.mail import send_confirmation, render_alert, BASE_URL, send_alerts, read_private_alert_token, build_db_url, MailSingleton
 from api.models import alerts as alerts_
-from api.models import (annotated_leads, confirmed_emails, leads,
+from api.models import (alert_jobs, annotated_leads, confirmed_emails, leads,
                         sent_alert_contents, sent_alerts)
 
 alerts = Blueprint('alerts', __name__, url_prefix="/alert")
@@ -27,31 +33,36 @@ def init_alerts():
 
     current_app.config['ALERT_TRIGGER_WHITELIST'] = cfg.get(
         'alert-trigger', 'trigger_ip_whitelist').split(',')
+    current_app.config['ALERT_BATCH_SIZE'] = cfg.getint(
+        'alert-trigger', 'batch-size', fallback=100)
+    current_app.config['ALERT_WORKERS'] = cfg.getint(
+        'alert-trigger', 'workers', fallback=4)
+    current_app.config['ALERT_SEND_CONCURRENCY'] = cfg.getint(
+        'alert-trigger', 'send-concurrency', fallback=4)
+    current_app.config['ALERT_SEND_RATE'] = cfg.getfloat(
+        'alert-trigger', 'send-rate', fallback=14)
+    current_app.config['ALERT_MATCHING'] = cfg.get(
+        'alert-trigger', 'matching', fallback='query')
+    current_app.config['ALERT_JOB_ATTEMPTS'] = cfg.getint(
+        'alert-trigger', 'job-attempts', fallback=3)
 
 
 def is_confirmed(uid, emails, con):
     """Checks if an email or emails has been confirmed."""
+    confirmed = confirmed_email_set(con, uid)
     if isinstance(emails, list):
-        res = con.execute(select([confirmed_emails]).where(
-            and_(confirmed_emails.c.user_id == uid, confirmed_emails.c.email.in_(emails))))
-        confirmed = {email: False for email in emails}
-        for row in res:
-            confirmed[row['email']] = True
-
-        return confirmed
+        return {email: email in confirmed for email in emails}
     else:
-        res = con.execute(select([confirmed_emails]).where(
-            and_(confirmed_emails.c.user_id == uid, confirmed_emails.c.email == emails)))
-
-        return res.rowcount >= 1
+        return emails in confirmed
 
 
 def email_taken(uid, email, con):
+    # not cached: another process may have just confirmed the address for
+    # someone else
     query = select([confirmed_emails]).where(and_(
-        confirmed_emails.c.email == email, not_(confirmed_emails.c.user_id == uid)))
-    res = con.execute(query)
+        confirmed_emails.c.email == email, confirmed_emails.c.user_id != uid))
 
-    if res.rowcount > 0:
+    if con.execute(query).fetchone() is not None:
         return abort_json(400, 'Email address is already claimed by another user.')
 
     return False
@@ -81,7 +92,7 @@ def lookup_alert(uid, alert_id):
 
         response = format_alert(res.fetchone())
         response['confirmed'] = is_confirmed(uid, response['recipient'], con)
-        return flask.jsonify(response)
+        return json_response(response)
 
 
 @alerts.route('/<alert_id>', methods=('PUT',))
@@ -176,13 +187,16 @@ def unsubscribe_all_alerts():
             sent = res.fetchone()
 
             # see note in delete_alert_via_link
+            owners = [row['user_id'] for row in con.execute(
+                select([confirmed_emails.c.user_id]).where(confirmed_emails.c.email == sent['recipient']))]
             query = confirmed_emails.delete().where(confirmed_emails.c.email == sent['recipient'])
             res = con.execute(query)
             query = alerts_.delete().where(alerts_.c.recipient == sent['recipient'])
             res = con.execute(query)
 
-            if res.rowcount == 0:
-                return abort_json(404, 'No such alert')
+        forget_confirmations(owners)
+        if res.rowcount == 0:
+            return abort_json(404, 'No such alert')
     except BadSignature:
         return abort_json(400, 'Invalid token')
     return {'status': 'ok'}
@@ -206,7 +220,7 @@ def list_alerts(uid):
 
         for alert in alert_list:
             alert['confirmed'] = confirmed[alert['recipient']]
-        return {'alerts': alert_list}
+        return json_response({'alerts': alert_list})
 
 
 EMAIL_REGEX = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
@@ -302,104 +316,414 @@ FREQS = {
 }
 
 
-@alerts.route('/trigger', methods=('POST',))
-def trigger_alerts():
+class RateLimiter:
+    """Spaces out calls to `wait` so that they return at most `rate` times per
+    second, across all threads. A rate of 0 disables limiting."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = monotonic()
+        self._lock = Lock()
+
+    def wait(self):
+        with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            sleep(delay)
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the time spent in the block to `timings[stage]` (in milliseconds)."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + (perf_counter() - start) * 1000
+
+
+def select_due_alerts(con, frequency=None):
+    """Select all alerts that are due to be sent, where:
+
+    1. the recipient email is confirmed
+    2. the alert hasn't been delivered in the current time period
+
+    Sends whose mail failed are not counted, so the next job retries them.
+    Sends recorded before jobs existed (without a `job_id`) were never marked
+    as delivered and are counted regardless.
+
+    If `frequency` (a value of `FREQS`) is given, only alerts with that frequency are selected."""
+    confirmed = select(
+        [confirmed_emails.c.user_id, confirmed_emails.c.email])
+
+    where = tuple_(alerts_.c.user_id, alerts_.c.recipient).in_(confirmed)
+    if frequency is not None:
+        where = and_(where, alerts_.c.frequency == frequency)
+
+    counted = and_(sent_alerts.c.alert_id == alerts_.c.id,
+                   or_(sent_alerts.c.delivered_dt.isnot(None), sent_alerts.c.job_id.is_(None)))
+
+    query = select([alerts_, func.max(sent_alerts.c.send_date).label('last_sent')])\
+        .select_from(alerts_.outerjoin(sent_alerts, counted))\
+        .where(where)\
+        .group_by(alerts_.c.id)\
+        .order_by(alerts_.c.id)
+
+    results = con.execute(query)
+
+    # these results satisfy #1, but not #2 yet
+    due = []
+    for result in results:
+        row = dict(result)
+        if row['last_sent'] is not None and row['last_sent'] >= min_date_threshold(row['frequency']):
+            # has been sent more recently than we allow
+            print(
+                f"Last trigger for {row['id']} is too recent ({row['last_sent']}, {min_date_threshold(row['frequency'])})")
+            continue
+        due.append(row)
+
+    return due
+
+
+def find_alert_leads(alert):
+    """Find the leads published since the last period that match an alert.
+
+    MySQL cannot match on column values (only plaintext), so this runs one
+    query per alert on its own connection."""
     from api.api import build_filtered_lead_selection
 
-    if request.remote_addr not in current_app.config['ALERT_TRIGGER_WHITELIST']:
-        return abort_json(401, 'Unauthorized')
+    query = build_filtered_lead_selection(
+        filter_=alert['filter'],
+        from_=None,
+        to=None,
+        sources={
+            key: alert[f"{key}_source"]
+            for key in ['federal', 'regional', 'local']
+        },
+        page=None,
+        fields=[leads.c.id, annotated_leads.c.name],
+        where=[
+            annotated_leads.c.published_dt >= min_date_threshold(
+                alert['frequency'], fudge=timedelta(0))
+        ]
+    )
+
+    with engine().connect() as con:
+        return list(dict(row) for row in con.execute(query))
+
+
+def alert_criteria(alert):
+    """The parts of an alert that determine which leads it matches. Alerts
+    with equal criteria match the same leads within a trigger run."""
+    return (
+        ' '.join(alert['filter'].split()),
+        alert['federal_source'],
+        alert['regional_source'],
+        alert['local_source'],
+        alert['frequency'],
+    )
+
+
+def record_alert(con, alert, lead_results, job_id=None):
+    """Record that an alert is being sent with the given leads. Returns the
+    `sent_alerts` row, including its `send_id`."""
+    sent_alert = {
+        k: v
+        for k, v in alert.items()
+        if k not in ['id', 'last_sent']
+    }
+
+    sent_alert['alert_id'] = alert['id']
+    sent_alert['job_id'] = job_id
+    sent_alert['send_date'] = datetime.now()
+    sent_alert['db_link'] = build_db_url(sent_alert)
+
+    query = sent_alerts.insert().values(  # pylint: disable=no-value-for-parameter
+        **sent_alert)
+
+    res = con.execute(query)
+
+    send_id = res.inserted_primary_key[0]
 
+    sent_alert['send_id'] = send_id
+
+    sent_contents = [
+        {'send_id': send_id,
+         'lead_id': lead['id']}
+        for lead in lead_results
+    ]
+
+    con.execute(sent_alert_contents.insert(  # pylint: disable=no-value-for-parameter
+    ), *sent_contents)
+
+    return sent_alert
+
+
+def select_undelivered(con, job_id):
+    """Select the sends recorded by a job that have not been delivered yet,
+    along with their leads. Returns a list of `(sent_alert, lead_results)`."""
+    query = select([sent_alerts])\
+        .where(and_(sent_alerts.c.job_id == job_id, sent_alerts.c.delivered_dt.is_(None)))\
+        .order_by(sent_alerts.c.id)
+
+    undelivered = []
+    for row in con.execute(query).fetchall():
+        sent_alert = dict(row)
+        sent_alert['send_id'] = sent_alert.pop('id')
+
+        lead_query = select([leads.c.id, annotated_leads.c.name])\
+            .select_from(sent_alert_contents.join(leads).join(annotated_leads))\
+            .where(sent_alert_contents.c.send_id == sent_alert['send_id'])\
+            .order_by(sent_alert_contents.c.id)
+        lead_results = [dict(lead) for lead in con.execute(lead_query)]
+
+        undelivered.append((sent_alert, lead_results))
+
+    return undelivered
+
+
+def mark_delivered(send_id):
+    with engine().begin() as con:
+        con.execute(sent_alerts.update().values(  # pylint: disable=no-value-for-parameter
+            delivered_dt=datetime.now()
+        ).where(sent_alerts.c.id == send_id))
+
+
+def render_sent_alert(app, sent_alert, lead_results):
+    with app.app_context():
+        return render_alert(sent_alert, [{
+            'name': lead['name'],
+            'link': f'{BASE_URL}/lead/{lead["id"]}'
+        } for lead in islice(lead_results, None)])
+
+
+def dispatch_alerts(frequency=None, job_id=None):
+    """Send every due alert. Returns a report with counts and per-stage timings.
+
+    Alerts are handled in batches of `ALERT_BATCH_SIZE`. For each batch, the
+    lead queries and rendering run on a pool of `ALERT_WORKERS` threads, all
+    sends for the batch are recorded in a single transaction, and the mail is
+    split between `ALERT_SEND_CONCURRENCY` threads, each sending its share as
+    one `send_alerts` batch (so the SMTP transport reuses its connection), at
+    no more than `ALERT_SEND_RATE` emails per second in total.
+
+    Many alerts share the same criteria, so lead results are memoized by
+    `alert_criteria` for the duration of the run. The report counts both the
+    queries run and those saved by this. With `ALERT_MATCHING = 'percolate'`,
+    the results for every due alert are instead found up front by a single
+    pass over the recent leads (see api.percolator).
+
+    Sends are marked as delivered as soon as the mail goes out. If `job_id` is
+    given, sends that the job recorded in an earlier, interrupted run but
+    never delivered are delivered first. Alerts already delivered are not due
+    again, so resuming a job neither skips nor repeats alerts. Mail that fails
+    is left undelivered and retried by the next job."""
+    config = current_app.config
+    app = current_app._get_current_object()
+
+    batch_size = config.get('ALERT_BATCH_SIZE', 100)
+    limiter = RateLimiter(config.get('ALERT_SEND_RATE', 14))
+
+    report = {'alerts': 0, 'sent': 0, 'failed': 0, 'skipped': 0, 'resumed': 0,
+              'queries': 0, 'queries_saved': 0}
+    timings = {}
+    # lead results of every distinct set of criteria seen so far in this run
+    lead_memo = {}
+
+    send_concurrency = config.get('ALERT_SEND_CONCURRENCY', 4)
+
+    def send(chunk):
+        return send_alerts(chunk, wait=limiter.wait,
+                           on_sent=lambda sent_alert: mark_delivered(sent_alert['send_id']))
+
+    def deliver(pending):
+        with timed(timings, 'render'):
+            rendered = list(workers.map(
+                lambda item: render_sent_alert(app, *item), pending))
+
+        with timed(timings, 'send'):
+            to_send = [(sent_alert, html, text) for ((sent_alert, _), (html, text)) in zip(pending, rendered)]
+            chunks = [to_send[i::send_concurrency] for i in range(min(send_concurrency, len(to_send)))]
+            for results in senders.map(send, chunks):
+                for ok in results:
+                    report['sent' if ok else 'failed'] += 1
+
+    with ThreadPoolExecutor(config.get('ALERT_WORKERS', 4)) as workers, \
+            ThreadPoolExecutor(send_concurrency) as senders:
+        undelivered = []
+        if job_id is not None:
+            with timed(timings, 'resume'), engine().connect() as con:
+                undelivered = select_undelivered(con, job_id)
+            report['resumed'] = len(undelivered)
+            deliver(undelivered)
+
+        # an alert whose resumed send failed again waits for the next job
+        resumed = set(sent_alert['alert_id'] for (sent_alert, _) in undelivered)
+        with timed(timings, 'select'), engine().connect() as con:
+            due = [alert for alert in select_due_alerts(con, frequency) if alert['id'] not in resumed]
+        report['alerts'] = len(due)
+
+        if config.get('ALERT_MATCHING', 'query') == 'percolate':
+            from api.percolator import AlertPercolator
+
+            with timed(timings, 'query'), engine().connect() as con:
+                lead_memo.update(AlertPercolator(alert_criteria(alert) for alert in due).percolate(con))
+            report['queries'] += 1
+
+        for start in range(0, len(due), batch_size):
+            batch = due[start:start + batch_size]
+
+            with timed(timings, 'query'):
+                unseen = {}
+                for alert in batch:
+                    key = alert_criteria(alert)
+                    if key not in lead_memo and key not in unseen:
+                        unseen[key] = alert
+
+                results = workers.map(find_alert_leads, unseen.values())
+                lead_memo.update(zip(unseen.keys(), results))
+
+                lead_lists = [lead_memo[alert_criteria(alert)] for alert in batch]
+                report['queries'] += len(unseen)
+                report['queries_saved'] += len(batch) - len(unseen)
+
+            with timed(timings, 'record'), engine().begin() as con:
+                pending = []
+                for alert, lead_results in zip(batch, lead_lists):
+                    if len(lead_results) == 0:
+                        print(f"Skipping alert {alert['id']}. No new results.")
+                        report['skipped'] += 1
+                        continue
+
+                    pending.append((record_alert(con, alert, lead_results, job_id), lead_results))
+
+            deliver(pending)
+
+    report['timings'] = timings
+    send_seconds = timings.get('send', 0) / 1000
+    report['emails_per_second'] = report['sent'] / send_seconds if send_seconds else 0
+    report['mail'] = MailSingleton.get_stats()
+    return report
+
+
+def enqueue_alert_job(con, frequency=None):
+    """Queue a job to send due alerts. If an identical job is already waiting,
+    its id is returned instead of queueing another."""
+    query = select([alert_jobs.c.id]).where(and_(
+        alert_jobs.c.status == 'pending',
+        alert_jobs.c.frequency.is_(None) if frequency is None else alert_jobs.c.frequency == frequency))
+    existing = con.execute(query).fetchone()
+    if existing is not None:
+        return existing['id']
+
+    res = con.execute(alert_jobs.insert().values(  # pylint: disable=no-value-for-parameter
+        frequency=frequency,
+        status='pending',
+        created_dt=datetime.now()
+    ))
+    return res.inserted_primary_key[0]
+
+
+def claim_alert_job(con, job_id):
+    """Mark a pending job as running. Returns False if another worker got to it first."""
+    res = con.execute(alert_jobs.update().values(  # pylint: disable=no-value-for-parameter
+        status='running',
+        started_dt=datetime.now()
+    ).where(and_(alert_jobs.c.id == job_id, alert_jobs.c.status == 'pending')))
+    return res.rowcount == 1
+
+
+def job_attempts(job):
+    """The number of times a job has failed so far."""
+    report = json.loads(job['report']) if job['report'] else {}
+    return report.get('attempts', 0)
+
+
+def run_alert_job(job):
+    """Run a claimed job to completion and record its outcome.
+
+    A job that raises is queued again, so that the sends it recorded but did
+    not deliver are delivered when it is resumed. It is only marked as
+    failed after `ALERT_JOB_ATTEMPTS` tries."""
+    print(f"Running alert job {job['id']}")
+    try:
+        report = dispatch_alerts(job['frequency'], job_id=job['id'])
+        status = 'done'
+    except Exception as e:
+        print(f"Alert job {job['id']} failed: {e}")
+        attempts = job_attempts(job) + 1
+        report = {'error': str(e), 'attempts': attempts}
+        status = 'failed' if attempts >= current_app.config.get('ALERT_JOB_ATTEMPTS', 3) else 'pending'
+
+    with engine().begin() as con:
+        con.execute(alert_jobs.update().values(  # pylint: disable=no-value-for-parameter
+            status=status,
+            finished_dt=None if status == 'pending' else datetime.now(),
+            report=json.dumps(report)
+        ).where(alert_jobs.c.id == job['id']))
+
+    print(f"Alert job {job['id']} {status}: {report}")
+    return report
+
+
+def process_alert_jobs():
+    """Run queued alert jobs until none are left. Jobs left running by a
+    worker that crashed are resumed first. Jobs that fail are retried on the
+    next call rather than right away.
+
+    Only one worker may process jobs at a time, since a job that is running
+    cannot be told apart from one whose worker crashed."""
+    processed = []
+    while True:
+        with engine().begin() as con:
+            query = select([alert_jobs])\
+                .where(and_(alert_jobs.c.status.in_(['running', 'pending']),
+                            alert_jobs.c.id.notin_(processed)))\
+                .order_by(alert_jobs.c.status.desc(), alert_jobs.c.id)\
+                .limit(1)
+            job = con.execute(query).fetchone()
+            if job is None:
+                return processed
+
+            job = dict(job)
+            if job['status'] == 'pending' and not claim_alert_job(con, job['id']):
+                continue
+
+        run_alert_job(job)
+        processed.append(job['id'])
+
+
+def format_alert_job(row):
+    return {
+        **{k: v for k, v in row.items() if k != 'report'},
+        'report': json.loads(row['report']) if row['report'] else None
+    }
+
+
+@alerts.route('/trigger', methods=('POST',))
+@whitelist_required
+def trigger_alerts():
     freq = request.args.get('frequency', None)
 
     if freq is not None and freq not in FREQS:
         return abort_json(400, 'Invalid frequency specified.')
 
-    with engine().connect() as con:
-        # select all alerts where:
-        # 1. the recipient email is confirmed
-        # 2. the alert hasn't been sent in the current time period
-        confirmed = select(
-            [confirmed_emails.c.user_id, confirmed_emails.c.email]).cte()
-
-        where = tuple_(alerts_.c.user_id, alerts_.c.recipient).in_(confirmed)
-        if freq is not None:
-            where = and_(where, alerts_.c.frequency == FREQS[freq])
-
-        query = select([alerts_, func.max(sent_alerts.c.send_date).label('last_sent')])\
-            .select_from(alerts_.outerjoin(sent_alerts, sent_alerts.c.alert_id == alerts_.c.id))\
-            .where(where)\
-            .group_by(alerts_.c.id)
-
-        results = con.execute(query)
-
-        # these results satisfy #1, but not #2 yet
-        # however, we need to go row by row anyway because MySQL cannot match
-        # on column values (only plaintext)
-        for result in results:
-            row = dict(result)
-            if row['last_sent'] is not None and row['last_sent'] >= min_date_threshold(row['frequency']):
-                # has been sent more recently than we allow
-                print(
-                    f"Last trigger for {row['id']} is too recent ({row['last_sent']}, {min_date_threshold(row['frequency'])})")
-                continue
-            with con.begin():
-                query = build_filtered_lead_selection(
-                    filter_=row['filter'],
-                    from_=None,
-                    to=None,
-                    sources={
-                        key: row[f"{key}_source"]
-                        for key in ['federal', 'regional', 'local']
-                    },
-                    page=None,
-                    fields=[leads.c.id, annotated_leads.c.name],
-                    where=[
-                        annotated_leads.c.published_dt >= min_date_threshold(
-                            row['frequency'], fudge=timedelta(0))
-                    ]
-                )
-
-                lead_results = con.execute(query)
-                lead_results = list(dict(row) for row in lead_results)
-
-                if len(lead_results) == 0:
-                    print(f"Skipping alert {row['id']}. No new results.")
-                    continue
-
-                # record alert sending
-                sent_alert = {
-                    k: v
-                    for k, v in row.items()
-                    if k not in ['id', 'last_sent']
-                }
-
-                sent_alert['alert_id'] = row['id']
-                sent_alert['send_date'] = datetime.now()
-                sent_alert['db_link'] = build_db_url(sent_alert)
-
-                query = sent_alerts.insert().values(  # pylint: disable=no-value-for-parameter
-                    **sent_alert)
-
-                res = con.execute(query)
-
-                send_id = res.inserted_primary_key[0]
-
-                sent_alert['send_id'] = send_id
-
-                templates = render_alert(sent_alert, [{
-                    'name': lead['name'],
-                    'link': f'{BASE_URL}/lead/{lead["id"]}'
-                } for lead in islice(lead_results, None)])
-
-                sent_contents = [
-                    {'send_id': send_id,
-                     'lead_id': lead['id']}
-                    for lead in lead_results
-                ]
-
-                con.execute(sent_alert_contents.insert(  # pylint: disable=no-value-for-parameter
-                ), *sent_contents)
-
-                send_alert(sent_alert, *templates)
+    with engine().begin() as con:
+        job_id = enqueue_alert_job(con, FREQS[freq] if freq is not None else None)
 
-    return {'status': 'ok'}
+    # the job is run by the alert worker (python -m api.worker)
+    return {'status': 'ok', 'job': job_id}
+
+
+@alerts.route('/trigger/<job_id>', methods=('GET',))
+@whitelist_required
+def lookup_alert_job(job_id):
+    with engine().begin() as con:
+        job = con.execute(select([alert_jobs]).where(alert_jobs.c.id == job_id)).fetchone()
+        if job is None:
+            return abort_json(404, 'No such job')
+
+        return format_alert_job(job)
@@ -1,12 +1,15 @@
 from datetime import datetime, timedelta
+from time import monotonic
 
 import pytest
+from itsdangerous import URLSafeTimedSerializer
 from sqlalchemy.sql import select, and_
 from freezegun import freeze_time
 
-from api.alerts import CONFIRMATION_NOTE
-from api.mail import get_private_alert_token
-from api.models import (annotated_leads, confirmed_emails, sent_alert_contents,
+from api import alerts
+from api.alerts import CONFIRMATION_NOTE, RateLimiter, process_alert_jobs
+from api.mail import MailSingleton, Transport, get_private_alert_token
+from api.models import (annotated_leads, confirmed_emails, pending_confirmations, sent_alert_contents,
                         sent_alerts, alerts as alerts_)
 
 
@@ -17,7 +20,22 @@ def send_confirmation(mocker):
 
 @pytest.fixture
 def send_alert(mocker):
-    return mocker.patch('api.alerts.send_alert')
+    """Stands in for mailing a single alert. Returns a mock called with
+    `(sent_alert, html, text)` for each alert in a `send_alerts` batch; the
+    alert counts as sent if it returns a truthy value."""
+    send_alert = mocker.MagicMock()
+
+    def send_alerts(items, wait=None, on_sent=None):
+        results = []
+        for (alert, html, text) in items:
+            ok = bool(send_alert(alert, html, text))
+            if ok and on_sent is not None:
+                on_sent(alert)
+            results.append(ok)
+        return results
+
+    mocker.patch('api.alerts.send_alerts', side_effect=send_alerts)
+    return send_alert
 
 
 def update_published_dt(conn, dt, lead_id):
@@ -26,6 +44,24 @@ def update_published_dt(conn, dt, lead_id):
     ).where(annotated_leads.c.lead_id == lead_id))
 
 
+def trigger(alert_app, query=''):
+    """Queue an alert job, run it as the worker would and return its report."""
+    with alert_app.test_client(False) as client:
+        res = client.post(f'/alert/trigger{query}')
+        assert res.status_code == 200
+        job_id = res.get_json()['job']
+
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    with alert_app.test_client(False) as client:
+        res = client.get(f'/alert/trigger/{job_id}')
+        assert res.status_code == 200
+        job = res.get_json()
+        assert job['status'] == 'done'
+        return job['report']
+
+
 @pytest.fixture
 def trigger_published_dt(sqlite_connection):
     with sqlite_connection.connect() as conn:
@@ -70,6 +106,54 @@ def test_create_alert_logged_in(sqlite_connection, alert_app, send_confirmation)
         assert uid == 1 and recip == 'test@test.net'
 
 
+def test_confirmation_cache(sqlite_connection, alert_app, send_confirmation):
+    """Confirming an email is reflected by alerts even though confirmations are cached."""
+    with alert_app.test_client(True) as client:
+        with client.session_transaction() as sess:
+            sess['id'] = 1
+        res = client.post('/alert/create', json={
+            'filter': '',
+            'recipient': 'test@test.net',
+            'sources': {},
+            'frequency': 0,
+        })
+        assert res.status_code == 200
+
+        res = client.get('/alert/list')
+        assert [alert['confirmed'] for alert in res.get_json()['alerts']] == [False]
+
+        with sqlite_connection.connect() as conn:
+            res = conn.execute(pending_confirmations.insert().values(  # pylint: disable=no-value-for-parameter
+                user_id=1, email='test@test.net', send_date=datetime.now()))
+            confirmation_id = res.inserted_primary_key[0]
+        with alert_app.app_context():
+            token = URLSafeTimedSerializer(alert_app.secret_key).dumps(confirmation_id, salt='confirm')
+        res = client.get(f'/auth/confirm?token={token}')
+        assert res.status_code == 200
+
+        res = client.get('/alert/list')
+        assert [alert['confirmed'] for alert in res.get_json()['alerts']] == [True]
+
+        # the address now belongs to user 1
+        with client.session_transaction() as sess:
+            sess['id'] = 2
+        res = client.post('/alert/create', json={
+            'filter': '',
+            'recipient': 'test@test.net',
+            'sources': {},
+            'frequency': 0,
+        })
+        assert res.status_code == 400
+
+        # addresses confirmed by another process are noticed right away
+        alert = {'filter': '', 'recipient': 'other@test.net', 'sources': {}, 'frequency': 0}
+        assert client.post('/alert/create', json=alert).status_code == 200
+        with sqlite_connection.connect() as conn:
+            conn.execute(confirmed_emails.insert().values(  # pylint: disable=no-value-for-parameter
+                user_id=1, email='other@test.net'))
+        assert client.post('/alert/create', json=alert).status_code == 400
+
+
 def test_create_alert_invalid_email(sqlite_connection, alert_app, send_confirmation):
     with alert_app.test_client(True) as client:
         with client.session_transaction() as sess:
@@ -102,9 +186,7 @@ def test_trigger_unconfirmed_email(sqlite_connection, send_alert, alert_app, tri
 
         assert res.status_code == 200
 
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     with sqlite_connection.connect() as conn:
         sent_alert_results = conn.execute(select([sent_alerts]))
@@ -130,9 +212,7 @@ def test_trigger_initial_send(sqlite_connection, send_alert, alert_app, confirme
         assert res.status_code == 200
         alert_id = res.get_json()['id']
 
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     with sqlite_connection.connect() as conn:
         sent_alert_results = conn.execute(select([sent_alerts]))
@@ -164,9 +244,7 @@ def test_trigger_no_contents(sqlite_connection, send_alert, alert_app, confirmed
 
         assert res.status_code == 200
 
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     with sqlite_connection.connect() as conn:
         sent_alert_results = conn.execute(select([sent_alerts]))
@@ -183,9 +261,7 @@ def test_trigger_too_recent(sqlite_connection, send_alert, alert_app, trigger_pu
         sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt)
 
     # trigger again
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     with sqlite_connection.connect() as conn:
         sent_alert_results = conn.execute(select([sent_alerts]))
@@ -209,9 +285,7 @@ def test_trigger_next_email_no_new(sqlite_connection, send_alert, alert_app, con
     mocker.patch('api.alerts.datetime', NextWeek())
 
     # trigger again
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     # there should not be another alert sent
     with sqlite_connection.connect() as conn:
@@ -234,9 +308,7 @@ def test_trigger_next_email_with_new(sqlite_connection, send_alert, alert_app, c
     mocker.patch('api.alerts.datetime', NextWeek())
 
     # trigger again
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger')
-        assert res.status_code == 200
+    trigger(alert_app)
 
     # there should be another alert sent
     with sqlite_connection.connect() as conn:
@@ -335,9 +407,7 @@ def test_trigger_frequency_parameter(sqlite_connection, send_alert, alert_app, c
 
         assert res.status_code == 200
 
-    with alert_app.test_client(False) as client:
-        res = client.post('/alert/trigger?frequency=monthly')
-        assert res.status_code == 200
+    trigger(alert_app, '?frequency=monthly')
 
     with sqlite_connection.connect() as conn:
         sent_alert_results = conn.execute(select([sent_alerts]))
@@ -371,3 +441,263 @@ def test_trigger_invalid_frequency(sqlite_connection, send_alert, alert_app, con
         assert len(rows) == 0
 
     send_alert.assert_not_called()
+
+
+def test_trigger_report(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt):
+    """Test that a trigger run with several alerts sends each matching alert once and reports on it."""
+    alert_app.config['ALERT_BATCH_SIZE'] = 2
+    with sqlite_connection.connect() as conn:
+        for sources in [{}, {'federal_source': 'exclude'}, {'local_source': 'exclude'}]:
+            conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+                recipient='test@test.net',
+                filter='',
+                frequency=0,
+                user_id=1,
+                **sources
+            ))
+
+    report = trigger(alert_app)
+
+    assert report['alerts'] == 3
+    assert report['sent'] == 2
+    assert report['skipped'] == 1
+    assert report['queries'] == 3
+    assert report['queries_saved'] == 0
+    assert set(report['timings'].keys()) == {'resume', 'select', 'query', 'record', 'render', 'send'}
+    assert send_alert.call_count == 2
+
+    with sqlite_connection.connect() as conn:
+        rows = list(dict(row) for row in conn.execute(select([sent_alerts.c.alert_id])))
+        assert rows == [{'alert_id': 1}, {'alert_id': 3}]
+
+
+def test_trigger_sends_batches(sqlite_connection, alert_app, confirmed_email, trigger_published_dt, mocker):
+    """Test that each sending thread sends its share of the alerts as one batch, marking each delivered."""
+    class FlakyTransport(Transport):
+        def __init__(self):
+            super().__init__('test@test.net')
+            self.batches = []
+
+        def send_batch(self, messages, wait=None, on_sent=None):
+            self.batches.append(len(messages))
+            return super().send_batch(messages, wait, on_sent)
+
+        def deliver(self, recipient, subject, html, text):
+            if recipient == 'drop@test.net':
+                raise Exception('connection lost')
+
+    transport = FlakyTransport()
+    mocker.patch.object(MailSingleton, 'get_mailer', return_value=transport)
+    alert_app.config['ALERT_SEND_CONCURRENCY'] = 2
+    with sqlite_connection.connect() as conn:
+        conn.execute(confirmed_emails.insert().values(user_id=1, email='drop@test.net'))
+        for recipient in ['test@test.net', 'test@test.net', 'drop@test.net']:
+            conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+                recipient=recipient, filter='', frequency=0, user_id=1))
+
+    report = trigger(alert_app)
+
+    assert report['sent'] == 2
+    assert report['failed'] == 1
+    assert sorted(transport.batches) == [1, 2]
+
+    with sqlite_connection.connect() as conn:
+        rows = conn.execute(select([sent_alerts.c.recipient, sent_alerts.c.delivered_dt])).fetchall()
+        assert sorted((row['recipient'], row['delivered_dt'] is not None) for row in rows) == [
+            ('drop@test.net', False), ('test@test.net', True), ('test@test.net', True)]
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(100)
+    start = monotonic()
+    for _ in range(11):
+        limiter.wait()
+    assert monotonic() - start >= 0.1
+
+
+def test_trigger_deduplicates_queries(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt, mocker):
+    """Test that alerts with the same criteria share a single lead query, even across batches."""
+    alert_app.config['ALERT_BATCH_SIZE'] = 2
+    find_alert_leads = mocker.patch('api.alerts.find_alert_leads', side_effect=alerts.find_alert_leads)
+    with sqlite_connection.connect() as conn:
+        # a blank filter shares the query of no filter, so it must match everything too
+        for filter_, local in [(' ', None), ('', None), ('', None), ('', 'exclude')]:
+            conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+                recipient='test@test.net',
+                filter=filter_,
+                local_source=local,
+                frequency=0,
+                user_id=1,
+            ))
+
+    report = trigger(alert_app)
+
+    assert report['alerts'] == 4
+    assert report['queries'] == 2
+    assert report['queries_saved'] == 2
+    assert find_alert_leads.call_count == 2
+    assert send_alert.call_count == 4
+
+
+def test_trigger_percolate(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt, mocker):
+    """Test that percolation finds the leads for every alert without per-alert queries."""
+    alert_app.config['ALERT_MATCHING'] = 'percolate'
+    find_alert_leads = mocker.patch('api.alerts.find_alert_leads', side_effect=alerts.find_alert_leads)
+    with sqlite_connection.connect() as conn:
+        for local in [None, 'exclude']:
+            conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+                recipient='test@test.net',
+                filter='',
+                local_source=local,
+                frequency=0,
+                user_id=1,
+            ))
+
+    report = trigger(alert_app)
+
+    assert report['alerts'] == 2
+    assert report['queries'] == 1
+    assert find_alert_leads.call_count == 0
+    assert send_alert.call_count == 2
+
+
+def test_trigger_queues_job(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt):
+    """Test that the trigger endpoint only queues a job, and that repeated triggers share it."""
+    with alert_app.test_client(False) as client:
+        first = client.post('/alert/trigger').get_json()['job']
+        second = client.post('/alert/trigger').get_json()['job']
+        other = client.post('/alert/trigger?frequency=weekly').get_json()['job']
+
+        assert first == second
+        assert other != first
+        assert client.get(f'/alert/trigger/{first}').get_json()['status'] == 'pending'
+
+    send_alert.assert_not_called()
+
+    with alert_app.app_context():
+        assert process_alert_jobs() == [first, other]
+
+
+def test_trigger_resumes_interrupted_job(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt):
+    """Test that a job interrupted after recording sends delivers only the undelivered ones when resumed."""
+    with sqlite_connection.connect() as conn:
+        for recipient in ['test@test.net', 'test@test.net']:
+            conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+                recipient=recipient, filter='', frequency=0, user_id=1))
+
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+
+    # simulate a worker that recorded both sends, delivered the first, and then crashed
+    with alert_app.app_context(), sqlite_connection.begin() as conn:
+        assert alerts.claim_alert_job(conn, job_id)
+        due = alerts.select_due_alerts(conn)
+        leads = alerts.find_alert_leads(due[0])
+        recorded = [alerts.record_alert(conn, alert, leads, job_id) for alert in due]
+    alerts.mark_delivered(recorded[0]['send_id'])
+
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    assert send_alert.call_count == 1
+    (sent_alert, _, _) = send_alert.call_args[0]
+    assert sent_alert['send_id'] == recorded[1]['send_id']
+
+    with sqlite_connection.connect() as conn:
+        rows = list(dict(row) for row in conn.execute(select([sent_alerts.c.alert_id, sent_alerts.c.delivered_dt])))
+        assert len(rows) == 2
+        assert all(row['delivered_dt'] is not None for row in rows)
+
+    with alert_app.test_client(False) as client:
+        report = client.get(f'/alert/trigger/{job_id}').get_json()['report']
+        assert report['resumed'] == 1
+        assert report['alerts'] == 0
+
+
+def test_failed_send_retried(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt):
+    """Test that an alert whose mail failed is sent again by the next job."""
+    with sqlite_connection.connect() as conn:
+        conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+            recipient='test@test.net', filter='', frequency=0, user_id=1))
+
+    send_alert.return_value = False
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    with alert_app.test_client(False) as client:
+        job = client.get(f'/alert/trigger/{job_id}').get_json()
+        assert job['status'] == 'done'
+        assert job['report']['sent'] == 0
+        assert job['report']['failed'] == 1
+
+    send_alert.return_value = True
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    with alert_app.test_client(False) as client:
+        job = client.get(f'/alert/trigger/{job_id}').get_json()
+        assert job['report']['alerts'] == 1
+        assert job['report']['sent'] == 1
+    assert send_alert.call_count == 2
+
+    with sqlite_connection.connect() as conn:
+        rows = list(conn.execute(select([sent_alerts.c.delivered_dt]).order_by(sent_alerts.c.id)))
+        assert [row['delivered_dt'] is not None for row in rows] == [False, True]
+
+    # once delivered, the alert is not due again this period
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+    assert send_alert.call_count == 2
+
+
+def test_failed_job_retried(sqlite_connection, send_alert, alert_app, confirmed_email, trigger_published_dt, mocker):
+    """Test that a job that raises is retried, delivering the sends it recorded, until it runs out of attempts."""
+    with sqlite_connection.connect() as conn:
+        conn.execute(alerts_.insert().values(  # pylint: disable=no-value-for-parameter
+            recipient='test@test.net', filter='', frequency=0, user_id=1))
+
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+
+    send_alert.return_value = True
+    mark_delivered = mocker.patch('api.alerts.mark_delivered', side_effect=Exception('connection lost'))
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    with alert_app.test_client(False) as client:
+        job = client.get(f'/alert/trigger/{job_id}').get_json()
+        assert job['status'] == 'pending'
+        assert job['report'] == {'error': 'connection lost', 'attempts': 1}
+
+    # the resumed send fails too. the alert is left for the next job instead
+    # of being recorded again
+    mark_delivered.side_effect = None
+    send_alert.return_value = False
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+
+    with alert_app.test_client(False) as client:
+        job = client.get(f'/alert/trigger/{job_id}').get_json()
+        assert job['status'] == 'done'
+        assert job['report']['resumed'] == 1
+        assert job['report']['failed'] == 1
+        assert job['report']['alerts'] == 0
+
+    with sqlite_connection.connect() as conn:
+        assert len(list(conn.execute(select([sent_alerts.c.id])))) == 1
+
+    # a job that keeps failing is given up on
+    alert_app.config['ALERT_JOB_ATTEMPTS'] = 1
+    send_alert.side_effect = Exception('connection lost')
+    with alert_app.test_client(False) as client:
+        job_id = client.post('/alert/trigger').get_json()['job']
+    with alert_app.app_context():
+        assert process_alert_jobs() == [job_id]
+    with alert_app.test_client(False) as client:
+        assert client.get(f'/alert/trigger/{job_id}').get_json()['status'] == 'failed'
@@ -1,23 +1,33 @@
+import base64
 import configparser
+import csv
+import hashlib
+import io
 import json
+from datetime import datetime
+from functools import wraps
 from math import ceil
 from os import environ
 
 import flask
-from flask import request, Blueprint
+from flask import current_app, request, Blueprint
 from flask_cors import CORS
-from sqlalchemy.sql import and_, select, text, func
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import orm
+from sqlalchemy.sql import and_, or_, select, text, func
 
 
 from api.alerts import alerts, init_alerts
-from api.auth import auth, login_required, login_used
-from api.db import engine, init_pool
+from api.auth import auth, login_required, login_used, whitelist_required
+from api.cache import (COMPRESSED_CACHE, COUNT_CACHE, RATINGS_CACHE, RESPONSE_CACHE,
+                       VersionCheck, init_cache, invalidate_lead_caches)
+from api.compression import compress_response, init_compression
+from api.db import engine, init_pool, pool_stats
+from api.encoding import DEFAULT_ENCODER, ENCODERS, dumps, json_response
+from api.flags import annotate_flags, flags_version, user_flag_set
 from api.flags import flags as flags_bp
-from api.mail import init_mail
-from api.models import annotated_leads, crowd_ratings, flags, leads
-from api.views import average_leads, CreateView
+from api.mail import MailSingleton, init_mail, init_templates
+from api.models import (RATING_DIMENSIONS, annotated_leads, crowd_ratings,
+                        lead_scores, leads)
+from api.search import get_search, init_search
 
 from api.errors import abort_json
 
@@ -25,6 +35,30 @@ with open('data/sources.json') as f:
     SOURCES = json.load(f)
 
 
+def init_leads():
+    cfg = configparser.ConfigParser()
+    cfg.read('keys.conf')
+
+    strategy = cfg.get('leads', 'count-strategy', fallback='query')
+    if strategy not in COUNT_STRATEGIES:
+        raise ValueError(f'Unknown count-strategy: {strategy}')
+
+    current_app.config['LEAD_COUNT_STRATEGY'] = strategy
+
+    encoder = cfg.get('leads', 'json-encoder', fallback=DEFAULT_ENCODER)
+    if encoder == 'orjson' and encoder not in ENCODERS:
+        print(f'json-encoder is orjson, but it is not installed. Using {DEFAULT_ENCODER} instead.')
+        encoder = DEFAULT_ENCODER
+    if encoder not in ENCODERS:
+        raise ValueError(f'Unknown json-encoder: {encoder}')
+    current_app.config['JSON_ENCODER'] = encoder
+    COUNT_CACHE.ttl = cfg.getint('leads', 'count-cache-ttl', fallback=60)
+    RESPONSE_CACHE.ttl = cfg.getint('leads', 'response-cache-ttl', fallback=300)
+    RESPONSE_CACHE.maxsize = cfg.getint('leads', 'response-cache-size', fallback=512)
+    RATINGS_CACHE.ttl = cfg.getint('leads', 'ratings-cache-ttl', fallback=300)
+    LEAD_VERSION_CHECK.interval = cfg.getint('leads', 'version-check-interval', fallback=10)
+
+
 def init_keys(app):
     try:
         cfg = configparser.ConfigParser()
@@ -43,8 +77,14 @@ app.register_blueprint(flags_bp)
 app.register_blueprint(auth)
 app.register_blueprint(alerts)
 app.before_first_request(init_mail)
+app.before_first_request(init_templates)
 app.before_first_request(init_pool)
+app.before_first_request(init_cache)
 app.before_first_request(init_alerts)
+app.before_first_request(init_leads)
+app.before_first_request(init_search)
+app.before_first_request(init_compression)
+app.after_request(compress_response)
 
 main = Blueprint('main', __name__)
 
@@ -66,45 +106,55 @@ LEAD_FIELDS = [
     leads.c.document_relevance
 ]
 
+LEAD_FIELDS_BY_NAME = {field.name: field for field in LEAD_FIELDS}
 
 
 
-def build_lead_selection(uid=None, fields=LEAD_FIELDS, where=[], flagged_only=False):
-    join = leads.join(annotated_leads)
-
 
-    if uid is not None:
-        fields = fields + [text('not isnull(uflags.id) as flagged')]
-        uflags = select([flags.c.id, flags.c.lead_id]).where(
-            flags.c.user_id == uid).alias('uflags')
+def build_lead_selection(fields=LEAD_FIELDS, where=[], flagged_ids=None):
+    """Build a selection of published leads. Setting `flagged_ids` (a user's
+    flag set, see `api.flags.user_flag_set`) restricts it to those leads."""
+    query = select(fields).select_from(leads.join(annotated_leads))
 
-        if flagged_only:
-            join = join.join(uflags)
-        else:
-            join = join.outerjoin(uflags)
-
-    query = select(fields).select_from(join)
+    if flagged_ids is not None:
+        where = [*where, leads.c.id.in_(flagged_ids)]
 
     # E712 asks for 'is True' but this is not actually a bool, just bool-y
     return query.where(and_(annotated_leads.c.is_published == True, *where))  # noqa: E712
 
 
-def build_filtered_lead_selection(filter_, from_, to, sources, page=1, uid=None, fields=LEAD_FIELDS, where=[], flagged_only=False):
-    """Build a filtered lead selection query. The filter parameters are required, but the remainder are optional.
+# sort score of leads without a news value average. they come first in their
+# day, as MySQL sorts NULLs first
+NULL_SCORE = -1
+
+
+def encode_cursor(row):
+    """Encode the sort key of `row` (the last lead on a page) as an opaque cursor string."""
+    # DATE() gives a date with MySQL and a string with SQLite
+    key = [str(row['sort_day']), row['sort_score'], row['id']]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by `encode_cursor` into a `(date, score, id)` tuple.
+
+    Raises `ValueError` if the cursor is malformed."""
+    try:
+        day, score, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+    if score is None:
+        score = NULL_SCORE
+    if not isinstance(day, str) or not isinstance(id_, int) or not isinstance(score, (int, float)):
+        raise ValueError('Invalid cursor')
+
+    return (day, score, id_)
 
-    Notes:
-    - Setting `page = None` disables pagination.
-    - Setting `uid = None` disables the `flagged` field in the output and the corresponding join.
-    """
-    where = [*where]
-    if filter_ is not None and filter_ != '':
-        where.append(
-            text("(match(name, description, topic) against (:filter in boolean mode) or match(people, organizations) against (:filter in boolean mode))").bindparams(filter=filter_))
-    if from_ is not None and from_ != '':
-        where.append(annotated_leads.c.published_dt >= from_)
-    if to is not None and to != '':
-        where.append(annotated_leads.c.published_dt <= to + ' 23:59:59')
 
+def allowed_jurisdictions(sources):
+    """The jurisdictions of leads matching the federal / regional / local
+    source filters in `sources`."""
     source_values = []
     for key in ['federal', 'regional', 'local']:
         value = sources.get(key, None)
@@ -115,61 +165,413 @@ def build_filtered_lead_selection(filter_, from_, to, sources, page=1, uid=None,
         else:
             # value is exclude or invalid
             pass
+    return source_values
 
-    # if the length of source_values is 0, then this will exclude
+
+def build_filtered_lead_selection(filter_, from_, to, sources, page=1, fields=LEAD_FIELDS, where=[], flagged_ids=None, after=None, with_count=False, scored=False):
+    """Build a filtered lead selection query. The filter parameters are required, but the remainder are optional.
+
+    Notes:
+    - Setting `page = None` disables pagination.
+    - Paginated queries are sorted by score, so they only select leads with a
+      `lead_scores` row. Setting `scored = True` applies the same restriction
+      to unpaginated queries, e.g. to count the pages.
+    - Setting `flagged_ids` restricts the selection to a user's flagged leads
+      (see `build_lead_selection`). The `flagged` field is not part of the
+      query; it is added with `api.flags.annotate_flags`.
+    - Setting `after` to a decoded cursor (see `decode_cursor`) seeks past that
+      row instead of using an offset. `page` is ignored in this case, but must
+      not be `None`.
+    - Paginated queries include extra `sort_day` and `sort_score` columns,
+      which are needed to build the cursor for the next page.
+    - Setting `with_count = True` adds a `num_results` column holding the
+      number of results across all pages (via `count(*) over ()`). This
+      requires window function support (MySQL 8+) and is meaningless when
+      combined with `after`, which excludes the earlier rows.
+    """
+    where = [*where]
+    # a blank filter matches everything. MATCH would match nothing
+    if filter_ is not None and filter_.strip() != '':
+        where.append(get_search().condition(filter_))
+    if from_ is not None and from_ != '':
+        where.append(annotated_leads.c.published_dt >= from_)
+    if to is not None and to != '':
+        where.append(annotated_leads.c.published_dt <= to + ' 23:59:59')
+
+    # if there are no allowed jurisdictions, then this will exclude
     # everything...but that is what the user asked for
-    where.append(leads.c.jurisdiction.in_(source_values))
+    where.append(leads.c.jurisdiction.in_(allowed_jurisdictions(sources)))
 
-    query = build_lead_selection(
-        uid=uid, fields=fields, where=where, flagged_only=flagged_only)
+    query = build_lead_selection(fields=fields, where=where, flagged_ids=flagged_ids)
+
+    if page is not None or scored:
+        # join query with the persisted lead scores (see api.scores).
+        query = query.join(lead_scores)
 
     if page is not None:
+        day = func.DATE(annotated_leads.c.published_dt)
+        # the average is NULL if no rating has a news value. NULLs would break
+        # the comparisons in the seek predicate below
+        score = func.coalesce(lead_scores.c.news_value_avg, NULL_SCORE)
+        query = query.add_columns(day.label('sort_day'), score.label('sort_score'))
+
+        if with_count:
+            query = query.add_columns(func.count().over().label('num_results'))
+
+        # order by annotated leads publish time and average leads newsworthy score.
+        # the id is a tie-breaker so that the order (and thus the cursor) is total
+        query = query.order_by(day.desc(), score.asc(), leads.c.id.asc())\
+            .limit(PAGE_SIZE)
+
+        if after is not None:
+            (after_day, after_score, after_id) = after
+            # seek past the last row of the previous page. this lets the
+            # database use the sort order instead of discarding every row
+            # before the offset
+            query = query.where(or_(
+                day < after_day,
+                and_(day == after_day, or_(
+                    score > after_score,
+                    and_(score == after_score, leads.c.id > after_id)))))
+        else:
+            query = query.offset(PAGE_SIZE * (page - 1))
+
+    return query
 
-        if not hasattr(average_leads, '_sa_class_manager'):
-                    orm.mapper(average_leads, average_leads.__view__)
 
-        #join query with the average_leads view.
-        query = query.join(average_leads)
-        
-        #order by annotated leads publish time and average leads newsworthy score 
-        query = query.order_by(func.DATE(annotated_leads.c.published_dt).desc(), average_leads.average_news_value.asc())\
-            .limit(PAGE_SIZE).offset(PAGE_SIZE * (page - 1))
+def lead_data_version():
+    """A cheap fingerprint of the published leads and their ratings. It
+    changes whenever leads are published or ratings are added or removed."""
+    published = select([func.count(annotated_leads.c.id), func.max(annotated_leads.c.published_dt)])\
+        .where(annotated_leads.c.is_published == True)  # noqa: E712
+    rated = select([func.count(crowd_ratings.c.id), func.max(crowd_ratings.c.id)])
 
-    return query
+    with engine().begin() as con:
+        return (tuple(con.execute(published).fetchone()), tuple(con.execute(rated).fetchone()))
+
+
+def lead_data_changed():
+    """Drop cached lead data and add newly published leads to the search index.
+
+    Scores of leads rated without going through `api.scores` are refreshed
+    by the alert worker and scripts/process-changes.py, not here, since this
+    runs while requests wait."""
+    invalidate_lead_caches()
+    with engine().connect() as con:
+        get_search().catch_up(con)
+
+
+LEAD_VERSION_CHECK = VersionCheck(lead_data_version, lead_data_changed)
+
+
+def last_published(version):
+    """The publish time of the newest lead in a `lead_data_version`."""
+    published_dt = version[0][1]
+    if isinstance(published_dt, str):
+        # SQLite returns the aggregate as text
+        published_dt = datetime.fromisoformat(published_dt)
+    return published_dt
+
+
+def conditional(view):
+    """Add an ETag and Last-Modified header to successful responses, and
+    answer requests whose If-None-Match matches with 304 Not Modified
+    without running the view. Must be applied after `login_used`.
+
+    The ETag is derived from `lead_data_version` (and the user's flags), so
+    like `cache_anonymous` it can lag behind new data by up to
+    `LEAD_VERSION_CHECK.interval` seconds."""
+    @wraps(view)
+    def wrapped_view(uid, **kwargs):
+        lead_version = LEAD_VERSION_CHECK()
+        version = lead_version
+        if uid is not None:
+            # flagged leads appear in the user's responses. the view reuses
+            # the version to check the cached flag set
+            with engine().connect() as con:
+                flask.g.flags_version = flags_version(con, uid)
+            version = (lead_version, uid, flask.g.flags_version)
+        etag = hashlib.sha1(repr(version).encode()).hexdigest()
+
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = flask.make_response(view(uid=uid, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_published(lead_version)
+        # ratings can change without a new lead being published, so clients
+        # must revalidate instead of trusting Last-Modified
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapped_view
+
+
+def cache_anonymous(view):
+    """Serve responses to anonymous users (`uid = None`) from
+    `RESPONSE_CACHE`. Must be applied after `login_used`.
+
+    Only successful responses are cached. Entries are keyed on the request
+    path and query string, and are dropped when the lead data changes."""
+    @wraps(view)
+    def wrapped_view(uid, **kwargs):
+        if uid is not None:
+            return view(uid=uid, **kwargs)
+
+        LEAD_VERSION_CHECK()
+
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            (body, mimetype) = cached
+            return current_app.response_class(body, mimetype=mimetype)
+
+        response = flask.make_response(view(uid=uid, **kwargs))
+        if response.status_code == 200:
+            RESPONSE_CACHE.set(key, (response.get_data(), response.mimetype))
+        return response
+
+    return wrapped_view
+
+
+@main.route('/stats/cache')
+@whitelist_required
+def cache_stats():
+    return {
+        'responses': RESPONSE_CACHE.stats(),
+        'counts': COUNT_CACHE.stats(),
+        'ratings': RATINGS_CACHE.stats(),
+        'compressed': COMPRESSED_CACHE.stats(),
+    }
+
+
+@main.route('/stats/pool')
+@whitelist_required
+def database_pool_stats():
+    return pool_stats(engine().pool)
+
+
+@main.route('/stats/mail')
+@whitelist_required
+def mail_stats():
+    return MailSingleton.get_stats()
+
+
+def load_ratings(con, lead_ids):
+    """Load the `crowd_ratings` rows of each lead, returned as a dict of lists
+    keyed by lead id. Ratings are shared by all users, so they are cached
+    regardless of who is asking."""
+    ratings = {}
+    missing = []
+    for lead_id in lead_ids:
+        cached = RATINGS_CACHE.get(lead_id)
+        if cached is None:
+            missing.append(lead_id)
+        else:
+            ratings[lead_id] = cached
+
+    if len(missing) > 0:
+        fetched = {lead_id: [] for lead_id in missing}
+        query = select([crowd_ratings]).where(
+            crowd_ratings.c.lead_id.in_(missing))
+        for rating in con.execute(query):
+            fetched[rating['lead_id']].append(dict(rating.items()))
+
+        for lead_id, lead_ratings in fetched.items():
+            RATINGS_CACHE.set(lead_id, lead_ratings)
+        ratings.update(fetched)
+
+    return ratings
+
+
+# how ratings are included with leads, selected by the `ratings` query parameter:
+# - full: every `crowd_ratings` row, including explanations (default)
+# - summary: the mean and count of each rating dimension, from `lead_scores`
+# - none: no ratings
+RATINGS_MODES = ['full', 'summary', 'none']
+
+
+def load_rating_summaries(con, lead_ids):
+    """Load the aggregated ratings of each lead from `lead_scores`, returned
+    as a dict keyed by lead id. Leads without ratings get empty summaries."""
+    summaries = {
+        lead_id: {'num_ratings': 0, **{dim: {'mean': None, 'count': 0} for dim in RATING_DIMENSIONS}}
+        for lead_id in lead_ids
+    }
+
+    query = select([lead_scores]).where(lead_scores.c.lead_id.in_(lead_ids))
+    for row in con.execute(query):
+        summaries[row['lead_id']] = {
+            'num_ratings': row['num_ratings'],
+            **{dim: {'mean': row[f'{dim}_avg'], 'count': row[f'{dim}_count']} for dim in RATING_DIMENSIONS}
+        }
+
+    return summaries
+
+
+def attach_ratings(con, res_map, mode):
+    """Add ratings to each lead in `res_map` (a dict of leads keyed by id) as
+    specified by `mode`, one of `RATINGS_MODES`."""
+    if mode == 'full':
+        ratings = load_ratings(con, list(res_map.keys()))
+        for lead_id, lead in res_map.items():
+            lead['ratings'] = ratings[lead_id]
+    elif mode == 'summary':
+        summaries = load_rating_summaries(con, list(res_map.keys()))
+        for lead_id, lead in res_map.items():
+            lead['rating_summary'] = summaries[lead_id]
+
+
+def get_lead_fields():
+    """Read and validate the `fields` query parameter, a comma-separated list
+    of names from `LEAD_FIELDS`. Returns the columns to select, which always
+    include the id, or None if any name is invalid."""
+    names = request.args.get('fields', None)
+    if names is None:
+        return LEAD_FIELDS
+
+    names = [name.strip() for name in names.split(',') if name.strip() != '']
+    if any(name not in LEAD_FIELDS_BY_NAME for name in names):
+        return None
+
+    return [leads.c.id] + [LEAD_FIELDS_BY_NAME[name] for name in names if name != 'id']
+
+
+INVALID_FIELDS = f'fields must be a comma-separated list of: {", ".join(LEAD_FIELDS_BY_NAME)}'
+
+
+def get_ratings_mode():
+    """Read and validate the `ratings` query parameter. Returns None if it is invalid."""
+    mode = request.args.get('ratings', 'full')
+    return mode if mode in RATINGS_MODES else None
 
 
 @main.route('/lead/<lead_id>')
 @login_used
+@conditional
+@cache_anonymous
 def get_lead(uid, lead_id):
+    ratings_mode = get_ratings_mode()
+    if ratings_mode is None:
+        return abort_json(400, f'ratings must be one of: {", ".join(RATINGS_MODES)}')
+
+    fields = get_lead_fields()
+    if fields is None:
+        return abort_json(400, INVALID_FIELDS)
+
     with engine().begin() as con:
-        query = build_lead_selection(uid, where=[leads.c.id == lead_id])
+        query = build_lead_selection(fields=fields, where=[leads.c.id == lead_id])
 
         resultset = con.execute(query)
         result = resultset.fetchone()
-        if result is not None:
+        if result is None:
+            return abort_json(404, 'no such id')
+
+        if uid is not None or ratings_mode != 'none':
+            # now we load flags and comments for it. otherwise the row is
+            # serialized as-is
             result = dict(result)
+            if uid is not None:
+                annotate_flags(user_flag_set(con, uid, flask.g.get('flags_version')), [result])
+            attach_ratings(con, {result['id']: result}, ratings_mode)
+        return json_response(result)
 
-            # now we load comments for it
-            ratings_query = select([crowd_ratings])\
-                .where(crowd_ratings.c.lead_id == lead_id)
-            ratings = con.execute(ratings_query)
-            result['ratings'] = [dict(row) for row in ratings.fetchall()]
-            return flask.jsonify(result)
-        else:
-            return abort_json(404, 'no such id')
+
+# the most leads that can be requested from /leads/batch at once
+BATCH_LIMIT = 100
+
+
+@main.route('/leads/batch', methods=('POST',))
+@login_used
+def get_leads_batch(uid):
+    """Receives a list of lead ids as JSON in the message body. Returns the
+    leads (as `get_lead` would, or null for ids that don't exist) in the same
+    order. The ratings and fields query parameters work as for `get_lead`.
+
+    A fixed number of queries is run no matter how many ids are given."""
+    try:
+        ids = request.get_json()
+
+        if not isinstance(ids, list) or not all(isinstance(id_, int) for id_ in ids):
+            raise ValueError()
+    except ValueError:
+        return abort_json(400, 'expected a list of lead ids')
+
+    if len(ids) > BATCH_LIMIT:
+        return abort_json(400, f'at most {BATCH_LIMIT} leads can be requested at once')
+
+    ratings_mode = get_ratings_mode()
+    if ratings_mode is None:
+        return abort_json(400, f'ratings must be one of: {", ".join(RATINGS_MODES)}')
+
+    fields = get_lead_fields()
+    if fields is None:
+        return abort_json(400, INVALID_FIELDS)
+
+    if len(ids) == 0:
+        return json_response({'leads': []})
+
+    with engine().begin() as con:
+        query = build_lead_selection(fields=fields, where=[leads.c.id.in_(set(ids))])
+        res_map = {row['id']: dict(row) for row in con.execute(query)}
+        if uid is not None:
+            annotate_flags(user_flag_set(con, uid), res_map.values())
+
+        attach_ratings(con, res_map, ratings_mode)
+        return json_response({'leads': [res_map.get(id_, None) for id_ in ids]})
 
 
 PAGE_SIZE = 5
 
+# ways of counting the total number of results in `filter_leads`:
+# - query: run a second `count(*)` query with the same filters
+# - window: add `count(*) over ()` to the page query (MySQL 8+)
+# - cache: like `query`, but reuse counts for `COUNT_CACHE.ttl` seconds
+COUNT_STRATEGIES = ['query', 'window', 'cache']
+
+
+def count_filtered_leads(con, filter_, from_, to, sources, flagged_ids=None, cached=False):
+    """Count the results of a filtered lead selection. If `cached` is set,
+    counts are shared between requests with equivalent filters for
+    `COUNT_CACHE.ttl` seconds."""
+    if cached:
+        key = (
+            ' '.join((filter_ or '').split()),
+            from_ or None,
+            to or None,
+            tuple(sources.get(k, None) for k in ['federal', 'regional', 'local']),
+            # flags are per-user, and change the count as soon as they change
+            None if flagged_ids is None else tuple(flagged_ids),
+        )
+        count = COUNT_CACHE.get(key)
+        if count is not None:
+            return count
+
+    count_query = build_filtered_lead_selection(filter_, from_, to, sources, page=None,
+                                                fields=[text('count(*) as num_results')],
+                                                flagged_ids=flagged_ids, scored=True)
+    count = con.execute(count_query).scalar()
+
+    if cached:
+        COUNT_CACHE.set(key, count)
+
+    return count
+
 
 @main.route('/leads')
 @login_used
+@conditional
+@cache_anonymous
 def filter_all(uid):
     return filter_leads(uid)
 
 
 @main.route('/leads/flagged')
 @login_required
+@conditional
 def filter_flagged(uid):
     return filter_leads(uid, flagged=True)
 
@@ -181,30 +583,56 @@ def filter_leads(uid, flagged=False):
     - from / to are start / end dates to search within
     - federal / regional / local define source filters which are matched on equality. "exclude" is a special value that indicates they should not be included.
     - page is a number from 1 to ...
+    - cursor is the `next` value of a previous response. If given, it is used instead of page.
+    - ratings is one of `RATINGS_MODES`. Listings that only show scores should use summary.
+    - fields is a comma-separated list of lead fields to include (see `LEAD_FIELDS`). The id is always included.
     """
 
     filter_ = request.args.get('filter', None)
     from_ = request.args.get('from', None)
     to = request.args.get('to', None)
     page = request.args.get('page', 1, int)
+    cursor = request.args.get('cursor', None)
 
-    query = build_filtered_lead_selection(
-        filter_, from_, to, request.args, page, uid, flagged_only=flagged)
+    ratings_mode = get_ratings_mode()
+    if ratings_mode is None:
+        return abort_json(400, f'ratings must be one of: {", ".join(RATINGS_MODES)}')
+
+    fields = get_lead_fields()
+    if fields is None:
+        return abort_json(400, INVALID_FIELDS)
 
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError as e:
+            return abort_json(400, str(e))
 
+    strategy = current_app.config.get('LEAD_COUNT_STRATEGY', 'query')
+    # the window count only covers the rows after the cursor, so cursor pages
+    # fall back to a separate count query
+    window_count = strategy == 'window' and after is None
 
     with engine().begin() as con:
+        flag_set = user_flag_set(con, uid, flask.g.get('flags_version')) if uid is not None else None
 
+        query = build_filtered_lead_selection(
+            filter_, from_, to, request.args, page, fields=fields, flagged_ids=flag_set if flagged else None,
+            after=after, with_count=window_count)
         result = con.execute(query)
 
         results = list(result.fetchall())
 
-        res_map = {res['id']: {'ratings': [], **dict(res.items())}
+        res_map = {res['id']: dict(res.items())
                    for res in results}
+        for lead in res_map.values():
+            del lead['sort_day'], lead['sort_score']
+            lead.pop('num_results', None)
 
         if len(results) == 0:
             # no need to do more queries. return empty result
-            return flask.jsonify({
+            return json_response({
                 'num_pages': 0,
                 'num_results': 0,
                 'page': 1,
@@ -212,36 +640,99 @@ def filter_leads(uid, flagged=False):
             })
 
         # count total results so we know the page count
-        count_query = build_filtered_lead_selection(filter_, from_, to, request.args, page=None, uid=uid,
-                                                    fields=[text('count(*) as num_results')], flagged_only=flagged)
-        result = con.execute(count_query)
-
-        meta = dict(result.fetchone().items())
-        print(meta)
-        
-
-        meta['num_pages'] = ceil(meta['num_results'] / PAGE_SIZE)
-        meta['page'] = page
-        if 'flagged' in meta:
-            del meta['flagged']
-
-        ratings_query = select([crowd_ratings]).where(
-            crowd_ratings.c.lead_id.in_(tuple(res_map.keys())))
-
-        ratings = con.execute(ratings_query)
+        if window_count:
+            num_results = results[0]['num_results']
+        else:
+            num_results = count_filtered_leads(con, filter_, from_, to, request.args,
+                                               flagged_ids=flag_set if flagged else None,
+                                               cached=strategy == 'cache')
 
+        meta = {
+            'num_results': num_results,
+            'num_pages': ceil(num_results / PAGE_SIZE)
+        }
+        if after is None:
+            meta['page'] = page
+        if len(results) == PAGE_SIZE:
+            meta['next'] = encode_cursor(results[-1])
 
-        for rating in ratings:
-            
-            lead = res_map[rating['lead_id']]
-            lead['ratings'].append(dict(rating.items()))
+        if flag_set is not None:
+            annotate_flags(flag_set, res_map.values())
+        attach_ratings(con, res_map, ratings_mode)
 
         result = {
             'leads': list(res_map.values()),
             **meta
         }
 
-        return flask.jsonify(result)
+        return json_response(result)
+
+
+# content types of the formats supported by /leads/export
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# rows fetched from the database (and written to the response) at a time
+EXPORT_BATCH_SIZE = 500
+
+
+def format_csv_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+@main.route('/leads/export')
+@login_used
+def export_leads(uid):
+    """Stream every lead matching the filters of /leads (filter, from, to,
+    federal / regional / local and fields, see `filter_leads`), newest first.
+
+    The format is ndjson (one JSON object per line, the default) or csv,
+    given by ?format=. Rows are written as they are fetched from a
+    server-side cursor, so memory use does not grow with the number of leads."""
+    format_ = request.args.get('format', 'ndjson')
+    if format_ not in EXPORT_FORMATS:
+        return abort_json(400, f'format must be one of: {", ".join(EXPORT_FORMATS)}')
+
+    fields = get_lead_fields()
+    if fields is None:
+        return abort_json(400, INVALID_FIELDS)
+
+    query = build_filtered_lead_selection(
+        request.args.get('filter', None), request.args.get('from', None), request.args.get('to', None),
+        request.args, page=None, fields=fields)\
+        .order_by(annotated_leads.c.published_dt.desc(), leads.c.id.asc())
+
+    def generate():
+        with engine().connect() as con:
+            flag_set = user_flag_set(con, uid) if uid is not None else None
+
+            result = con.execution_options(stream_results=True).execute(query)
+            if format_ == 'csv':
+                yield format_csv_rows([[*result.keys(), *(['flagged'] if flag_set is not None else [])]])
+
+            while True:
+                rows = result.fetchmany(EXPORT_BATCH_SIZE)
+                if len(rows) == 0:
+                    break
+
+                if flag_set is not None:
+                    rows = [dict(row._mapping) for row in rows]
+                    annotate_flags(flag_set, rows)
+                    if format_ == 'csv':
+                        rows = [lead.values() for lead in rows]
+
+                if format_ == 'csv':
+                    yield format_csv_rows(rows)
+                else:
+                    yield b''.join(dumps(row) + b'\n' for row in rows)
+
+    response = current_app.response_class(flask.stream_with_context(generate()), mimetype=EXPORT_FORMATS[format_])
+    response.headers['Content-Disposition'] = f'attachment; filename=leads.{format_}'
+    return response
 
 
 app.register_blueprint(main)
@@ -1,5 +1,12 @@
-from api.models import crowd_ratings
+from api.api import COUNT_CACHE, LEAD_VERSION_CHECK, RATINGS_CACHE, RESPONSE_CACHE
+from api.models import annotated_leads, crowd_ratings, flags, lead_scores, leads
+from api.scores import add_ratings, refresh_stale_lead_scores
+import csv
 import datetime
+import io
+import json
+import pytest
+from sqlalchemy import event
 
 
 def test_get_lead_returns_ratings(sqlite_connection, api_app):
@@ -32,3 +39,299 @@ def test_filtered_leads_exact_day(sqlite_connection, api_app):
         for lead in data['leads']:
             lead_dt = datetime.datetime.strptime(lead['published_dt'], '%a, %d %b %Y %H:%M:%S GMT')
             assert lead_dt.date() == date
+
+
+def test_filtered_leads_cursor_matches_pages(sqlite_connection, api_app):
+    """Test that following `next` cursors visits the same leads as numbered pages."""
+    with api_app.test_client(True) as client:
+        data = client.get('/leads').get_json()
+        num_pages = data['num_pages']
+        num_results = data['num_results']
+        assert num_pages > 1
+
+        paged = []
+        for page in range(1, num_pages + 1):
+            res = client.get(f'/leads?page={page}')
+            paged += [lead['id'] for lead in res.get_json()['leads']]
+
+        cursored = []
+        res = client.get('/leads')
+        while True:
+            data = res.get_json()
+            cursored += [lead['id'] for lead in data['leads']]
+            if 'next' not in data:
+                break
+            res = client.get(f"/leads?cursor={data['next']}")
+            assert res.status_code == 200
+
+        assert cursored == paged
+        assert len(cursored) == num_results
+
+
+def test_new_ratings_listed(sqlite_connection, api_app, mocker):
+    """Test that leads rated without going through api.scores are listed and counted once their scores are refreshed."""
+    mocker.patch.object(LEAD_VERSION_CHECK, 'interval', 0)
+    with api_app.test_client(True) as client:
+        before = client.get('/leads').get_json()
+
+        with sqlite_connection.connect() as conn:
+            conn.execute(leads.insert().values(id=20000, jurisdiction='Federal Agency - Executive'))
+            conn.execute(annotated_leads.insert().values(
+                lead_id=20000, name='new', is_published=1, published_dt=datetime.datetime(2020, 1, 1)))
+
+        # unrated leads are neither listed nor counted
+        data = client.get('/leads').get_json()
+        assert data['num_results'] == before['num_results']
+        assert 20000 not in [lead['id'] for lead in data['leads']]
+
+        with sqlite_connection.connect() as conn:
+            conn.execute(crowd_ratings.insert().values(lead_id=20000, news_value=3.0))
+
+        # the API only drops its caches, the worker refreshes the scores
+        data = client.get('/leads').get_json()
+        assert data['num_results'] == before['num_results']
+
+        with sqlite_connection.begin() as conn:
+            assert refresh_stale_lead_scores(conn) == [20000]
+
+        data = client.get('/leads').get_json()
+        assert data['num_results'] == before['num_results'] + 1
+        assert data['leads'][0]['id'] == 20000
+
+
+def test_filtered_leads_cursor_null_scores(sqlite_connection, api_app):
+    """Test that cursors work across leads without a news value average."""
+    with sqlite_connection.connect() as conn:
+        conn.execute(lead_scores.update().values(news_value_avg=None).where(
+            lead_scores.c.lead_id.in_([11329, 11439, 10082])))
+
+    test_filtered_leads_cursor_matches_pages(sqlite_connection, api_app)
+
+    with api_app.test_client(True) as client:
+        data = client.get('/leads').get_json()
+        # unscored leads come first in their day, ordered by id
+        assert [lead['id'] for lead in data['leads']] == [14370, 14345, 12431, 11329, 11439]
+        assert client.get(f"/leads?cursor={data['next']}").get_json()['leads'][0]['id'] == 10082
+
+
+def test_filtered_leads_blank_filter(sqlite_connection, api_app):
+    """Test that a blank filter matches every lead, like no filter."""
+    with api_app.test_client(True) as client:
+        everything = client.get('/leads').get_json()
+        assert client.get('/leads?filter=%20%20').get_json() == everything
+
+
+def test_filtered_leads_invalid_cursor(sqlite_connection, api_app):
+    with api_app.test_client(True) as client:
+        res = client.get('/leads?cursor=garbage')
+        assert res.status_code == 400
+
+
+@pytest.mark.parametrize('strategy', ['query', 'window', 'cache'])
+def test_filtered_leads_count_strategies(sqlite_connection, api_app, strategy):
+    """Test that every count strategy reports the same totals, regardless of page."""
+    COUNT_CACHE.clear()
+    api_app.config['LEAD_COUNT_STRATEGY'] = strategy
+    expected = {
+        '': 10,
+        'page=2': 10,
+        'regional=exclude&local=exclude&federal=Federal Agency - Legislative': 1,
+        'from=2019-06-30&to=2019-06-30': 2,
+    }
+    with api_app.test_client(True) as client:
+        for _ in range(2):
+            for query, count in expected.items():
+                data = client.get(f'/leads?{query}').get_json()
+                assert data['num_results'] == count
+                assert data['num_pages'] == -(-count // 5)
+                assert 'num_results' not in data['leads'][0]
+
+
+def test_anonymous_responses_cached(sqlite_connection, api_app):
+    """Test that repeated anonymous requests are served from the response cache."""
+    with api_app.test_client(True) as client:
+        first = client.get('/lead/6933')
+        hits = RESPONSE_CACHE.hits
+        second = client.get('/lead/6933')
+
+        assert RESPONSE_CACHE.hits == hits + 1
+        assert second.status_code == 200
+        assert second.get_json() == first.get_json()
+
+        # 404s are not cached
+        assert client.get('/lead/1').status_code == 404
+        assert client.get('/lead/1').status_code == 404
+        assert RESPONSE_CACHE.hits == hits + 1
+
+        stats = client.get('/stats/cache').get_json()
+        assert stats['responses']['hits'] == hits + 1
+
+        # stats are only available to whitelisted addresses
+        assert client.get('/stats/cache', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 401
+
+
+def test_response_cache_invalidated_by_ratings(sqlite_connection, api_app, mocker):
+    """Test that new ratings invalidate cached responses, even if added by another process."""
+    mocker.patch.object(LEAD_VERSION_CHECK, 'interval', 0)
+    with api_app.test_client(True) as client:
+        before = client.get('/lead/6933').get_json()
+
+        with sqlite_connection.connect() as conn:
+            conn.execute(crowd_ratings.insert().values(lead_id=6933, news_value=1.0))
+
+        after = client.get('/lead/6933').get_json()
+        assert len(after['ratings']) == len(before['ratings']) + 1
+
+        with sqlite_connection.begin() as conn:
+            add_ratings(conn, [{'lead_id': 6933, 'news_value': 2.0}])
+
+        after = client.get('/lead/6933').get_json()
+        assert len(after['ratings']) == len(before['ratings']) + 2
+
+
+def test_conditional_requests(sqlite_connection, api_app, mocker):
+    """Test that repeat requests with a matching ETag get 304s until the lead data changes."""
+    mocker.patch.object(LEAD_VERSION_CHECK, 'interval', 0)
+    with api_app.test_client(True) as client:
+        for url in ['/lead/6933', '/leads', '/leads?page=2']:
+            first = client.get(url)
+            assert first.status_code == 200
+            assert first.headers['ETag'].startswith('W/')
+            assert first.last_modified is not None
+            assert 'no-cache' in first.headers['Cache-Control']
+
+            repeat = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+            assert repeat.status_code == 304
+            assert repeat.get_data() == b''
+            assert repeat.headers['ETag'] == first.headers['ETag']
+
+        assert client.get('/lead/6933', headers={'If-None-Match': 'W/"stale"'}).status_code == 200
+        assert 'ETag' not in client.get('/lead/1').headers
+
+        etag = client.get('/lead/6933').headers['ETag']
+        with sqlite_connection.connect() as conn:
+            conn.execute(crowd_ratings.insert().values(lead_id=6933, news_value=1.0))
+        changed = client.get('/lead/6933', headers={'If-None-Match': etag})
+        assert changed.status_code == 200
+        assert changed.headers['ETag'] != etag
+
+
+def test_ratings_modes(sqlite_connection, api_app):
+    """Test that ratings can be summarized or left out, on both endpoints."""
+    with api_app.test_client(True) as client:
+        full = client.get('/lead/6933').get_json()
+        summary = client.get('/lead/6933?ratings=summary').get_json()
+        none = client.get('/lead/6933?ratings=none').get_json()
+
+        assert 'rating_summary' not in full
+        assert 'ratings' not in summary and 'ratings' not in none
+        assert 'rating_summary' not in none
+
+        values = [r['news_value'] for r in full['ratings']]
+        assert summary['rating_summary']['num_ratings'] == len(full['ratings'])
+        assert summary['rating_summary']['news_value']['count'] == len(values)
+        assert summary['rating_summary']['news_value']['mean'] == pytest.approx(sum(values) / len(values))
+
+        leads = client.get('/leads?ratings=summary').get_json()['leads']
+        assert all('ratings' not in lead and lead['rating_summary']['num_ratings'] > 0 for lead in leads)
+
+        assert client.get('/leads?ratings=bogus').status_code == 400
+        assert client.get('/lead/6933?ratings=bogus').status_code == 400
+
+
+def test_field_projection(sqlite_connection, api_app):
+    """Test that ?fields= limits the lead fields returned, and that cursors still work with it."""
+    with api_app.test_client(True) as client:
+        lead = client.get('/lead/6933?fields=name,link&ratings=none').get_json()
+        assert set(lead.keys()) == {'id', 'name', 'link'}
+
+        data = client.get('/leads?fields=name&ratings=none').get_json()
+        assert all(set(lead.keys()) == {'id', 'name'} for lead in data['leads'])
+
+        full = client.get(f"/leads?cursor={data['next']}").get_json()
+        projected = client.get(f"/leads?cursor={data['next']}&fields=name").get_json()
+        assert [lead['id'] for lead in projected['leads']] == [lead['id'] for lead in full['leads']]
+        assert all(set(lead.keys()) == {'id', 'name', 'ratings'} for lead in projected['leads'])
+
+        assert client.get('/leads?fields=name,password').status_code == 400
+        assert client.get('/lead/6933?fields=secret').status_code == 400
+
+
+def test_export(sqlite_connection, api_app):
+    """Test that every matching lead is exported, in either format."""
+    with api_app.test_client(True) as client:
+        num_results = client.get('/leads?local=exclude').get_json()['num_results']
+
+        res = client.get('/leads/export?local=exclude')
+        assert res.status_code == 200
+        assert res.mimetype == 'application/x-ndjson'
+        assert res.is_streamed
+        rows = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+        assert len(rows) == num_results
+        assert len({row['id'] for row in rows}) == num_results
+        assert 'published_dt' in rows[0]
+
+        res = client.get('/leads/export?local=exclude&format=csv&fields=name,link')
+        assert res.mimetype == 'text/csv'
+        rows = list(csv.reader(io.StringIO(res.get_data(as_text=True))))
+        assert rows[0] == ['id', 'name', 'link']
+        assert len(rows) == num_results + 1
+
+        assert client.get('/leads/export?format=xml').status_code == 400
+        assert client.get('/leads/export?fields=nope').status_code == 400
+
+
+def test_leads_batch(sqlite_connection, api_app):
+    """Test that a batch returns the same leads as /lead/<id>, in request order."""
+    with api_app.test_client(True) as client:
+        ids = [6933, 1, 1420, 6933]
+        res = client.post('/leads/batch?ratings=summary', json=ids)
+        assert res.status_code == 200
+        batch = res.get_json()['leads']
+        assert [lead and lead['id'] for lead in batch] == [6933, None, 1420, 6933]
+        assert batch[0] == client.get('/lead/6933?ratings=summary').get_json()
+        assert batch[2] == client.get('/lead/1420?ratings=summary').get_json()
+
+        # the number of queries doesn't depend on the number of leads
+        queries = []
+        event.listen(sqlite_connection, 'before_cursor_execute', lambda *args: queries.append(args))
+        for ids in [[6933], [6933, 1420, 6914, 9697, 10082]]:
+            RATINGS_CACHE.clear()
+            queries.clear()
+            assert len(client.post('/leads/batch', json=ids).get_json()['leads']) == len(ids)
+            assert len(queries) == 2
+
+        assert client.post('/leads/batch', json=[]).get_json() == {'leads': []}
+        assert client.post('/leads/batch', json={'id': 1}).status_code == 400
+        assert client.post('/leads/batch', json=['a']).status_code == 400
+        assert client.post('/leads/batch', json=list(range(1000))).status_code == 400
+
+
+def test_flagged_leads(sqlite_connection, api_app):
+    """Test that signed-in users see their flags, which are annotated from their cached flag set."""
+    with api_app.test_client(True) as client:
+        with client.session_transaction() as sess:
+            sess['id'] = 1
+
+        assert client.get('/lead/6933').get_json()['flagged'] is False
+        assert client.get('/leads/flagged').get_json()['num_results'] == 0
+
+        with sqlite_connection.connect() as conn:
+            conn.execute(flags.insert().values(lead_id=6933, user_id=1))
+
+        # the cached flag set is reloaded once the flags change
+        assert client.get('/lead/6933').get_json()['flagged'] is True
+        data = client.get('/leads/flagged').get_json()
+        assert [lead['id'] for lead in data['leads']] == [6933]
+        assert data['num_results'] == 1
+
+        leads = client.get('/leads').get_json()['leads']
+        assert all(lead['flagged'] == (lead['id'] == 6933) for lead in leads)
+
+        # the version computed for the ETag is reused to check the flag set
+        statements = []
+        event.listen(sqlite_connection, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        client.get('/leads')
+        assert len([statement for statement in statements if 'flags_version' in statement]) == 1
+        assert client.post('/leads/batch', json=[6933, 1420]).get_json()['leads'][1]['flagged'] is False
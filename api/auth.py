@@ -1,12 +1,13 @@
 from functools import wraps
 
 from flask import Blueprint, abort, current_app, request, session
-from google.auth.transport import requests
 from google.oauth2 import id_token
 from itsdangerous import BadSignature, URLSafeTimedSerializer
 from sqlalchemy.sql import and_, select
 from werkzeug.exceptions import BadRequest
 
+from api.cache import USER_CACHE
+from api.certs import get_cert_transport
 from api.db import engine
 from api.errors import NoSuchConfirmation, abort_json
 from api.models import confirmed_emails, pending_confirmations, users
@@ -20,7 +21,7 @@ def validate_token(token):
     success, returns the EXTERNAL user id. on failure, returns None."""
     try:
         idinfo = id_token.verify_oauth2_token(
-            token, requests.Request(), CLIENT_ID)
+            token, get_cert_transport(), CLIENT_ID)
     except ValueError as e:
         print(e)
         return None
@@ -39,9 +40,13 @@ def signup(token):
     if info is None:
         return None
 
-    with engine().begin() as con:
-        email = info['email'] if info['email_verified'] else None
+    key = ('user', 'GOOGLE', info['sub'])
+    uid = USER_CACHE.get(key)
+    if uid is not None:
+        return uid
 
+    email = info['email'] if info['email_verified'] else None
+    with engine().begin() as con:
         query = select([users.c.id]).where(
             and_(users.c.external_id == info['sub'], users.c.external_type == 'GOOGLE'))
 
@@ -49,7 +54,8 @@ def signup(token):
 
         if res.rowcount >= 1:
             row = res.fetchone()
-            return row[0]
+            uid = row[0]
+            email = None
         else:
             res = con.execute(users.insert().values(  # pylint: disable=no-value-for-parameter
                 external_id=info['sub'], external_type='GOOGLE'))
@@ -58,7 +64,29 @@ def signup(token):
             if email is not None:
                 con.execute(confirmed_emails.insert().values(  # pylint: disable=no-value-for-parameter
                     user_id=uid, email=email))
-            return uid
+
+    if email is not None:
+        forget_confirmations([uid])
+    USER_CACHE.set(key, uid)
+    return uid
+
+
+def confirmed_email_set(con, uid):
+    """The emails that user `uid` has confirmed, as a frozenset."""
+    key = ('confirmed', uid)
+    emails = USER_CACHE.get(key)
+    if emails is None:
+        res = con.execute(select([confirmed_emails.c.email]).where(confirmed_emails.c.user_id == uid))
+        emails = frozenset(row['email'] for row in res)
+        USER_CACHE.set(key, emails)
+    return emails
+
+
+def forget_confirmations(uids):
+    """Drop the cached confirmations of the users `uids` after one of their
+    emails was confirmed or unconfirmed. Call once the change is committed."""
+    for uid in uids:
+        USER_CACHE.delete(('confirmed', uid))
 
 
 def parse_token():
@@ -87,6 +115,17 @@ def login_used(view):
     return wrapped_view
 
 
+def whitelist_required(view):
+    """Only allow requests from the addresses in `ALERT_TRIGGER_WHITELIST`
+    (trigger_ip_whitelist in keys.conf), e.g. for operational endpoints."""
+    @wraps(view)
+    def wrapped_view(**kwargs):
+        if request.remote_addr not in current_app.config.get('ALERT_TRIGGER_WHITELIST', []):
+            return abort_json(401, 'Unauthorized')
+        return view(**kwargs)
+    return wrapped_view
+
+
 auth = Blueprint('auth', __name__, url_prefix='/auth')
 
 
@@ -143,6 +182,7 @@ def confirm_email():
                 and_(pending_confirmations.c.user_id == confirmation['user_id'],
                      pending_confirmations.c.email == confirmation['email'])))
 
+        forget_confirmations([confirmation['user_id']])
         return {
             'status': 'ok'
         }
@@ -0,0 +1,267 @@
+"""Caches for query results and responses.
+
+Each named `Cache` stores its entries in the configured backend. By default
+this is a `MemoryBackend`, which is private to the process. uWSGI runs several
+processes, so `init_cache` can instead select a `SQLiteBackend`, which keeps
+entries in a file shared by every process on the machine."""
+import pickle
+import sqlite3
+from collections import OrderedDict
+from configparser import ConfigParser
+from threading import Lock, local
+from time import monotonic, time
+
+MISSING = object()
+
+
+class MemoryBackend:
+    """Stores each cache as a thread-safe LRU dictionary in this process."""
+
+    def __init__(self):
+        self._caches = {}
+        self._lock = Lock()
+
+    def get(self, name, key):
+        with self._lock:
+            entries = self._caches.get(name, {})
+            entry = entries.get(key, None)
+            if entry is None:
+                return MISSING
+
+            (expires, value) = entry
+            if expires <= monotonic():
+                del entries[key]
+                return MISSING
+
+            entries.move_to_end(key)
+            return value
+
+    def set(self, name, key, value, ttl, maxsize):
+        """Store an entry, returning the number of entries evicted to make room."""
+        with self._lock:
+            entries = self._caches.setdefault(name, OrderedDict())
+            entries.pop(key, None)
+            entries[key] = (monotonic() + ttl, value)
+            evicted = 0
+            while len(entries) > maxsize:
+                entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, name, key):
+        with self._lock:
+            self._caches.get(name, {}).pop(key, None)
+
+    def clear(self, name):
+        with self._lock:
+            self._caches.pop(name, None)
+
+    def size(self, name):
+        return len(self._caches.get(name, {}))
+
+
+class SQLiteBackend:
+    """Stores every cache in a single SQLite file, which can be shared by all
+    processes on the machine. Values must be picklable.
+
+    When a cache is full, the entries closest to expiry are evicted first."""
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+
+        con = self._connection()
+        con.execute('pragma journal_mode=wal')
+        con.execute('''create table if not exists cache_entries (
+            name text not null,
+            key text not null,
+            value blob not null,
+            expires real not null,
+            primary key (name, key)
+        )''')
+        con.execute('create index if not exists cache_entries_expiry on cache_entries(name, expires)')
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.con = con
+        return con
+
+    def get(self, name, key):
+        row = self._connection().execute(
+            'select value from cache_entries where name = ? and key = ? and expires > ?',
+            (name, repr(key), time())).fetchone()
+
+        if row is None:
+            return MISSING
+        return pickle.loads(row[0])
+
+    def set(self, name, key, value, ttl, maxsize):
+        """Store an entry, returning the number of entries evicted to make room."""
+        con = self._connection()
+        with con:
+            con.execute('begin immediate')
+            con.execute('insert or replace into cache_entries values (?, ?, ?, ?)',
+                        (name, repr(key), pickle.dumps(value), time() + ttl))
+            con.execute('delete from cache_entries where name = ? and expires <= ?', (name, time()))
+
+            excess = self.size(name) - maxsize
+            if excess > 0:
+                con.execute('''delete from cache_entries where rowid in (
+                    select rowid from cache_entries where name = ? order by expires limit ?
+                )''', (name, excess))
+                return excess
+            return 0
+
+    def delete(self, name, key):
+        self._connection().execute('delete from cache_entries where name = ? and key = ?', (name, repr(key)))
+
+    def clear(self, name):
+        self._connection().execute('delete from cache_entries where name = ?', (name,))
+
+    def size(self, name):
+        return self._connection().execute(
+            'select count(*) from cache_entries where name = ?', (name,)).fetchone()[0]
+
+
+class BackendSingleton:
+    __backend = MemoryBackend()
+
+    @classmethod
+    def init(cls, backend=None):
+        if backend is None:
+            cfg = ConfigParser()
+            cfg.read('keys.conf')
+
+            kind = cfg.get('cache', 'backend', fallback='memory')
+            if kind == 'memory':
+                backend = MemoryBackend()
+            elif kind == 'sqlite':
+                backend = SQLiteBackend(cfg.get('cache', 'path', fallback='/tmp/algotips-cache.sqlite'))
+            else:
+                raise ValueError(f'Unknown cache backend: {kind}')
+
+        cls.__backend = backend
+
+    @classmethod
+    def get_backend(cls):
+        return cls.__backend
+
+
+def init_cache(backend=None):
+    """Select the cache backend. If `backend` is None, it is read from keys.conf."""
+    BackendSingleton.init(backend)
+
+
+class Cache:
+    """A named cache whose entries expire `ttl` seconds after being set. At
+    most `maxsize` entries are kept. Entries are stored in the backend chosen
+    by `init_cache`.
+
+    Hit and miss counts are tracked per process."""
+
+    def __init__(self, name, ttl, maxsize=1024):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        value = BackendSingleton.get_backend().get(self.name, key)
+        if value is MISSING:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.evictions += BackendSingleton.get_backend().set(self.name, key, value, self.ttl, self.maxsize)
+
+    def delete(self, key):
+        BackendSingleton.get_backend().delete(self.name, key)
+
+    def clear(self):
+        BackendSingleton.get_backend().clear(self.name)
+
+    def stats(self):
+        return {
+            'backend': type(BackendSingleton.get_backend()).__name__,
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return BackendSingleton.get_backend().size(self.name)
+
+
+class VersionCheck:
+    """Calls `on_change` whenever the value returned by `probe` changes.
+    Each call returns the latest version.
+
+    Probing usually costs a query, so `probe` is called at most once every
+    `interval` seconds. Calling `reset` forces the next check to probe."""
+
+    def __init__(self, probe, on_change, interval=10):
+        self.probe = probe
+        self.on_change = on_change
+        self.interval = interval
+        self._version = None
+        self._next_check = 0
+        self._lock = Lock()
+
+    def __call__(self):
+        with self._lock:
+            now = monotonic()
+            if now < self._next_check:
+                return self._version
+
+            self._next_check = now + self.interval
+            version = self.probe()
+            if version != self._version:
+                if self._version is not None:
+                    self.on_change()
+                self._version = version
+            return version
+
+    def reset(self):
+        with self._lock:
+            self._version = None
+            self._next_check = 0
+
+
+# counts of filtered lead selections. see api.api.count_filtered_leads
+COUNT_CACHE = Cache('counts', ttl=60)
+
+# serialized responses for anonymous lead requests. see api.api.cache_anonymous
+RESPONSE_CACHE = Cache('responses', ttl=300, maxsize=512)
+
+# `crowd_ratings` rows by lead id. see api.api.load_ratings
+RATINGS_CACHE = Cache('ratings', ttl=300, maxsize=4096)
+
+# sorted arrays of the lead ids flagged by each user. see api.flags.user_flag_set
+FLAG_CACHE = Cache('flags', ttl=300, maxsize=4096)
+
+# user ids by external id, and confirmed emails by user. see api.auth. the
+# ttl is short as memory backends are not invalidated across processes
+USER_CACHE = Cache('users', ttl=60, maxsize=4096)
+
+# compressed bodies of cacheable responses. see api.compression
+COMPRESSED_CACHE = Cache('compressed', ttl=300, maxsize=512)
+
+
+def invalidate_lead_caches():
+    """Drop all cached lead data. This must be called after leads are
+    published or ratings change."""
+    COUNT_CACHE.clear()
+    RESPONSE_CACHE.clear()
+    RATINGS_CACHE.clear()
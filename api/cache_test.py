@@ -0,0 +1,74 @@
+import pytest
+
+from api.cache import (RESPONSE_CACHE, Cache, MemoryBackend, SQLiteBackend,
+                       init_cache)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        backend = MemoryBackend()
+    else:
+        backend = SQLiteBackend(str(tmp_path / 'cache.sqlite'))
+    init_cache(backend)
+    return backend
+
+
+def test_cache_lru_eviction(backend):
+    cache = Cache('test', ttl=60, maxsize=2)
+    cache.set(('a',), 1)
+    cache.set(('b',), 2)
+    cache.set(('c',), 3)
+
+    assert cache.get(('a',)) is None
+    assert cache.get(('b',)) == 2
+    assert cache.get(('c',)) == 3
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+    assert len(cache) == 2
+
+
+def test_cache_expiry(backend):
+    cache = Cache('test', ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+def test_cache_delete(backend):
+    cache = Cache('test', ttl=60)
+    cache.set(('a', 1), 1)
+    cache.set(('b', 1), 2)
+    cache.delete(('a', 1))
+    cache.delete(('c', 1))
+
+    assert cache.get(('a', 1)) is None
+    assert cache.get(('b', 1)) == 2
+
+
+def test_cache_namespaces(backend):
+    first = Cache('first', ttl=60)
+    second = Cache('second', ttl=60)
+    first.set('a', 1)
+    second.set('a', 2)
+    first.clear()
+
+    assert first.get('a') is None
+    assert second.get('a') == 2
+
+
+def test_sqlite_backend_shared_between_processes(sqlite_connection, api_app, tmp_path):
+    """Test that a response cached by one worker is served by another worker using the same file."""
+    path = str(tmp_path / 'shared.sqlite')
+    init_cache(SQLiteBackend(path))
+    with api_app.test_client(True) as client:
+        first = client.get('/lead/6933')
+
+    # simulate a second uWSGI process, which has its own connection
+    init_cache(SQLiteBackend(path))
+    hits = RESPONSE_CACHE.hits
+    with api_app.test_client(True) as client:
+        second = client.get('/lead/6933')
+
+    assert RESPONSE_CACHE.hits == hits + 1
+    assert second.get_json() == first.get_json()
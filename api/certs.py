@@ -0,0 +1,75 @@
+"""Transport for fetching the certificates that Google signs id tokens with.
+
+`id_token.verify_oauth2_token` fetches Google's certificates every time it
+verifies a token, so each sign-in waited on an HTTPS request over a new
+connection. `CachedCertsRequest` wraps a google-auth transport and keeps
+successful GET responses for as long as their Cache-Control max-age allows.
+The default transport uses a pooled `requests.Session`.
+
+Tests can install a local stand-in transport with `init_cert_transport`.
+"""
+from threading import Lock
+from time import monotonic
+
+from google.auth.transport import requests
+from requests import Session
+from werkzeug.http import parse_cache_control_header
+
+
+def max_age(response):
+    """How long `response` may be cached for, in seconds, or None."""
+    cache_control = parse_cache_control_header(response.headers.get('Cache-Control'))
+    if cache_control.no_store or cache_control.no_cache:
+        return None
+    return cache_control.max_age
+
+
+class CachedCertsRequest:
+    def __init__(self, transport=None, clock=monotonic):
+        if transport is None:
+            transport = requests.Request(session=Session())
+        self._transport = transport
+        self._clock = clock
+        # (expiry, response) by url
+        self._responses = {}
+        self._lock = Lock()
+
+    def __call__(self, url, method='GET', body=None, headers=None, **kwargs):
+        if method != 'GET' or body is not None:
+            return self._transport(url, method=method, body=body, headers=headers, **kwargs)
+
+        with self._lock:
+            cached = self._responses.get(url)
+        if cached is not None and cached[0] > self._clock():
+            return cached[1]
+
+        response = self._transport(url, method=method, headers=headers, **kwargs)
+        age = max_age(response)
+        if response.status == 200 and age:
+            with self._lock:
+                self._responses[url] = (self._clock() + age, response)
+        return response
+
+
+class CertTransportSingleton:
+    __transport = None
+
+    @classmethod
+    def init(cls, transport=None):
+        cls.__transport = CachedCertsRequest(transport)
+
+    @classmethod
+    def get_transport(cls):
+        if cls.__transport is None:
+            cls.init()
+        return cls.__transport
+
+
+def init_cert_transport(transport=None):
+    """Cache certificates fetched with `transport`, or with a pooled requests
+    session if it is None."""
+    CertTransportSingleton.init(transport)
+
+
+def get_cert_transport():
+    return CertTransportSingleton.get_transport()
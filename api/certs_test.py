@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from api.auth import validate_token
+from api.certs import CachedCertsRequest, init_cert_transport
+
+
+class FakeResponse:
+    def __init__(self, status=200, cache_control='public, max-age=100', data=b'{}'):
+        self.status = status
+        self.headers = {'Cache-Control': cache_control}
+        self.data = data
+
+
+class FakeTransport:
+    """Stands in for Google's certificate endpoint."""
+
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def __call__(self, url, method='GET', body=None, headers=None, **kwargs):
+        self.calls.append((url, method))
+        return self.response
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_caches_until_max_age(clock):
+    transport = FakeTransport(FakeResponse())
+    request = CachedCertsRequest(transport, clock)
+
+    assert request('https://certs').data == b'{}'
+    clock.now = 99
+    assert request('https://certs').data == b'{}'
+    assert len(transport.calls) == 1
+
+    clock.now = 100
+    request('https://certs')
+    assert len(transport.calls) == 2
+
+    request('https://other')
+    assert len(transport.calls) == 3
+
+
+@pytest.mark.parametrize('response', [
+    FakeResponse(status=500),
+    FakeResponse(cache_control='no-store, max-age=100'),
+    FakeResponse(cache_control=None),
+])
+def test_uncacheable_responses(clock, response):
+    transport = FakeTransport(response)
+    request = CachedCertsRequest(transport, clock)
+
+    request('https://certs')
+    request('https://certs')
+    assert len(transport.calls) == 2
+
+
+def test_only_caches_get(clock):
+    transport = FakeTransport(FakeResponse())
+    request = CachedCertsRequest(transport, clock)
+
+    request('https://certs', method='POST', body=b'{}')
+    request('https://certs', method='POST', body=b'{}')
+    assert transport.calls == [('https://certs', 'POST')] * 2
+
+
+def test_validate_token_reuses_certs():
+    transport = FakeTransport(FakeResponse(data=json.dumps({}).encode()))
+    init_cert_transport(transport)
+    try:
+        # the certificates are fetched before the token is decoded
+        assert validate_token('not.a.token') is None
+        assert validate_token('not.a.token') is None
+        assert len(transport.calls) == 1
+    finally:
+        init_cert_transport()
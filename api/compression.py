@@ -0,0 +1,82 @@
+"""Compression of API responses.
+
+`compress_response` is registered as an `after_request` hook. It gzips (or,
+if the brotli package is installed and the client accepts it, brotlis)
+JSON and CSV responses larger than COMPRESSION_MIN_SIZE bytes.
+
+Responses with an ETag are cacheable, so their compressed bodies are kept
+in `COMPRESSED_CACHE`, keyed on a digest of the uncompressed body. Repeat
+responses (e.g. served from `RESPONSE_CACHE`) are then not compressed again.
+"""
+import configparser
+import gzip
+import hashlib
+
+from flask import current_app, request
+
+from api.cache import COMPRESSED_CACHE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/csv'}
+
+
+def init_compression():
+    cfg = configparser.ConfigParser()
+    cfg.read('keys.conf')
+
+    current_app.config['COMPRESSION_ENABLED'] = cfg.getboolean('compression', 'enabled', fallback=True)
+    current_app.config['COMPRESSION_MIN_SIZE'] = cfg.getint('compression', 'min-size', fallback=1024)
+    current_app.config['COMPRESSION_GZIP_LEVEL'] = cfg.getint('compression', 'gzip-level', fallback=6)
+    current_app.config['COMPRESSION_BROTLI_QUALITY'] = cfg.getint('compression', 'brotli-quality', fallback=4)
+    current_app.config['COMPRESSION_BROTLI'] = cfg.getboolean('compression', 'brotli', fallback=True)
+
+
+def available_encodings():
+    """Encodings we can produce, in order of preference."""
+    if brotli is not None and current_app.config.get('COMPRESSION_BROTLI', True):
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=current_app.config.get('COMPRESSION_BROTLI_QUALITY', 4))
+    return gzip.compress(body, compresslevel=current_app.config.get('COMPRESSION_GZIP_LEVEL', 6))
+
+
+def compress_response(response):
+    if not current_app.config.get('COMPRESSION_ENABLED', True):
+        return response
+
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    # the representation depends on Accept-Encoding even if we don't compress
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    if len(body) < current_app.config.get('COMPRESSION_MIN_SIZE', 1024):
+        return response
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if 'ETag' in response.headers:
+        key = (encoding, hashlib.sha1(body).digest())
+        compressed = COMPRESSED_CACHE.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            COMPRESSED_CACHE.set(key, compressed)
+    else:
+        compressed = compress(body, encoding)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,48 @@
+import gzip
+
+import pytest
+
+from api.cache import COMPRESSED_CACHE
+from api.compression import compress_response
+
+
+@pytest.fixture
+def compressed_app(api_app):
+    api_app.after_request(compress_response)
+    return api_app
+
+
+def test_gzip_leads(sqlite_connection, compressed_app):
+    with compressed_app.test_client(True) as client:
+        plain = client.get('/leads')
+        assert 'Content-Encoding' not in plain.headers
+        assert 'Accept-Encoding' in plain.headers['Vary']
+
+        res = client.get('/leads', headers={'Accept-Encoding': 'gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert len(res.get_data()) < len(plain.get_data())
+        assert gzip.decompress(res.get_data()) == plain.get_data()
+
+
+def test_precompressed_cache(sqlite_connection, compressed_app):
+    """Cacheable responses are compressed once."""
+    with compressed_app.test_client(True) as client:
+        first = client.get('/lead/6933', headers={'Accept-Encoding': 'gzip'})
+        misses = COMPRESSED_CACHE.misses
+        second = client.get('/lead/6933', headers={'Accept-Encoding': 'gzip'})
+        assert COMPRESSED_CACHE.misses == misses
+        assert COMPRESSED_CACHE.hits >= 1
+        assert second.get_data() == first.get_data()
+
+
+def test_small_responses_not_compressed(sqlite_connection, compressed_app):
+    compressed_app.config['COMPRESSION_MIN_SIZE'] = 10 ** 6
+    with compressed_app.test_client(True) as client:
+        res = client.get('/leads', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in res.headers
+
+        # errors are never compressed
+        compressed_app.config['COMPRESSION_MIN_SIZE'] = 0
+        res = client.get('/lead/1', headers={'Accept-Encoding': 'gzip'})
+        assert res.status_code == 404
+        assert 'Content-Encoding' not in res.headers
@@ -3,9 +3,11 @@ import tempfile
 import shutil
 from flask import Flask
 from sqlalchemy import create_engine
-from api import alerts
-from api.api import main as main_bp
+from api import alerts, auth, flags
+from api.api import LEAD_VERSION_CHECK, main as main_bp
+from api.cache import MemoryBackend, init_cache, invalidate_lead_caches
 from api.models import confirmed_emails
+from api.search import InvertedIndexSearch, MySQLSearch, init_search
 
 
 @pytest.fixture
@@ -15,9 +17,28 @@ def sqlite_connection(mocker):
         engine = create_engine(f"sqlite:///{tmp.name}")
         mocker.patch('api.alerts.engine', lambda: engine)
         mocker.patch('api.api.engine', lambda: engine)
+        mocker.patch('api.auth.engine', lambda: engine)
+        mocker.patch('api.flags.engine', lambda: engine)
         yield engine
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    init_cache(MemoryBackend())
+    invalidate_lead_caches()
+    LEAD_VERSION_CHECK.reset()
+
+
+@pytest.fixture
+def search_index(sqlite_connection):
+    """Search with an index of the test database, since SQLite has no MATCH."""
+    with sqlite_connection.connect() as con:
+        index = InvertedIndexSearch.build(con)
+    init_search(index)
+    yield index
+    init_search(MySQLSearch())
+
+
 def base_app():
     app = Flask(__name__)
     app.config['TESTING'] = True
@@ -30,16 +51,25 @@ def alert_app():
     app = base_app()
     app.config['ALERT_TRIGGER_WHITELIST'] = '127.0.0.1'
     app.register_blueprint(alerts.alerts)
+    app.register_blueprint(auth.auth)
     return app
 
 
 @pytest.fixture
 def api_app():
     app = base_app()
+    app.config['ALERT_TRIGGER_WHITELIST'] = '127.0.0.1'
     app.register_blueprint(main_bp)
     return app
 
 
+@pytest.fixture
+def flags_app():
+    app = base_app()
+    app.register_blueprint(flags.flags)
+    return app
+
+
 @pytest.fixture
 def confirmed_email(sqlite_connection):
     with sqlite_connection.connect() as conn:
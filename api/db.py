@@ -1,5 +1,53 @@
 import configparser
+from threading import Lock
+from time import perf_counter
+
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A `QueuePool` that records how long callers wait to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def stats(self):
+        return {
+            'pool': type(self).__name__,
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'in_use': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'checkouts': self.checkouts,
+            'wait_total_ms': self.wait_total * 1000,
+            'wait_max_ms': self.wait_max * 1000,
+            'wait_mean_ms': self.wait_total * 1000 / self.checkouts if self.checkouts else 0,
+        }
+
+
+def pool_stats(pool):
+    """Summarize the state of a connection pool. Only pools created by
+    `PoolSingleton` report wait times."""
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'pool': type(pool).__name__}
 
 
 class PoolSingleton:
@@ -18,7 +66,15 @@ class PoolSingleton:
         aws_database = config.get("AWSDatabaseConfig", "database")
 
         cls.__engine = create_engine(
-            f'mysql+pymysql://{aws_username}:{aws_password}@{aws_host}/{aws_database}', echo=True)
+            f'mysql+pymysql://{aws_username}:{aws_password}@{aws_host}/{aws_database}',
+            poolclass=InstrumentedQueuePool,
+            pool_size=config.getint('pool', 'size', fallback=5),
+            max_overflow=config.getint('pool', 'max-overflow', fallback=10),
+            pool_timeout=config.getfloat('pool', 'timeout', fallback=30),
+            # MySQL closes connections after wait_timeout (8h by default)
+            pool_recycle=config.getint('pool', 'recycle', fallback=3600),
+            pool_pre_ping=config.getboolean('pool', 'pre-ping', fallback=True),
+            echo=config.getboolean('pool', 'echo', fallback=False))
 
     @classmethod
     def get_engine(cls):
@@ -0,0 +1,27 @@
+from sqlalchemy import create_engine
+
+from api.db import InstrumentedQueuePool, pool_stats
+
+
+def test_pool_records_checkouts():
+    engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool, pool_size=2, max_overflow=0)
+
+    with engine.connect():
+        stats = pool_stats(engine.pool)
+        assert stats['in_use'] == 1
+        with engine.connect():
+            assert pool_stats(engine.pool)['in_use'] == 2
+
+    stats = pool_stats(engine.pool)
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 2
+    assert stats['checkouts'] == 2
+    assert stats['wait_max_ms'] >= stats['wait_mean_ms'] >= 0
+
+
+def test_pool_stats_endpoint(sqlite_connection, api_app):
+    with api_app.test_client(True) as client:
+        res = client.get('/stats/pool')
+        assert res.status_code == 200
+        assert 'pool' in res.get_json()
+        assert client.get('/stats/pool', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 401
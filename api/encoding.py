@@ -0,0 +1,66 @@
+"""JSON encoding for API responses.
+
+`json_response` is a drop-in replacement for `flask.jsonify` that produces
+the same output (sorted keys, http dates) but can use orjson, which is
+several times faster on lead pages. orjson is optional: without it the
+standard library encoder is used.
+
+SQLAlchemy rows can be serialized directly, without copying them into
+dicts first.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import current_app
+from sqlalchemy.engine import Row
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """Serialize the types that the JSON encoders do not handle themselves."""
+    if isinstance(obj, Row):
+        return dict(obj._mapping)
+    if isinstance(obj, date):
+        # same format as flask.json.JSONEncoder
+        return http_date(obj.utctimetuple() if isinstance(obj, datetime) else obj.timetuple())
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps_json(obj):
+    return json.dumps(obj, default=default, sort_keys=True, separators=(',', ':')).encode()
+
+
+def dumps_orjson(obj):
+    return orjson.dumps(obj, default=default,
+                        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+ENCODERS = {'json': dumps_json}
+if orjson is not None:
+    ENCODERS['orjson'] = dumps_orjson
+
+DEFAULT_ENCODER = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(obj, encoder=None):
+    """Serialize `obj` to JSON bytes using `encoder` (one of `ENCODERS`).
+    Defaults to the JSON_ENCODER app setting, or the fastest one available."""
+    if encoder is None:
+        encoder = current_app.config.get('JSON_ENCODER', DEFAULT_ENCODER)
+    return ENCODERS[encoder](obj)
+
+
+def json_response(obj, status=200):
+    """Build a JSON response for `obj`, like `flask.jsonify`."""
+    return current_app.response_class(dumps(obj) + b'\n', status=status,
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
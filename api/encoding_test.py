@@ -0,0 +1,40 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import flask
+import pytest
+from sqlalchemy import create_engine
+
+from api.encoding import ENCODERS, dumps, json_response
+
+
+def sample(con):
+    row = con.execute('select 1 as id, \'Lead\' as name').fetchone()
+    return {
+        'published_dt': datetime(2020, 6, 1, 12, 30),
+        'day': date(2020, 6, 1),
+        'score': Decimal('2.5'),
+        'lead': row,
+        'nested': {'b': [1, 2.5, None, True], 'a': 'ü'},
+    }
+
+
+@pytest.mark.parametrize('encoder', sorted(ENCODERS))
+def test_matches_jsonify(encoder):
+    """Each encoder gives the same JSON as flask.jsonify (apart from types jsonify can't handle)."""
+    app = flask.Flask(__name__)
+    with app.app_context(), create_engine('sqlite://').connect() as con:
+        obj = sample(con)
+        expected = flask.json.loads(flask.jsonify({**obj, 'score': 2.5, 'lead': dict(obj['lead'])}).get_data())
+        assert flask.json.loads(dumps(obj, encoder)) == expected
+        assert expected['published_dt'] == 'Mon, 01 Jun 2020 12:30:00 GMT'
+
+
+def test_json_response():
+    app = flask.Flask(__name__)
+    app.config['JSON_ENCODER'] = 'json'
+    with app.app_context():
+        res = json_response({'b': 1, 'a': 2}, status=201)
+        assert res.status_code == 201
+        assert res.mimetype == 'application/json'
+        assert res.get_data() == b'{"a":2,"b":1}\n'
@@ -0,0 +1,94 @@
+"""A feed of newly published leads.
+
+Leads are only ever added by the ingestion pipeline. A mark `(last_id,
+last_published_dt)` records how far a consumer has read `annotated_leads`:
+rows with a greater id, or published after the mark, are new to it. This
+lets derived data (scores, search indices, caches) be updated for just the
+new leads instead of rescanning everything.
+
+Marks of long-running consumers are persisted in `change_feed_marks`, e.g.
+by `process_changes`, which scripts/process-changes.py runs after leads are
+loaded. Marks held in memory (e.g. by `InvertedIndexSearch`) are plain
+tuples.
+"""
+from datetime import datetime
+
+from sqlalchemy.sql import func, or_, select
+
+from api.cache import invalidate_lead_caches
+from api.models import annotated_leads, change_feed_marks
+from api.scores import refresh_lead_scores, refresh_stale_lead_scores
+
+
+def latest_mark(con):
+    """The mark of the newest published lead, so that only leads published later are read."""
+    query = select([func.max(annotated_leads.c.id), func.max(annotated_leads.c.published_dt)])\
+        .where(annotated_leads.c.is_published == True)  # noqa: E712
+    return tuple(con.execute(query).fetchone())
+
+
+def read_changes(con, mark=None):
+    """Find the leads published after `mark` (or all published leads if it is
+    None). Returns the lead ids, in order, and the mark to read from next."""
+    query = select([annotated_leads.c.id, annotated_leads.c.lead_id, annotated_leads.c.published_dt])\
+        .where(annotated_leads.c.is_published == True)  # noqa: E712
+
+    (last_id, last_published_dt) = mark if mark is not None else (None, None)
+    if last_id is not None:
+        after = annotated_leads.c.id > last_id
+        if last_published_dt is not None:
+            # older rows may be published after newer ones
+            after = or_(after, annotated_leads.c.published_dt > last_published_dt)
+        query = query.where(after)
+
+    lead_ids = []
+    for row in con.execute(query.order_by(annotated_leads.c.id)):
+        lead_ids.append(row['lead_id'])
+        last_id = max(last_id or 0, row['id'])
+        if row['published_dt'] is not None and (last_published_dt is None or row['published_dt'] > last_published_dt):
+            last_published_dt = row['published_dt']
+
+    return (lead_ids, (last_id, last_published_dt))
+
+
+def load_mark(con, consumer):
+    row = con.execute(select([change_feed_marks])
+                      .where(change_feed_marks.c.consumer == consumer)).fetchone()
+    return None if row is None else (row['last_id'], row['last_published_dt'])
+
+
+def save_mark(con, consumer, mark):
+    (last_id, last_published_dt) = mark
+    values = {'last_id': last_id, 'last_published_dt': last_published_dt, 'updated_dt': datetime.utcnow()}
+
+    res = con.execute(change_feed_marks.update()  # pylint: disable=no-value-for-parameter
+                      .where(change_feed_marks.c.consumer == consumer).values(**values))
+    if res.rowcount == 0:
+        con.execute(change_feed_marks.insert().values(  # pylint: disable=no-value-for-parameter
+            consumer=consumer, **values))
+
+
+def process_changes(con, consumer='pipeline'):
+    """Refresh the scores of the leads published since `consumer` last ran
+    (and of any other leads whose ratings changed), and drop the lead caches.
+    Returns a summary of what was processed.
+
+    Search indices live in the API processes and the alert worker, which add
+    new leads to them on their own (see `SearchBackend.catch_up`). The API
+    processes also drop their caches when they notice new leads or ratings
+    (see `LEAD_VERSION_CHECK`), but only every `version-check-interval`
+    seconds, and the worker refreshes stale scores as well."""
+    mark = load_mark(con, consumer)
+    (lead_ids, new_mark) = read_changes(con, mark)
+
+    if len(lead_ids) > 0:
+        refresh_lead_scores(con, lead_ids)
+    refresh_stale_lead_scores(con)
+    invalidate_lead_caches()
+
+    save_mark(con, consumer, new_mark)
+    return {
+        'leads': lead_ids,
+        'since': mark,
+        'mark': new_mark,
+    }
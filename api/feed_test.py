@@ -0,0 +1,57 @@
+from datetime import datetime
+
+from sqlalchemy.sql import select
+
+from api.feed import latest_mark, load_mark, process_changes, read_changes
+from api.models import annotated_leads, crowd_ratings, lead_scores, leads
+
+
+def publish(con, name, published_dt):
+    """Add a copy of an existing lead with a new annotation. Returns the new lead id."""
+    lead = dict(con.execute(select([leads]).limit(1)).fetchone())
+    del lead['id']
+    lead_id = con.execute(leads.insert().values(**lead)).inserted_primary_key[0]
+    con.execute(annotated_leads.insert().values(
+        lead_id=lead_id, name=name, description='', topic='', is_published=1, published_dt=published_dt))
+    return lead_id
+
+
+def test_read_changes(sqlite_connection):
+    with sqlite_connection.begin() as con:
+        (everything, mark) = read_changes(con)
+        assert len(everything) > 0
+        assert mark == latest_mark(con)
+        assert read_changes(con, mark) == ([], mark)
+
+        new_id = publish(con, 'Zygomorphic lead', datetime(2020, 1, 1))
+        (lead_ids, new_mark) = read_changes(con, mark)
+        assert lead_ids == [new_id]
+        assert new_mark[1] == datetime(2020, 1, 1)
+        assert read_changes(con, new_mark)[0] == []
+
+
+def test_process_changes(sqlite_connection):
+    with sqlite_connection.begin() as con:
+        first = process_changes(con)
+        assert first['since'] is None
+        assert load_mark(con, 'pipeline') == first['mark']
+        assert process_changes(con)['leads'] == []
+
+        new_id = publish(con, 'Zygomorphic lead', datetime(2020, 1, 1))
+        assert process_changes(con)['leads'] == [new_id]
+        # no ratings yet, so no score
+        assert con.execute(select([lead_scores]).where(lead_scores.c.lead_id == new_id)).fetchone() is None
+
+        # ratings loaded after the lead was published are scored too
+        con.execute(crowd_ratings.insert().values(lead_id=new_id, news_value=3.0))
+        assert process_changes(con)['leads'] == []
+        assert con.execute(select([lead_scores]).where(lead_scores.c.lead_id == new_id)).fetchone() is not None
+
+
+def test_index_catch_up(sqlite_connection, search_index):
+    with sqlite_connection.begin() as con:
+        new_id = publish(con, 'Zygomorphic lead', datetime(2020, 1, 1))
+        assert search_index.search('zygomorphic') == {}
+        assert search_index.catch_up(con) == [new_id]
+        assert set(search_index.search('zygomorphic')) == {new_id}
+        assert search_index.catch_up(con) == []
@@ -1,16 +1,75 @@
+from array import array
+from bisect import bisect_left
+
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import and_, select, text
+from sqlalchemy.sql import and_, func, select
 
 from api.auth import login_required
+from api.cache import FLAG_CACHE
 from api.db import engine
 from api.models import flags as flags_
-from api.models import leads
+from api.models import leads, users
 from api.errors import abort_json
 
 flags = Blueprint('flags', __name__, url_prefix='/flag')
 
 
+def flags_version(con, uid):
+    """A fingerprint of the leads flagged by `uid`. Any change to their flags changes it.
+
+    The API increments `users.flags_version` whenever it changes flags (see
+    `bump_flags_version`), which catches changes that reuse flag ids. The
+    count and greatest id of the flags catch flags added or removed
+    directly in the database."""
+    counter = select([users.c.flags_version]).where(users.c.id == uid).scalar_subquery()
+    query = select([func.count(flags_.c.id), func.max(flags_.c.id), counter]).where(flags_.c.user_id == uid)
+    return tuple(con.execute(query).fetchone())
+
+
+def bump_flags_version(con, uid):
+    con.execute(users.update().values(  # pylint: disable=no-value-for-parameter
+        flags_version=users.c.flags_version + 1).where(users.c.id == uid))
+
+
+def load_flag_set(con, uid, version=None):
+    """Load the flag set of `uid` (see `user_flag_set`) and cache it."""
+    if version is None:
+        version = flags_version(con, uid)
+    query = select([flags_.c.lead_id]).where(flags_.c.user_id == uid).order_by(flags_.c.lead_id)
+    flag_set = array('l', (row['lead_id'] for row in con.execute(query)))
+    FLAG_CACHE.set(uid, (version, flag_set))
+    return flag_set
+
+
+def user_flag_set(con, uid, version=None):
+    """The ids of the leads flagged by `uid`, as a sorted array.
+
+    Flag sets are cached in `FLAG_CACHE`, and reused for as long as the
+    user's `flags_version` (a cheap, indexed query) is unchanged. This also
+    catches flags changed through other processes. Pass `version` if it was
+    already looked up in this request (see `api.api.conditional`)."""
+    if version is None:
+        version = flags_version(con, uid)
+
+    cached = FLAG_CACHE.get(uid)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    return load_flag_set(con, uid, version)
+
+
+def is_flagged(flag_set, lead_id):
+    i = bisect_left(flag_set, lead_id)
+    return i < len(flag_set) and flag_set[i] == lead_id
+
+
+def annotate_flags(flag_set, results):
+    """Set `flagged` on each lead in `results` (a list of dicts)."""
+    for lead in results:
+        lead['flagged'] = is_flagged(flag_set, lead['id'])
+
+
 @flags.route('/list', methods=('POST',))
 @login_required
 def list_flags(uid):
@@ -27,18 +86,8 @@ def list_flags(uid):
         return {'flags': []}
 
     with engine().begin() as con:
-        uflags = select([flags_.c.id, flags_.c.lead_id])\
-            .where(flags_.c.user_id == uid).alias('uflags')
-
-        query = select([leads.c.id, text('not isnull(uflags.id) as flagged')])\
-            .select_from(leads.outerjoin(uflags))\
-            .where(leads.c.id.in_(ids))
-
-        res = con.execute(query)
-
-        result = {row['id']: row['flagged'] for row in res}
-
-        return {'flags': [result[id] if id in result else False for id in ids]}
+        flag_set = user_flag_set(con, uid)
+        return {'flags': [isinstance(id, int) and is_flagged(flag_set, id) for id in ids]}
 
 
 @flags.route('/<lead_id>', methods=('PUT',))
@@ -50,6 +99,8 @@ def put_flag(uid, lead_id):
 
         try:
             res = con.execute(query)
+            bump_flags_version(con, uid)
+            load_flag_set(con, uid)
             return {'status': 'ok', 'rows': res.rowcount}
         except IntegrityError:
             # invalid lead_id
@@ -63,4 +114,73 @@ def delete_flag(uid, lead_id):
         query = flags_.delete().where(  # pylint: disable=no-value-for-parameter
             and_(flags_.c.lead_id == lead_id, flags_.c.user_id == uid))
         res = con.execute(query)
+        bump_flags_version(con, uid)
+        load_flag_set(con, uid)
         return {'status': 'ok', 'rows': res.rowcount}
+
+
+def parse_id_list(value):
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(id_, int) for id_ in value):
+        raise ValueError()
+    return value
+
+
+@flags.route('/bulk', methods=('POST',))
+@login_required
+def bulk_flags(uid):
+    """Receives `{"add": [ids], "remove": [ids]}` as JSON in the message body
+    and flags / unflags the given leads in one transaction. Returns the outcome
+    for each id, in the same order:
+
+    - add: "flagged", "unchanged" (already flagged) or "not_found" (no such lead)
+    - remove: "unflagged" or "unchanged" (was not flagged)
+    """
+    try:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            raise ValueError()
+        add = parse_id_list(body.get('add'))
+        remove = parse_id_list(body.get('remove'))
+    except ValueError:
+        return abort_json(400)
+
+    if set(add) & set(remove):
+        return abort_json(400, 'A lead cannot be both added and removed.')
+
+    with engine().begin() as con:
+        flagged = set()
+        if len(add) + len(remove) > 0:
+            query = select([flags_.c.lead_id]).where(
+                and_(flags_.c.user_id == uid, flags_.c.lead_id.in_(set(add + remove))))
+            flagged = {row['lead_id'] for row in con.execute(query)}
+
+        added = {}
+        if len(add) > 0:
+            query = select([leads.c.id]).where(leads.c.id.in_(set(add)))
+            existing = {row['id'] for row in con.execute(query)}
+            added = {id_: 'not_found' if id_ not in existing else 'unchanged' if id_ in flagged else 'flagged'
+                     for id_ in add}
+
+            new = sorted(id_ for id_, outcome in added.items() if outcome == 'flagged')
+            if len(new) > 0:
+                # ignore flags added concurrently since we looked
+                ignore = 'OR IGNORE' if con.dialect.name == 'sqlite' else 'IGNORE'
+                con.execute(flags_.insert().prefix_with(ignore).values(  # pylint: disable=no-value-for-parameter
+                    [{'lead_id': id_, 'user_id': uid} for id_ in new]))
+
+        removed = {id_: 'unflagged' if id_ in flagged else 'unchanged' for id_ in remove}
+        old = sorted(id_ for id_, outcome in removed.items() if outcome == 'unflagged')
+        if len(old) > 0:
+            con.execute(flags_.delete().where(  # pylint: disable=no-value-for-parameter
+                and_(flags_.c.user_id == uid, flags_.c.lead_id.in_(old))))
+
+        bump_flags_version(con, uid)
+        load_flag_set(con, uid)
+
+    return {
+        'status': 'ok',
+        'add': [added[id_] for id_ in add],
+        'remove': [removed[id_] for id_ in remove],
+    }
@@ -0,0 +1,75 @@
+from sqlalchemy.sql import select
+
+from api.cache import FLAG_CACHE
+from api.flags import bump_flags_version
+from api.models import flags
+
+
+def flagged_leads(con):
+    return sorted(row['lead_id'] for row in con.execute(select([flags.c.lead_id]).where(flags.c.user_id == 1)))
+
+
+def test_bulk_flags(sqlite_connection, flags_app):
+    with flags_app.test_client(True) as client:
+        assert client.post('/flag/bulk', json={'add': [6933]}).status_code == 401
+
+        with client.session_transaction() as sess:
+            sess['id'] = 1
+
+        res = client.post('/flag/bulk', json={'add': [6933, 1420, 1]})
+        assert res.status_code == 200
+        assert res.get_json()['add'] == ['flagged', 'flagged', 'not_found']
+        assert flagged_leads(sqlite_connection) == [1420, 6933]
+
+        res = client.post('/flag/bulk', json={'add': [6933, 6914], 'remove': [1420, 9697]})
+        assert res.get_json()['add'] == ['unchanged', 'flagged']
+        assert res.get_json()['remove'] == ['unflagged', 'unchanged']
+        assert flagged_leads(sqlite_connection) == [6914, 6933]
+
+        assert client.post('/flag/bulk', json={'add': [1420], 'remove': [1420]}).status_code == 400
+        assert client.post('/flag/bulk', json={'add': ['x']}).status_code == 400
+        assert client.post('/flag/bulk', json=[1420]).status_code == 400
+        assert flagged_leads(sqlite_connection) == [6914, 6933]
+
+
+def test_flag_set_cache(sqlite_connection, flags_app):
+    with flags_app.test_client(True) as client:
+        with client.session_transaction() as sess:
+            sess['id'] = 1
+
+        assert client.post('/flag/list', json=[6933, 1420, 'x']).get_json()['flags'] == [False, False, False]
+        assert client.put('/flag/6933').status_code == 200
+        assert client.post('/flag/list', json=[6933, 1420]).get_json()['flags'] == [True, False]
+
+        # updated by the write, so reading doesn't reload it
+        misses = FLAG_CACHE.misses
+        assert client.post('/flag/list', json=[6933]).get_json()['flags'] == [True]
+        assert FLAG_CACHE.misses == misses
+
+        assert client.delete('/flag/6933').status_code == 200
+        assert client.post('/flag/list', json=[6933]).get_json()['flags'] == [False]
+
+        # changes made elsewhere are noticed
+        with sqlite_connection.connect() as conn:
+            conn.execute(flags.insert().values(lead_id=1420, user_id=1))
+        assert client.post('/flag/list', json=[6933, 1420]).get_json()['flags'] == [False, True]
+
+
+def test_flag_set_reused_ids(sqlite_connection, flags_app):
+    """Test that cached flag sets notice flags replaced by another process, even if the flag id is reused."""
+    with flags_app.test_client(True) as client:
+        with client.session_transaction() as sess:
+            sess['id'] = 1
+
+        assert client.put('/flag/6933').status_code == 200
+        assert client.post('/flag/list', json=[6933, 1420]).get_json()['flags'] == [True, False]
+
+        # as delete_flag and put_flag would in another process
+        with sqlite_connection.begin() as conn:
+            flag_id = conn.execute(select([flags.c.id]).where(flags.c.lead_id == 6933)).scalar()
+            conn.execute(flags.delete().where(flags.c.id == flag_id))
+            bump_flags_version(conn, 1)
+            conn.execute(flags.insert().values(id=flag_id, lead_id=1420, user_id=1))
+            bump_flags_version(conn, 1)
+
+        assert client.post('/flag/list', json=[6933, 1420]).get_json()['flags'] == [False, True]
@@ -1,10 +1,19 @@
+import os
+import smtplib
 from configparser import ConfigParser
 from datetime import datetime, timedelta
+from email.message import EmailMessage
+from functools import lru_cache
+from threading import Lock
+from time import perf_counter, sleep
 from urllib.parse import quote as urlencode
+from uuid import uuid4
 
 import boto3
+from botocore.exceptions import ClientError
 from flask import current_app, render_template
 from itsdangerous import URLSafeTimedSerializer, URLSafeSerializer
+from markupsafe import escape
 from sqlalchemy.sql import and_, select
 
 from api.errors import ConfirmationPendingError
@@ -12,25 +21,255 @@ from api.models import pending_confirmations, confirmed_emails
 
 CHARSET = 'UTF-8'
 BASE_URL = 'https://db.algorithmtips.org'
+CONFIRMATION_SUBJECT = 'Algorithm Tips: Confirm Your Email'
+ALERT_SUBJECT = 'Algorithm Tips: New Leads Match Your Alert'
+
+
+class Transport:
+    """Base class for mail transports. Subclasses implement `deliver`, which
+    sends a single message and raises an exception on failure.
+
+    Transports are shared between threads and keep throughput counters."""
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.throttle_retries = 0
+        self.send_time = 0.0
+
+    def deliver(self, recipient, subject, html, text):
+        raise NotImplementedError()
+
+    def send(self, recipient, subject, html, text):
+        start = perf_counter()
+        try:
+            self.deliver(recipient, subject, html, text)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.send_time += perf_counter() - start
+
+        with self._lock:
+            self.sent += 1
+
+    def send_batch(self, messages, wait=None, on_sent=None):
+        """Send a list of `(recipient, subject, html, text)` tuples. Returns a
+        list with True for each message that was sent and False for each
+        that failed.
+
+        If given, `wait()` is called before each message (e.g. to limit the
+        sending rate) and `on_sent(i)` as soon as message `i` was sent. Errors
+        raised by either are not caught."""
+        results = []
+        for (i, message) in enumerate(messages):
+            if wait is not None:
+                wait()
+            try:
+                self.send(*message)
+            except Exception as e:
+                print(e)
+                results.append(False)
+                continue
+
+            if on_sent is not None:
+                on_sent(i)
+            results.append(True)
+        return results
+
+    def stats(self):
+        return {
+            'transport': type(self).__name__,
+            'sent': self.sent,
+            'failed': self.failed,
+            'throttle_retries': self.throttle_retries,
+            # per sending thread. concurrent senders multiply this
+            'emails_per_second': self.sent / self.send_time if self.send_time else 0,
+        }
+
+
+def build_message(sender, recipient, subject, html, text):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = recipient
+    message.set_content(text, charset=CHARSET)
+    message.add_alternative(html, subtype='html', charset=CHARSET)
+    return message
+
+
+class SESTransport(Transport):
+    """Sends mail through Amazon SES. Requests rejected because the sending
+    rate was exceeded are retried with exponential backoff."""
+
+    def __init__(self, client, sender, max_retries=5, backoff=0.5):
+        super().__init__(sender)
+        self.client = client
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    @staticmethod
+    def is_throttled(error):
+        # SES reports an exceeded daily quota with the same code, but
+        # retrying does not help with that
+        details = error.response.get('Error', {})
+        return details.get('Code', None) in ['Throttling', 'ThrottlingException'] and \
+            'quota' not in details.get('Message', '').lower()
+
+    def deliver(self, recipient, subject, html, text):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.client.send_email(
+                    Destination={
+                        'ToAddresses': [recipient]
+                    },
+                    Message={
+                        'Subject': {
+                            'Charset': CHARSET,
+                            'Data': subject
+                        },
+                        'Body': {
+                            'Text': {
+                                'Charset': CHARSET,
+                                'Data': text,
+                            },
+                            'Html': {
+                                'Charset': CHARSET,
+                                'Data': html,
+                            }
+                        }
+                    },
+                    Source=self.sender
+                )
+                return
+            except ClientError as e:
+                if attempt == self.max_retries or not self.is_throttled(e):
+                    raise
+
+                with self._lock:
+                    self.throttle_retries += 1
+                sleep(self.backoff * 2 ** attempt)
+
+
+class SpoolTransport(Transport):
+    """Writes each message to a .eml file in `directory` instead of sending it.
+    Intended for development and offline benchmarks."""
+
+    def __init__(self, directory, sender):
+        super().__init__(sender)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def deliver(self, recipient, subject, html, text):
+        message = build_message(self.sender, recipient, subject, html, text)
+        path = os.path.join(self.directory, f'{uuid4().hex}.eml')
+        with open(path, 'wb') as f:
+            f.write(message.as_bytes())
+
+
+class SMTPTransport(Transport):
+    """Sends mail to an SMTP server, such as a local sink for testing (e.g.
+    `python -m aiosmtpd -n -l localhost:1025`)."""
+
+    def __init__(self, host, port, sender):
+        super().__init__(sender)
+        self.host = host
+        self.port = port
+
+    def deliver(self, recipient, subject, html, text, smtp=None):
+        message = build_message(self.sender, recipient, subject, html, text)
+        if smtp is not None:
+            smtp.send_message(message)
+            return
+
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            smtp.send_message(message)
+
+    # errors the server reports for a single message. the connection can
+    # still be used for the next one
+    MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException)
+
+    @staticmethod
+    def close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def send_batch(self, messages, wait=None, on_sent=None):
+        """Like `Transport.send_batch`, but sends every message over one
+        connection. If the connection fails, the next message reconnects."""
+        results = []
+        smtp = None
+        try:
+            for (i, (recipient, subject, html, text)) in enumerate(messages):
+                if wait is not None:
+                    wait()
+                start = perf_counter()
+                try:
+                    if smtp is None:
+                        smtp = smtplib.SMTP(self.host, self.port)
+                    self.deliver(recipient, subject, html, text, smtp=smtp)
+                except Exception as e:
+                    print(e)
+                    ok = False
+                    if smtp is not None and not isinstance(e, self.MESSAGE_ERRORS):
+                        self.close(smtp)
+                        smtp = None
+                else:
+                    ok = True
+                finally:
+                    with self._lock:
+                        self.send_time += perf_counter() - start
+
+                with self._lock:
+                    if ok:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+
+                if ok and on_sent is not None:
+                    on_sent(i)
+                results.append(ok)
+        finally:
+            if smtp is not None:
+                self.close(smtp)
+        return results
 
 
 class MailSingleton:
     __mail = None
-    __sender = None
 
     @classmethod
-    def init(cls):
-        config = ConfigParser()
-        config.read('keys.conf')
-
-        region = config.get('mail', 'ses-region')
-        aws_access_key_id = config.get('mail', 'ses-access-key-id')
-        aws_secret_access_key = config.get('mail', 'ses-secret-access-key')
-
-        cls.__mail = boto3.client('ses', region_name=region,
-                                  aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
-
-        cls.__sender = config.get('mail', 'sender-address')
+    def init(cls, transport=None):
+        if transport is None:
+            config = ConfigParser()
+            config.read('keys.conf')
+
+            sender = config.get('mail', 'sender-address')
+            kind = config.get('mail', 'transport', fallback='ses')
+            if kind == 'ses':
+                region = config.get('mail', 'ses-region')
+                aws_access_key_id = config.get('mail', 'ses-access-key-id')
+                aws_secret_access_key = config.get('mail', 'ses-secret-access-key')
+
+                client = boto3.client('ses', region_name=region,
+                                      aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+                transport = SESTransport(client, sender,
+                                         max_retries=config.getint('mail', 'max-retries', fallback=5))
+            elif kind == 'spool':
+                transport = SpoolTransport(config.get('mail', 'spool-dir', fallback='mail-spool'), sender)
+            elif kind == 'smtp':
+                transport = SMTPTransport(config.get('mail', 'smtp-host', fallback='localhost'),
+                                          config.getint('mail', 'smtp-port', fallback=1025), sender)
+            else:
+                raise ValueError(f'Unknown mail transport: {kind}')
+
+        cls.__mail = transport
 
     @classmethod
     def get_mailer(cls):
@@ -38,13 +277,14 @@ class MailSingleton:
         return cls.__mail
 
     @classmethod
-    def get_sender(cls):
-        assert cls.__sender is not None
-        return cls.__sender
+    def get_stats(cls):
+        if cls.__mail is None:
+            return {}
+        return cls.__mail.stats()
 
 
-def init_mail():
-    MailSingleton.init()
+def init_mail(transport=None):
+    MailSingleton.init(transport)
 
 
 def render_confirmation_email(confirmation_id):
@@ -91,28 +331,7 @@ def send_confirmation(uid, email, con, min_delay=timedelta(days=1)):
     # send a confirmation mail
     try:
         mail = MailSingleton.get_mailer()
-        mail.send_email(
-            Destination={
-                'ToAddresses': [email]
-            },
-            Message={
-                'Subject': {
-                    'Charset': CHARSET,
-                    'Data': 'Algorithm Tips: Confirm Your Email'
-                },
-                'Body': {
-                    'Text': {
-                        'Charset': CHARSET,
-                        'Data': text_body
-                    },
-                    'Html': {
-                        'Charset': CHARSET,
-                        'Data': html_body,
-                    }
-                }
-            },
-            Source=MailSingleton.get_sender()
-        )
+        mail.send(email, CONFIRMATION_SUBJECT, html_body, text_body)
     except Exception as e:
         print(e)
         return False
@@ -176,52 +395,85 @@ def read_private_alert_token(token):
     return signer.loads(token, salt='private_alert_token')
 
 
-def render_alert(alert, leads):
-    private_token = get_private_alert_token(alert['user_id'], alert['send_id'])
+ALERT_TEMPLATES = ('alert.html', 'alert.txt')
+
+# stand-ins for the per-recipient links in cached alert renders
+PRIVATE_LINK_PLACEHOLDERS = {
+    'delete': '%%DELETE_LINK%%',
+    'unsubscribe': '%%UNSUBSCRIBE_LINK%%',
+}
+
+
+def init_templates(app=None):
+    """Load and compile the alert templates once, rather than looking them up
+    (and checking them for changes) for every alert."""
+    app = app or current_app
+    app.extensions['alert_templates'] = tuple(
+        app.jinja_env.get_template(name) for name in ALERT_TEMPLATES)
+
+
+def get_alert_templates():
+    if 'alert_templates' not in current_app.extensions:
+        init_templates()
+    return current_app.extensions['alert_templates']
+
+
+@lru_cache(maxsize=1024)
+def render_alert_shell(templates, filter_text, source_text, leads, alert_link):
+    """Render the alert templates with placeholders in place of the private
+    links. Many alerts share everything else, so the results are cached.
+
+    `leads` must be hashable: a tuple of `(key, value)` tuples for each lead."""
     kwargs = {
-        'filter_text': alert['filter'],
-        'source_text': format_source(alert),
-        'leads': leads,
+        'filter_text': filter_text,
+        'source_text': source_text,
+        'leads': [dict(lead) for lead in leads],
         'links': {
-            'alert': build_db_url(alert),
-            'delete': f"{BASE_URL}/delete-alert?token={private_token}",
-            'unsubscribe': f"{BASE_URL}/unsubscribe?token={private_token}",
+            'alert': alert_link,
+            **PRIVATE_LINK_PLACEHOLDERS
         }
     }
-    html = render_template('alert.html', **kwargs)
-    text = render_template('alert.txt', **kwargs)
+    return tuple(template.render(**kwargs) for template in templates)
+
 
+def render_alert(alert, leads):
+    private_token = get_private_alert_token(alert['user_id'], alert['send_id'])
+    links = {
+        'delete': f"{BASE_URL}/delete-alert?token={private_token}",
+        'unsubscribe': f"{BASE_URL}/unsubscribe?token={private_token}",
+    }
+
+    shells = render_alert_shell(
+        get_alert_templates(),
+        alert['filter'],
+        format_source(alert),
+        tuple(tuple(sorted(lead.items())) for lead in leads),
+        build_db_url(alert))
+
+    rendered = []
+    for name, shell in zip(ALERT_TEMPLATES, shells):
+        for key, placeholder in PRIVATE_LINK_PLACEHOLDERS.items():
+            # match the autoescaping that the template would have applied
+            link = str(escape(links[key])) if name.endswith('.html') else links[key]
+            shell = shell.replace(placeholder, link)
+        rendered.append(shell)
+
+    (html, text) = rendered
     return (html, text)
 
 
-def send_alert(alert, html_content, text_content):
-    try:
-        mail = MailSingleton.get_mailer()
-        mail.send_email(
-            Destination={
-                'ToAddresses': [alert['recipient']]
-            },
-            Message={
-                'Subject': {
-                    'Charset': CHARSET,
-                    'Data': 'Algorithm Tips: New Leads Match Your Alert'
-                },
-                'Body': {
-                    'Text': {
-                        'Charset': CHARSET,
-                        'Data': text_content,
-                    },
-                    'Html': {
-                        'Charset': CHARSET,
-                        'Data': html_content,
-                    }
-                }
-            },
-            Source=MailSingleton.get_sender()
-        )
-    except Exception as e:
-        print(e)
-        return False
-    else:
+def send_alerts(items, wait=None, on_sent=None):
+    """Send a list of `(alert, html, text)` tuples as one batch (see
+    `Transport.send_batch`). `on_sent(alert)` is called as soon as an alert's
+    mail went out. Returns a list with True for each alert that was sent and
+    False for each that failed."""
+    items = list(items)
+    messages = [(alert['recipient'], ALERT_SUBJECT, html, text) for (alert, html, text) in items]
+
+    def sent(i):
+        alert = items[i][0]
         print('sent alert email to ' + alert['recipient'])
-        return True
+        if on_sent is not None:
+            on_sent(alert)
+
+    return MailSingleton.get_mailer().send_batch(messages, wait=wait, on_sent=sent)
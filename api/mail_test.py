@@ -1,4 +1,13 @@
-from api.mail import send_confirmation, MailSingleton, render_alert, render_confirmation_email
+import smtplib
+from email import policy
+from email.parser import BytesParser
+
+from botocore.exceptions import ClientError
+
+from api.mail import (MailSingleton, SESTransport, SMTPTransport, SpoolTransport, Transport,
+                      get_private_alert_token, render_alert,
+                      render_alert_shell, render_confirmation_email,
+                      send_alerts, send_confirmation)
 from api.models import pending_confirmations
 from sqlalchemy.sql import select
 import pytest
@@ -40,9 +49,156 @@ def test_alert_render(alert_app, snapshot):
     snapshot.assert_match(render_text)
 
 
+def test_alert_render_shares_shell(alert_app):
+    """Test that alerts differing only in recipient reuse one render, with their own private links."""
+    ALERT = {'send_id': 1, 'user_id': 1, 'federal_source': None, 'regional_source': None, 'local_source': None,
+             'frequency': 0, 'recipient': 'test@test.net', 'filter': 'a & b', 'alert_id': 1}
+    LEADS = [{'name': "FEMA's Climate Impact Model", 'link': 'http://db.algorithmtips.org/lead/6933'}]
+    render_alert_shell.cache_clear()
+    with alert_app.app_context():
+        (first_html, first_text) = render_alert(ALERT, LEADS)
+        (second_html, second_text) = render_alert({**ALERT, 'send_id': 2}, LEADS)
+        tokens = [get_private_alert_token(1, 1), get_private_alert_token(1, 2)]
+
+    assert render_alert_shell.cache_info().misses == 1
+    assert render_alert_shell.cache_info().hits == 1
+    assert '%%' not in first_html + first_text
+    assert tokens[0] in first_html and tokens[0] in first_text
+    assert tokens[1] in second_html and tokens[1] in second_text
+    assert first_html.replace(tokens[0], tokens[1]) == second_html
+
+
 @freeze_time('2020-06-04')
 def test_render_confirmation(alert_app, snapshot):
     with alert_app.app_context():
         (render_html, render_text) = render_confirmation_email(1001)
     snapshot.assert_match(render_html)
     snapshot.assert_match(render_text)
+
+
+class FakeSES:
+    """Stands in for the boto3 SES client, failing the first `failures` requests with `code`."""
+
+    def __init__(self, failures, code='Throttling', message='Maximum sending rate exceeded.'):
+        self.failures = failures
+        self.error = {'Error': {'Code': code, 'Message': message}}
+        self.calls = []
+
+    def send_email(self, **kwargs):
+        self.calls.append(kwargs)
+        if len(self.calls) <= self.failures:
+            raise ClientError(self.error, 'SendEmail')
+
+
+def test_ses_retries_when_throttled():
+    client = FakeSES(failures=2)
+    transport = SESTransport(client, 'sender@test.net', backoff=0)
+
+    transport.send('test@test.net', 'subject', '<p>html</p>', 'text')
+
+    assert len(client.calls) == 3
+    assert client.calls[-1]['Destination'] == {'ToAddresses': ['test@test.net']}
+    stats = transport.stats()
+    assert stats['sent'] == 1 and stats['failed'] == 0
+    assert stats['throttle_retries'] == 2
+
+
+def test_ses_does_not_retry_quota():
+    client = FakeSES(failures=1, message='Daily message quota exceeded.')
+    transport = SESTransport(client, 'sender@test.net', backoff=0)
+
+    with pytest.raises(ClientError):
+        transport.send('test@test.net', 'subject', '<p>html</p>', 'text')
+
+    assert len(client.calls) == 1
+    assert transport.stats()['failed'] == 1
+
+
+def test_send_alert_spool_transport(tmp_path, mocker):
+    transport = SpoolTransport(str(tmp_path), 'sender@test.net')
+    mocker.patch.object(MailSingleton, 'get_mailer', return_value=transport)
+
+    alert = {'recipient': 'test@test.net'}
+    sent = []
+    assert send_alerts([(alert, '<p>html</p>', 'text')], on_sent=sent.append) == [True]
+    assert sent == [alert]
+
+    [path] = list(tmp_path.iterdir())
+    with open(path, 'rb') as f:
+        message = BytesParser(policy=policy.default).parse(f)
+    assert message['To'] == 'test@test.net'
+    assert message['Subject'] == 'Algorithm Tips: New Leads Match Your Alert'
+    assert message.get_body(('plain',)).get_content().strip() == 'text'
+    assert transport.stats()['sent'] == 1
+
+
+def test_smtp_batch_survives_errors(mocker):
+    """Test that one failed message doesn't abort the rest of an SMTP batch."""
+    connections = []
+
+    class FakeSMTP:
+        def __init__(self, host, port):
+            self.sent = []
+            self.closed = False
+            connections.append(self)
+
+        def send_message(self, message):
+            if message['To'] == 'refused@test.net':
+                raise smtplib.SMTPRecipientsRefused({'refused@test.net': (550, b'no')})
+            if message['To'] == 'drop@test.net':
+                raise smtplib.SMTPServerDisconnected('connection lost')
+            self.sent.append(message['To'])
+
+        def quit(self):
+            self.closed = True
+
+        def close(self):
+            self.closed = True
+
+    mocker.patch('smtplib.SMTP', FakeSMTP)
+    transport = SMTPTransport('localhost', 25, 'test@test.net')
+    recipients = ['a@test.net', 'refused@test.net', 'b@test.net', 'drop@test.net', 'c@test.net']
+
+    sent = []
+    results = transport.send_batch([(recipient, 'subject', '<p>html</p>', 'text') for recipient in recipients],
+                                   on_sent=sent.append)
+
+    assert results == [True, False, True, False, True]
+    assert sent == [0, 2, 4]
+    assert transport.sent == 3 and transport.failed == 2
+    # refused recipients keep the connection, lost connections are replaced
+    assert [smtp.sent for smtp in connections] == [['a@test.net', 'b@test.net'], ['c@test.net']]
+    assert all(smtp.closed for smtp in connections)
+
+
+def test_send_batch_hooks():
+    """Test that send_batch waits before every message and reports each one sent."""
+    class FlakyTransport(Transport):
+        def deliver(self, recipient, subject, html, text):
+            if recipient == 'drop@test.net':
+                raise Exception('connection lost')
+
+    transport = FlakyTransport('test@test.net')
+    recipients = ['a@test.net', 'drop@test.net', 'b@test.net']
+    waits = []
+    sent = []
+
+    results = transport.send_batch([(recipient, 'subject', '<p>html</p>', 'text') for recipient in recipients],
+                                   wait=lambda: waits.append(len(sent)), on_sent=sent.append)
+
+    assert results == [True, False, True]
+    assert sent == [0, 2]
+    assert waits == [0, 1, 1]
+
+    # errors in the callbacks are not mistaken for failed mail
+    def fail(i):
+        raise Exception('database gone')
+
+    with pytest.raises(Exception, match='database gone'):
+        transport.send_batch([('a@test.net', 'subject', '<p>html</p>', 'text')], on_sent=fail)
+
+
+def test_mail_stats_endpoint(api_app):
+    with api_app.test_client(True) as client:
+        assert client.get('/stats/mail').status_code == 200
+        assert client.get('/stats/mail', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 401
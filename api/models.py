@@ -7,6 +7,8 @@ users = Table('users', meta,
               Column('id', Integer, primary_key=True),
               Column('external_id', String(64), nullable=False),
               Column('external_type', String(16), nullable=False),
+              # see api.flags.flags_version
+              Column('flags_version', Integer, nullable=False, default=0),
               UniqueConstraint('external_id', 'external_type')
               )
 
@@ -66,6 +68,21 @@ crowd_ratings = Table('crowd_ratings', meta,
                       Column('societal_impact_explanation')
                       )
 
+# the rating dimensions in `crowd_ratings`, each of which is aggregated in `lead_scores`
+RATING_DIMENSIONS = ['controversy', 'surprise',
+                     'magnitude', 'societal_impact', 'news_value']
+
+# persisted per-lead aggregate of `crowd_ratings`. maintained by api.scores
+lead_scores = Table('lead_scores', meta,
+                    Column('lead_id', None, ForeignKey(
+                        'leads.id'), primary_key=True),
+                    Column('num_ratings', Integer, nullable=False),
+                    *[col
+                      for dim in RATING_DIMENSIONS
+                      for col in (Column(f'{dim}_avg', Float),
+                                  Column(f'{dim}_count', Integer, nullable=False))]
+                    )
+
 confirmed_emails = Table('confirmed_emails', meta,
                          Column('id', Integer, primary_key=True),
                          Column('user_id', None, ForeignKey('users.id')),
@@ -93,6 +110,10 @@ sent_alerts = Table('sent_alerts', meta,
                     Column('recipient', String, nullable=False),
                     Column('db_link', String, nullable=False),
                     Column('filter', String, nullable=False),
+                    # the alert job that recorded this send, and when it was
+                    # delivered. see api.alerts.dispatch_alerts
+                    Column('job_id', Integer),
+                    Column('delivered_dt', DateTime),
                     )
 
 sent_alert_contents = Table('sent_alert_contents', meta,
@@ -101,3 +122,22 @@ sent_alert_contents = Table('sent_alert_contents', meta,
                                 'sent_alerts.id')),
                             Column('lead_id', None, ForeignKey('leads.id')),
                             )
+
+alert_jobs = Table('alert_jobs', meta,
+                   Column('id', Integer, primary_key=True),
+                   # null means all frequencies
+                   Column('frequency', SmallInteger),
+                   # pending, running, done or failed
+                   Column('status', String(16), nullable=False),
+                   Column('created_dt', DateTime, nullable=False),
+                   Column('started_dt', DateTime),
+                   Column('finished_dt', DateTime),
+                   Column('report', String),
+                   )
+
+change_feed_marks = Table('change_feed_marks', meta,
+                          Column('consumer', String(64), primary_key=True),
+                          Column('last_id', Integer),
+                          Column('last_published_dt', DateTime),
+                          Column('updated_dt', DateTime, nullable=False),
+                          )
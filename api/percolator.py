@@ -0,0 +1,103 @@
+"""Reverse matching of recent leads against alerts.
+
+Running each alert's filter as a query (`find_alert_leads`) costs one
+query per distinct set of criteria. Few leads are published per period, so
+with many alerts it is cheaper to load the recent leads once and match
+each of them against every alert. `AlertPercolator` indexes the criteria
+(see `alert_criteria`) by the words their filters need, so each lead is
+only checked against the alerts it could match.
+
+Filters are matched with the rules of `api.search.InvertedIndexSearch`, which
+approximate MySQL's boolean mode. Enable this for alert runs with
+`matching=percolate` under [alert-trigger] in keys.conf.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy.sql import and_, select
+
+from api.alerts import min_date_threshold
+from api.api import allowed_jurisdictions
+from api.models import annotated_leads, leads
+from api.search import FIELD_GROUPS, MIN_TOKEN_LENGTH, document_positions, matches_document, parse_query
+
+
+class AlertPercolator:
+    def __init__(self, criteria):
+        self._terms = {}
+        self._jurisdictions = {}
+        self._since = {}
+        # criteria that every lead is checked against
+        self._unfiltered = set()
+        # criteria by a word (or prefix) that matching leads must contain
+        self._by_token = defaultdict(set)
+        self._by_prefix = defaultdict(set)
+
+        for key in set(criteria):
+            (filter_, federal, regional, local, frequency) = key
+            self._jurisdictions[key] = set(allowed_jurisdictions(
+                {'federal': federal, 'regional': regional, 'local': local}))
+            self._since[key] = min_date_threshold(frequency, fudge=timedelta(0))
+
+            if filter_ == '':
+                self._unfiltered.add(key)
+                continue
+
+            terms = parse_query(filter_)
+            self._terms[key] = terms
+
+            required = [term for term in terms if term[0] == '+']
+            # one required term suffices as all of them must match. otherwise
+            # any of the optional terms can
+            anchors = required[:1] or [term for term in terms if term[0] == '']
+            for (_, kind, tokens) in anchors:
+                (self._by_prefix if kind == 'prefix' else self._by_token)[tokens[0]].add(key)
+
+    def criteria(self):
+        return self._jurisdictions.keys()
+
+    def oldest(self):
+        """The publish time of the oldest lead that any alert could match."""
+        return min(self._since.values(), default=None)
+
+    def _candidates(self, documents):
+        candidates = set(self._unfiltered)
+        for positions in documents:
+            for token in positions:
+                candidates |= self._by_token.get(token, set())
+                for end in range(MIN_TOKEN_LENGTH, len(token) + 1):
+                    candidates |= self._by_prefix.get(token[:end], set())
+        return candidates
+
+    def match(self, lead):
+        """The criteria that `lead` matches. It needs the searchable fields,
+        `jurisdiction` and `published_dt`."""
+        documents = [document_positions([lead[column.name] for column in group]) for group in FIELD_GROUPS]
+
+        matched = []
+        for key in self._candidates(documents):
+            if lead['jurisdiction'] not in self._jurisdictions[key] or lead['published_dt'] < self._since[key]:
+                continue
+            if key in self._unfiltered or any(matches_document(self._terms[key], positions) for positions in documents):
+                matched.append(key)
+        return matched
+
+    def percolate(self, con):
+        """Match every lead published since `oldest` against the criteria.
+        Returns lists of leads (id and name, as `find_alert_leads`) keyed on
+        criteria."""
+        results = {key: [] for key in self.criteria()}
+        if len(results) == 0:
+            return results
+
+        columns = [column for group in FIELD_GROUPS for column in group]
+        query = select([leads.c.id, leads.c.jurisdiction, annotated_leads.c.published_dt, *columns])\
+            .select_from(leads.join(annotated_leads))\
+            .where(and_(annotated_leads.c.is_published == True,  # noqa: E712
+                        annotated_leads.c.published_dt >= self.oldest()))\
+            .order_by(leads.c.id)
+
+        for lead in con.execute(query):
+            for key in self.match(lead):
+                results[key].append({'id': lead['id'], 'name': lead['name']})
+        return results
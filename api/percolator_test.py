@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.sql import select
+
+from api.alerts import alert_criteria, find_alert_leads
+from api.models import annotated_leads
+from api.percolator import AlertPercolator
+
+FILTERS = ['', 'risk', '+risk +assessment', 'risk -fraud', '"risk assessment"', 'assess*', 'model climate', 'xyzzyplugh']
+
+
+def alert(filter_, federal=None, frequency=0):
+    return {'filter': filter_, 'federal_source': federal, 'regional_source': None,
+            'local_source': None, 'frequency': frequency}
+
+
+def test_percolate_matches_queries(sqlite_connection, search_index):
+    """Percolation finds the same leads as running each alert's query with the index backend."""
+    with sqlite_connection.begin() as con:
+        lead_ids = [row['lead_id'] for row in con.execute(select([annotated_leads.c.lead_id]).limit(20))]
+        for (i, lead_id) in enumerate(lead_ids):
+            con.execute(annotated_leads.update().values(  # pylint: disable=no-value-for-parameter
+                published_dt=datetime.now() - timedelta(days=i)).where(annotated_leads.c.lead_id == lead_id))
+
+    alerts = [alert(filter_, federal, frequency)
+              for filter_ in FILTERS
+              for federal in [None, 'exclude']
+              for frequency in [0, 2]]
+
+    with sqlite_connection.connect() as con:
+        results = AlertPercolator(alert_criteria(a) for a in alerts).percolate(con)
+
+    assert len(results) == len(alerts)
+    assert any(len(leads) > 0 for leads in results.values())
+    for a in alerts:
+        # the order of query results is unspecified
+        assert results[alert_criteria(a)] == sorted(find_alert_leads(a), key=lambda lead: lead['id']), a
@@ -0,0 +1,82 @@
+"""Maintenance of the `lead_scores` table.
+
+`lead_scores` holds the average and count of each rating dimension for every
+rated lead so that listing queries can sort by score without aggregating
+`crowd_ratings` on each request. Whenever ratings are added or changed, the
+affected leads must be refreshed with `refresh_lead_scores` (or loaded through
+`add_ratings`, which does so automatically). Ratings loaded some other way are
+picked up by `refresh_stale_lead_scores`, which the alert worker runs whenever
+the number of leads or ratings changes, and `api.feed.process_changes` on each
+run."""
+from sqlalchemy.sql import exists, func, or_, select
+
+from api.cache import invalidate_lead_caches
+from api.models import RATING_DIMENSIONS, crowd_ratings, lead_scores
+
+
+def score_aggregates():
+    """Build a query computing the `lead_scores` row of every rated lead from `crowd_ratings`."""
+    fields = [crowd_ratings.c.lead_id, func.count().label('num_ratings')]
+    for dim in RATING_DIMENSIONS:
+        fields += [func.avg(crowd_ratings.c[dim]).label(f'{dim}_avg'),
+                   func.count(crowd_ratings.c[dim]).label(f'{dim}_count')]
+
+    return select(fields).group_by(crowd_ratings.c.lead_id)
+
+
+def refresh_lead_scores(con, lead_ids):
+    """Recompute the scores of the given leads. Leads that no longer have any
+    ratings are removed from the table."""
+    lead_ids = list(set(lead_ids))
+    if len(lead_ids) == 0:
+        return
+
+    con.execute(lead_scores.delete().where(  # pylint: disable=no-value-for-parameter
+        lead_scores.c.lead_id.in_(lead_ids)))
+
+    query = score_aggregates().where(crowd_ratings.c.lead_id.in_(lead_ids))
+    con.execute(lead_scores.insert().from_select(  # pylint: disable=no-value-for-parameter
+        [c.name for c in lead_scores.c], query))
+
+    invalidate_lead_caches()
+
+
+def stale_lead_scores(con):
+    """Find the leads whose `lead_scores` row is missing, or was computed from
+    a different number of ratings than they have now."""
+    counts = select([crowd_ratings.c.lead_id, func.count().label('num_ratings')])\
+        .group_by(crowd_ratings.c.lead_id).alias('counts')
+    missing_or_changed = select([counts.c.lead_id])\
+        .select_from(counts.outerjoin(lead_scores, lead_scores.c.lead_id == counts.c.lead_id))\
+        .where(or_(lead_scores.c.lead_id == None,  # noqa: E711
+                   lead_scores.c.num_ratings != counts.c.num_ratings))
+    unrated = select([lead_scores.c.lead_id])\
+        .where(~exists().where(crowd_ratings.c.lead_id == lead_scores.c.lead_id))
+
+    return [row[0] for row in con.execute(missing_or_changed)] + [row[0] for row in con.execute(unrated)]
+
+
+def refresh_stale_lead_scores(con):
+    """Refresh the scores found by `stale_lead_scores`. Returns their lead ids."""
+    lead_ids = stale_lead_scores(con)
+    refresh_lead_scores(con, lead_ids)
+    return lead_ids
+
+
+def rebuild_lead_scores(con):
+    """Recompute the entire `lead_scores` table. Returns the number of scored leads."""
+    con.execute(lead_scores.delete())  # pylint: disable=no-value-for-parameter
+    con.execute(lead_scores.insert().from_select(  # pylint: disable=no-value-for-parameter
+        [c.name for c in lead_scores.c], score_aggregates()))
+    invalidate_lead_caches()
+
+    return con.execute(select([func.count()]).select_from(lead_scores)).scalar()
+
+
+def add_ratings(con, ratings):
+    """Insert a list of `crowd_ratings` rows (as dicts) and refresh the scores of the rated leads."""
+    if len(ratings) == 0:
+        return
+
+    con.execute(crowd_ratings.insert(), *ratings)  # pylint: disable=no-value-for-parameter
+    refresh_lead_scores(con, [rating['lead_id'] for rating in ratings])
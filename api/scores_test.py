@@ -0,0 +1,58 @@
+from sqlalchemy.sql import select
+
+from api.models import crowd_ratings, lead_scores
+from api.scores import add_ratings, rebuild_lead_scores, refresh_stale_lead_scores
+
+
+def test_rebuild_matches_ratings(sqlite_connection):
+    """Test that rebuilt scores agree with the averages of the raw ratings."""
+    with sqlite_connection.begin() as conn:
+        conn.execute(lead_scores.delete())
+        assert rebuild_lead_scores(conn) == 10
+
+        ratings = [dict(row) for row in conn.execute(
+            select([crowd_ratings]).where(crowd_ratings.c.lead_id == 6933))]
+        score = conn.execute(select([lead_scores]).where(
+            lead_scores.c.lead_id == 6933)).fetchone()
+
+        assert score['num_ratings'] == len(ratings)
+        assert score['news_value_count'] == len(ratings)
+        assert score['news_value_avg'] == sum(r['news_value'] for r in ratings) / len(ratings)
+
+
+def test_add_ratings_updates_scores(sqlite_connection):
+    """Test that loading ratings refreshes only the affected lead's score."""
+    with sqlite_connection.begin() as conn:
+        before = {row['lead_id']: dict(row) for row in conn.execute(select([lead_scores]))}
+
+        add_ratings(conn, [
+            {'lead_id': 6933, 'news_value': 5.0, 'surprise': None},
+            {'lead_id': 6933, 'news_value': 5.0, 'surprise': None},
+        ])
+
+        after = {row['lead_id']: dict(row) for row in conn.execute(select([lead_scores]))}
+
+        old = before[6933]
+        new = after[6933]
+        assert new['num_ratings'] == old['num_ratings'] + 2
+        assert new['news_value_count'] == old['news_value_count'] + 2
+        assert new['surprise_count'] == old['surprise_count']
+        assert new['news_value_avg'] > old['news_value_avg']
+
+        del before[6933], after[6933]
+        assert before == after
+
+
+def test_refresh_stale_scores(sqlite_connection):
+    """Test that scores are refreshed for ratings loaded without add_ratings."""
+    with sqlite_connection.begin() as conn:
+        conn.execute(crowd_ratings.insert().values(lead_id=6933, news_value=5.0))
+        conn.execute(lead_scores.delete().where(lead_scores.c.lead_id == 1420))
+        before = {row['lead_id']: dict(row) for row in conn.execute(select([lead_scores]))}
+
+        assert sorted(refresh_stale_lead_scores(conn)) == [1420, 6933]
+        assert refresh_stale_lead_scores(conn) == []
+
+        after = {row['lead_id']: dict(row) for row in conn.execute(select([lead_scores]))}
+        assert after[6933]['num_ratings'] == before[6933]['num_ratings'] + 1
+        assert 1420 in after
@@ -0,0 +1,355 @@
+"""Full text search over leads.
+
+The `filter` of /leads and of alerts is a MySQL boolean mode search string.
+Search backends turn it into a where clause on `leads.id`:
+
+- `MySQLSearch` uses `MATCH ... AGAINST` over the fulltext indices from
+  sql/01-fulltext-indices. This is the default.
+- `InvertedIndexSearch` keeps an inverted index of the leads in each
+  process. It works with any database (including the SQLite test database)
+  and avoids the OR-ed MATCH clauses. It must be updated with `update` when
+  leads are added or changed.
+
+The backend is chosen with `init_search`, from [search] in keys.conf.
+"""
+import math
+import re
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from configparser import ConfigParser
+from threading import Lock
+
+from sqlalchemy.sql import false, select, text
+
+from api.feed import latest_mark, read_changes
+from api.models import annotated_leads, leads
+
+# columns searched together, like the fulltext indices. a query matches a
+# lead if it matches either group
+FIELD_GROUPS = [
+    [annotated_leads.c.name, annotated_leads.c.description, annotated_leads.c.topic],
+    [leads.c.people, leads.c.organizations],
+]
+
+# words shorter than this are neither indexed nor searched for (as with
+# MySQL's innodb_ft_min_token_size)
+MIN_TOKEN_LENGTH = 3
+
+# gap between the positions of consecutive fields, so phrases don't match across them
+FIELD_GAP = 100
+
+TOKEN_REGEX = re.compile(r'\w+')
+QUERY_REGEX = re.compile(r'([+-]?)[~<>(]*("[^"]*"|[^\s"]+)')
+
+
+def tokenize(value):
+    return [token for token in TOKEN_REGEX.findall((value or '').lower()) if len(token) >= MIN_TOKEN_LENGTH]
+
+
+def parse_query(query):
+    """Parse a boolean mode search string into a list of `(operator, kind,
+    tokens)`, where operator is '+' (required), '-' (excluded) or '' and kind
+    is 'word', 'prefix' or 'phrase'. Grouping with parentheses and the ranking
+    operators ~ < > are ignored."""
+    terms = []
+    for (operator, term) in QUERY_REGEX.findall(query):
+        if term.startswith('"'):
+            tokens = tokenize(term)
+            if tokens:
+                terms.append((operator, 'phrase', tokens))
+            continue
+
+        term = term.rstrip(')')
+        prefix = term.endswith('*')
+        tokens = tokenize(term.rstrip('*'))
+        if len(tokens) == 1:
+            terms.append((operator, 'prefix' if prefix else 'word', tokens))
+        elif tokens:
+            # e.g. hyphenated words, which MySQL also splits
+            terms.append((operator, 'phrase', tokens))
+    return terms
+
+
+def document_positions(values):
+    """Map each token of a document made up of the field `values` to the
+    positions it occurs at."""
+    positions = defaultdict(list)
+    position = 0
+    for value in values:
+        for token in tokenize(value):
+            positions[token].append(position)
+            position += 1
+        position += FIELD_GAP
+    return positions
+
+
+def has_phrase(positions, tokens):
+    """Whether `tokens` occur consecutively in a document (see `document_positions`)."""
+    starts = set(positions.get(tokens[0], []))
+    for (offset, token) in enumerate(tokens[1:], 1):
+        starts &= {position - offset for position in positions.get(token, [])}
+    return len(starts) > 0
+
+
+def matches_document(terms, positions):
+    """Whether a single document (see `document_positions`) matches the
+    parsed query `terms`, with the same rules as `InvertedIndexSearch.search`."""
+    def matches(kind, tokens):
+        if kind == 'phrase':
+            return has_phrase(positions, tokens)
+        if kind == 'prefix':
+            return any(token.startswith(tokens[0]) for token in positions)
+        return tokens[0] in positions
+
+    if any(matches(kind, tokens) for (op, kind, tokens) in terms if op == '-'):
+        return False
+
+    required = [matches(kind, tokens) for (op, kind, tokens) in terms if op == '+']
+    if required:
+        return all(required)
+    return any(matches(kind, tokens) for (op, kind, tokens) in terms if op == '')
+
+
+class SearchBackend:
+    def condition(self, query):
+        """A where clause selecting the leads that match `query`."""
+        raise NotImplementedError()
+
+    def update(self, con, lead_ids):
+        """Bring the leads with `lead_ids` up to date after they were added or changed."""
+        pass
+
+    def catch_up(self, con):
+        """Update the backend with the leads published since it last looked (see api.feed)."""
+        pass
+
+
+class MySQLSearch(SearchBackend):
+    def condition(self, query):
+        return text("(match(name, description, topic) against (:filter in boolean mode) or match(people, organizations) against (:filter in boolean mode))").bindparams(filter=query)
+
+
+class InvertedIndexSearch(SearchBackend):
+    """An in-memory inverted index over the searchable fields of leads.
+
+    Each field group of each lead is indexed as a separate document, keyed on
+    `(lead_id, group)`. Postings map each token to the positions it occurs at
+    in each document.
+
+    `condition` only needs the matching leads, which `matches` finds without
+    ranking them. The ids of the last `match_cache_size` queries are kept
+    until the index is updated, so the page and count queries of a listing
+    share one lookup."""
+
+    k1 = 1.2
+    b = 0.75
+    match_cache_size = 64
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._lengths = {}
+        self._tokens = {}
+        self._total_length = 0
+        self._vocabulary = None
+        self._mark = None
+        self._matched = OrderedDict()
+        self._lock = Lock()
+        self._catch_up_lock = Lock()
+
+    @classmethod
+    def build(cls, con):
+        """Build an index of all leads."""
+        index = cls()
+        index._mark = latest_mark(con)
+        index.update(con)
+        return index
+
+    def catch_up(self, con):
+        with self._catch_up_lock:
+            (lead_ids, self._mark) = read_changes(con, self._mark)
+            if len(lead_ids) > 0:
+                self.update(con, lead_ids)
+            return lead_ids
+
+    def __len__(self):
+        return len({lead_id for (lead_id, _) in self._lengths})
+
+    def update(self, con, lead_ids=None):
+        """(Re)index the leads with `lead_ids`, or all leads if None."""
+        query = select([leads.c.id, *[column for group in FIELD_GROUPS for column in group]])\
+            .select_from(leads.join(annotated_leads))
+        if lead_ids is not None:
+            query = query.where(leads.c.id.in_(lead_ids))
+        rows = con.execute(query).fetchall()
+
+        with self._lock:
+            if lead_ids is None:
+                self._clear()
+            else:
+                for lead_id in lead_ids:
+                    self._remove(lead_id)
+            for row in rows:
+                for (group, columns) in enumerate(FIELD_GROUPS):
+                    self._add((row['id'], group), [row[column.name] for column in columns])
+            self._vocabulary = None
+            self._matched = OrderedDict()
+
+    def _clear(self):
+        self._postings = defaultdict(dict)
+        self._lengths = {}
+        self._tokens = {}
+        self._total_length = 0
+
+    def _add(self, doc, values):
+        positions = document_positions(values)
+        for (token, token_positions) in positions.items():
+            self._postings[token][doc] = token_positions
+        length = sum(len(token_positions) for token_positions in positions.values())
+        self._lengths[doc] = length
+        self._tokens[doc] = set(positions)
+        self._total_length += length
+
+    def _remove(self, lead_id):
+        for group in range(len(FIELD_GROUPS)):
+            doc = (lead_id, group)
+            if doc not in self._lengths:
+                continue
+            self._total_length -= self._lengths.pop(doc)
+            for token in self._tokens.pop(doc):
+                del self._postings[token][doc]
+                if not self._postings[token]:
+                    del self._postings[token]
+
+    def _expand(self, kind, tokens):
+        """The tokens in the index matched by a term."""
+        if kind != 'prefix':
+            return tokens
+
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        (prefix,) = tokens
+        i = bisect_left(self._vocabulary, prefix)
+        expanded = []
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(prefix):
+            expanded.append(self._vocabulary[i])
+            i += 1
+        return expanded
+
+    def _matches(self, kind, tokens):
+        """The documents matching a term."""
+        if kind == 'phrase':
+            docs = set(self._postings.get(tokens[0], {}))
+            for token in tokens[1:]:
+                docs &= set(self._postings.get(token, {}))
+            return {doc for doc in docs if has_phrase({token: self._postings[token][doc] for token in tokens}, tokens)}
+
+        docs = set()
+        for token in self._expand(kind, tokens):
+            docs |= set(self._postings.get(token, {}))
+        return docs
+
+    def _bm25(self, doc, tokens):
+        num_docs = len(self._lengths)
+        avg_length = self._total_length / num_docs if num_docs else 0
+        norm = self.k1 * (1 - self.b + self.b * self._lengths[doc] / (avg_length or 1))
+
+        score = 0
+        for token in tokens:
+            docs = self._postings.get(token, {})
+            if doc not in docs:
+                continue
+            idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            freq = len(docs[doc])
+            score += idf * freq * (self.k1 + 1) / (freq + norm)
+        return score
+
+    def _match_docs(self, terms):
+        """The documents matching the parsed query `terms`. Must hold the lock."""
+        required = [self._matches(kind, tokens) for (op, kind, tokens) in terms if op == '+']
+        optional = [self._matches(kind, tokens) for (op, kind, tokens) in terms if op == '']
+        excluded = set()
+        for (op, kind, tokens) in terms:
+            if op == '-':
+                excluded |= self._matches(kind, tokens)
+
+        if required:
+            docs = set.intersection(*required)
+        else:
+            docs = set().union(*optional)
+        return docs - excluded
+
+    def matches(self, query):
+        """Find the ids of the leads matching the boolean mode search string
+        `query`, as a sorted tuple, with the rules of `search`."""
+        with self._lock:
+            lead_ids = self._matched.get(query)
+            if lead_ids is not None:
+                self._matched.move_to_end(query)
+                return lead_ids
+
+            lead_ids = tuple(sorted({lead_id for (lead_id, _) in self._match_docs(parse_query(query))}))
+            self._matched[query] = lead_ids
+            if len(self._matched) > self.match_cache_size:
+                self._matched.popitem(last=False)
+            return lead_ids
+
+    def search(self, query):
+        """Find the leads matching the boolean mode search string `query`.
+        Returns a dict of BM25 scores keyed on lead id.
+
+        As in MySQL, if there are required (+) terms, leads must match all of
+        them and the other terms only affect the score. Otherwise leads must
+        match at least one term. Leads matching an excluded (-) term are left
+        out."""
+        terms = parse_query(query)
+
+        with self._lock:
+            docs = self._match_docs(terms)
+            scored = [token for (op, kind, tokens) in terms if op != '-' for token in self._expand(kind, tokens)]
+
+            scores = {}
+            for doc in docs:
+                (lead_id, _) = doc
+                scores[lead_id] = max(scores.get(lead_id, 0), self._bm25(doc, scored))
+            return scores
+
+    def condition(self, query):
+        lead_ids = self.matches(query)
+        if not lead_ids:
+            return false()
+        return leads.c.id.in_(lead_ids)
+
+
+class SearchSingleton:
+    __backend = MySQLSearch()
+
+    @classmethod
+    def init(cls, backend=None):
+        if backend is None:
+            cfg = ConfigParser()
+            cfg.read('keys.conf')
+
+            kind = cfg.get('search', 'backend', fallback='mysql')
+            if kind == 'mysql':
+                backend = MySQLSearch()
+            elif kind == 'index':
+                from api.db import engine
+                with engine().connect() as con:
+                    backend = InvertedIndexSearch.build(con)
+            else:
+                raise ValueError(f'Unknown search backend: {kind}')
+
+        cls.__backend = backend
+
+    @classmethod
+    def get_backend(cls):
+        return cls.__backend
+
+
+def init_search(backend=None):
+    """Select the search backend. If `backend` is None, it is read from keys.conf."""
+    SearchSingleton.init(backend)
+
+
+def get_search():
+    return SearchSingleton.get_backend()
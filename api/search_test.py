@@ -0,0 +1,103 @@
+import pytest
+from sqlalchemy import create_engine
+
+from api.models import annotated_leads, leads, meta
+from api.search import InvertedIndexSearch, parse_query
+
+DOCS = {
+    1: ('Facial recognition at airports', 'Police use of face matching software', 'Policing', 'Jane Doe', 'TSA'),
+    2: ('Risk assessment for bail', 'Predicting pretrial risk', 'Justice', '', 'Courts'),
+    3: ('Benefits fraud detection', 'Algorithmic risk scores for welfare fraud', 'Welfare', 'John Roe', 'Police Department'),
+}
+
+
+def insert(con, lead_id, name, description, topic, people, organizations):
+    con.execute(leads.insert().values(
+        id=lead_id, query_term='', link='', domain='', jurisdiction='', source='',
+        people=people, organizations=organizations, document_ext='', document_relevance=0))
+    con.execute(annotated_leads.insert().values(
+        id=lead_id, lead_id=lead_id, name=name, description=description, topic=topic, is_published=1))
+
+
+@pytest.fixture
+def index_db():
+    engine = create_engine('sqlite://')
+    meta.create_all(engine, tables=[leads, annotated_leads])
+    with engine.begin() as con:
+        for (lead_id, doc) in DOCS.items():
+            insert(con, lead_id, *doc)
+    return engine
+
+
+def test_parse_query():
+    assert parse_query('+risk -bail "face matching" frau* ab') == [
+        ('+', 'word', ['risk']),
+        ('-', 'word', ['bail']),
+        ('', 'phrase', ['face', 'matching']),
+        ('', 'prefix', ['frau']),
+    ]
+
+
+def test_boolean_search(index_db):
+    with index_db.connect() as con:
+        index = InvertedIndexSearch.build(con)
+
+    assert set(index.search('risk')) == {2, 3}
+    assert set(index.search('risk police')) == {1, 2, 3}
+    assert set(index.search('+risk +welfare')) == {3}
+    assert set(index.search('+risk -bail')) == {3}
+    assert set(index.search('frau*')) == {3}
+    assert set(index.search('"risk scores"')) == {3}
+    assert set(index.search('"scores risk"')) == set()
+    assert set(index.search('-risk')) == set()
+
+    # the two field groups are matched separately, like the fulltext indices
+    assert set(index.search('+risk +police')) == set()
+
+    scores = index.search('risk')
+    assert scores[2] > scores[3] > 0
+
+
+def test_incremental_update(index_db):
+    with index_db.connect() as con:
+        index = InvertedIndexSearch.build(con)
+    assert len(index) == 3
+
+    with index_db.begin() as con:
+        insert(con, 4, 'Bail algorithm audit', '', 'Justice', '', '')
+        con.execute(annotated_leads.update().where(annotated_leads.c.id == 2).values(name='Pretrial tool'))
+        index.update(con, [2, 4])
+
+    assert len(index) == 4
+    assert set(index.search('bail')) == {4}
+    assert set(index.search('pretrial')) == {2}
+
+
+def test_matches(index_db, mocker):
+    with index_db.connect() as con:
+        index = InvertedIndexSearch.build(con)
+
+    for query in ['risk', 'risk police', '+risk -bail', 'frau*', '-risk']:
+        assert index.matches(query) == tuple(sorted(index.search(query)))
+
+    # repeat lookups reuse the ids until the index changes
+    match_docs = mocker.spy(index, '_match_docs')
+    assert index.matches('bail') == (2,)
+    assert index.matches('bail') == (2,)
+    assert match_docs.call_count == 1
+
+    with index_db.begin() as con:
+        insert(con, 4, 'Bail algorithm audit', '', 'Justice', '', '')
+        index.update(con, [4])
+    assert index.matches('bail') == (2, 4)
+
+
+def test_filter_leads(sqlite_connection, api_app, search_index):
+    """Filters can be used on SQLite with the index."""
+    with api_app.test_client(True) as client:
+        everything = client.get('/leads').get_json()
+        data = client.get('/leads?filter=risk').get_json()
+        assert 0 < data['num_results'] < everything['num_results']
+        assert {lead['id'] for lead in data['leads']} <= set(search_index.search('risk'))
+
+        assert client.get('/leads?filter=xyzzyplugh').get_json()['num_results'] == 0
@@ -0,0 +1,72 @@
+"""Run queued alert jobs.
+
+POST /api/alert/trigger only queues a job (see api.alerts.enqueue_alert_job),
+so that sending alerts does not tie up a uWSGI process. This worker runs the
+queued jobs. Only one worker should run at a time.
+
+Whenever the number of leads or ratings changes, the worker also refreshes the scores
+of leads rated without going through api.scores (see
+api.scores.refresh_stale_lead_scores), so that API processes don't have to.
+
+Usage:
+    python -m api.worker [options]
+
+Options:
+    -h --help           Show this screen.
+    --once              Run the queued jobs, then exit.
+    --poll=<seconds>    Seconds to wait between checks for new jobs [default: 30].
+"""
+import time
+
+from docopt import docopt
+
+from api.alerts import init_alerts, process_alert_jobs
+from api.api import app, lead_data_version
+from api.db import engine, init_pool
+from api.mail import init_mail, init_templates
+from api.scores import refresh_stale_lead_scores
+from api.search import get_search, init_search
+
+
+def refresh_scores(version):
+    """Refresh stale lead scores if the leads or ratings changed since
+    `version` (a `lead_data_version`). Returns the latest version."""
+    latest = lead_data_version()
+    if latest != version:
+        with engine().begin() as con:
+            refreshed = refresh_stale_lead_scores(con)
+        if len(refreshed) > 0:
+            print(f'Refreshed the scores of {len(refreshed)} leads')
+    return latest
+
+
+def main():
+    args = docopt(__doc__)
+
+    with app.app_context():
+        init_pool()
+        init_mail()
+        init_templates()
+        init_alerts()
+        init_search()
+
+        version = None
+        while True:
+            try:
+                version = refresh_scores(version)
+
+                # match alerts against leads published since the last job
+                with engine().connect() as con:
+                    get_search().catch_up(con)
+                process_alert_jobs()
+            except Exception as e:
+                # e.g. the database is unavailable. unfinished jobs are
+                # resumed on the next poll
+                print(f'Unable to process alert jobs: {e}')
+            if args['--once']:
+                break
+            time.sleep(float(args['--poll']))
+
+
+if __name__ == '__main__':
+    main()
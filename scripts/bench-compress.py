@@ -0,0 +1,48 @@
+"""Measure the CPU cost and bytes saved by compressing API responses.
+
+Each response body is compressed with gzip at several levels, and with
+brotli if it is installed.
+
+Usage:
+    bench-compress.py [options]
+
+Options:
+    -h --help           Show this screen.
+    -n --repeat=<n>     Compressions per codec and response [default: 500].
+    --db=<url>          SQLAlchemy database URL. Defaults to a copy of test-db.sqlite.
+"""
+import gzip
+
+from docopt import docopt
+
+from benchutil import api_client, database, measure, report
+
+QUERIES = [
+    '/leads',
+    '/leads?ratings=summary',
+    '/lead/6933',
+]
+
+CODECS = [(f'gzip -{level}', lambda body, level=level: gzip.compress(body, compresslevel=level))
+          for level in (1, 6, 9)]
+
+try:
+    import brotli
+    CODECS += [(f'brotli -q{quality}', lambda body, quality=quality: brotli.compress(body, quality=quality))
+               for quality in (4, 11)]
+except ImportError:
+    print('brotli is not installed, only measuring gzip')
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+
+    with database(args['--db']) as engine:
+        _, client = api_client(engine)
+        for query in QUERIES:
+            body = client.get(query).get_data()
+            print(f'\n{query}: {len(body)} bytes')
+            for name, codec in CODECS:
+                size = len(codec(body))
+                report(f'{name} ({size / len(body):.0%}, {size}B)', measure(lambda: codec(body), repeat))
@@ -0,0 +1,44 @@
+"""Compare the latency of /leads under each result count strategy.
+
+Usage:
+    bench-count.py [options]
+
+Options:
+    -h --help           Show this screen.
+    -n --repeat=<n>     Requests per strategy and query [default: 200].
+    --db=<url>          SQLAlchemy database URL. Defaults to a copy of test-db.sqlite.
+"""
+from docopt import docopt
+
+from benchutil import api_client, database, measure, report
+
+QUERIES = [
+    '/leads',
+    '/leads?page=2',
+    '/leads?from=2019-06-30&to=2019-06-30',
+]
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+
+    from api.api import COUNT_CACHE, COUNT_STRATEGIES, RESPONSE_CACHE
+
+    # measure the count queries, not responses served from the cache
+    RESPONSE_CACHE.maxsize = 0
+
+    with database(args['--db']) as engine:
+        baseline = None
+        for strategy in COUNT_STRATEGIES:
+            COUNT_CACHE.clear()
+            _, client = api_client(engine, LEAD_COUNT_STRATEGY=strategy)
+
+            def run():
+                for query in QUERIES:
+                    assert client.get(query).status_code == 200
+
+            run()  # warm up
+            times = measure(run, repeat)
+            report(strategy, times, baseline)
+            baseline = baseline or times
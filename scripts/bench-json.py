@@ -0,0 +1,51 @@
+"""Compare the time taken to serialize a page of leads to JSON.
+
+The page is a realistic /leads response: five leads with their full ratings,
+as built by filter_leads before serialization. It is encoded with
+flask.jsonify and with each of the encoders in api.encoding.
+
+Usage:
+    bench-json.py [options]
+
+Options:
+    -h --help           Show this screen.
+    -n --repeat=<n>     Serializations per encoder [default: 5000].
+    --db=<url>          SQLAlchemy database URL. Defaults to a copy of test-db.sqlite.
+"""
+import flask
+from docopt import docopt
+
+from benchutil import api_client, database, measure, report
+
+
+def load_page(engine):
+    """Fetch the first /leads page, with the same python types the view serializes."""
+    from api.api import PAGE_SIZE, attach_ratings, build_filtered_lead_selection
+
+    with engine.connect() as con:
+        rows = con.execute(build_filtered_lead_selection(None, None, None, {})).fetchall()
+        res_map = {row['id']: dict(row._mapping) for row in rows}
+        for lead in res_map.values():
+            del lead['sort_day'], lead['sort_score']
+        attach_ratings(con, res_map, 'full')
+
+    assert len(res_map) == PAGE_SIZE
+    return {'leads': list(res_map.values()), 'num_results': 100, 'num_pages': 20, 'page': 1}
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+
+    from api.encoding import ENCODERS, dumps
+
+    with database(args['--db']) as engine:
+        app, _ = api_client(engine)
+        with app.app_context():
+            page = load_page(engine)
+            print(f'{len(flask.jsonify(page).get_data())} bytes per page')
+
+            baseline = measure(lambda: flask.jsonify(page).get_data(), repeat)
+            report('flask.jsonify', baseline)
+            for encoder in sorted(ENCODERS):
+                report(encoder, measure(lambda: dumps(page, encoder), repeat), baseline)
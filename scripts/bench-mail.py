@@ -0,0 +1,65 @@
+"""Measure alert email throughput through an offline mail transport.
+
+Renders alert emails and sends them through the spool transport (or an SMTP
+sink, e.g. `python -m aiosmtpd -n -l localhost:1025`), reporting emails per
+second and throttle retries.
+
+Usage:
+    bench-mail.py [options]
+
+Options:
+    -h --help               Show this screen.
+    -n --count=<n>          Number of emails to send [default: 1000].
+    -c --concurrency=<n>    Number of sending threads [default: 4].
+    --batch=<n>             Messages per send_batch call [default: 50].
+    --smtp=<host:port>      Send to an SMTP server instead of spooling to a temporary directory.
+"""
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from docopt import docopt
+
+from benchutil import api_client, database
+
+ALERT = {'send_id': 1, 'user_id': 1, 'federal_source': None, 'regional_source': 'exclude', 'local_source': None,
+         'frequency': 0, 'recipient': 'test@test.net', 'filter': 'police', 'alert_id': 1}
+LEADS = [{'name': f'Lead {i}', 'link': f'https://db.algorithmtips.org/lead/{i}'} for i in range(10)]
+
+
+def run(transport, count, concurrency, batch_size, html, text):
+    from api.mail import ALERT_SUBJECT
+
+    messages = [(f'test{i}@test.net', ALERT_SUBJECT, html, text) for i in range(count)]
+    batches = [messages[i:i + batch_size] for i in range(0, count, batch_size)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = [ok for batch in pool.map(transport.send_batch, batches) for ok in batch]
+    elapsed = time.perf_counter() - start
+
+    stats = transport.stats()
+    print(f'{type(transport).__name__}: sent {sum(results)}/{count} in {elapsed:.3f}s '
+          f'({sum(results) / elapsed:.1f} emails/s, {stats["throttle_retries"]} throttle retries)')
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    from api.mail import SMTPTransport, SpoolTransport, render_alert
+
+    with database() as engine:
+        app, _ = api_client(engine)
+        with app.app_context():
+            (html, text) = render_alert(ALERT, LEADS)
+
+    count = int(args['--count'])
+    concurrency = int(args['--concurrency'])
+    batch_size = int(args['--batch'])
+
+    if args['--smtp']:
+        (host, port) = args['--smtp'].split(':')
+        run(SMTPTransport(host, int(port), 'bench@test.net'), count, concurrency, batch_size, html, text)
+    else:
+        with tempfile.TemporaryDirectory() as spool:
+            run(SpoolTransport(spool, 'bench@test.net'), count, concurrency, batch_size, html, text)
@@ -0,0 +1,90 @@
+"""Compare finding the leads of every alert with one query per alert
+against percolating the recent leads through all alerts at once.
+
+Alerts are generated with filters built from words in lead names. With the
+default copy of test-db.sqlite, some leads are first marked as published
+recently, and queries use the index search backend (SQLite has no MATCH).
+
+Usage:
+    bench-percolate.py [options]
+
+Options:
+    -h --help               Show this screen.
+    -a --alerts=<n>         Number of alerts [default: 2000].
+    -r --recent=<n>         Leads to mark as recently published (SQLite only) [default: 20].
+    -n --repeat=<n>         Runs per method [default: 5].
+    --db=<url>              SQLAlchemy database URL. Defaults to a copy of test-db.sqlite.
+"""
+import random
+from datetime import datetime, timedelta
+
+from docopt import docopt
+
+from benchutil import api_client, database, measure, report
+
+
+def make_alerts(count, words):
+    rng = random.Random(0)
+    templates = ['{}', '{} {}', '+{} +{}', '{} -{}', '{}*', '']
+    alerts = []
+    for i in range(count):
+        template = rng.choice(templates)
+        filter_ = template.format(*(rng.choice(words) for _ in range(template.count('{}'))))
+        if template == '{}*':
+            filter_ = filter_[:-1][:4] + '*'
+        alerts.append({
+            'filter': filter_,
+            'federal_source': rng.choice([None, None, 'exclude']),
+            'regional_source': None,
+            'local_source': rng.choice([None, 'exclude']),
+            'frequency': rng.choice([0, 1, 2]),
+        })
+    return alerts
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+
+    from sqlalchemy.sql import select
+
+    from api.alerts import alert_criteria, find_alert_leads
+    from api.models import annotated_leads
+    from api.percolator import AlertPercolator
+    from api.search import InvertedIndexSearch, init_search, tokenize
+
+    with database(args['--db']) as engine:
+        app, _ = api_client(engine)
+
+        with engine.begin() as con:
+            names = [row['name'] for row in con.execute(select([annotated_leads.c.lead_id, annotated_leads.c.name]))]
+            if args['--db'] is None:
+                recent = [row['lead_id'] for row in con.execute(
+                    select([annotated_leads.c.lead_id]).limit(int(args['--recent'])))]
+                for (i, lead_id) in enumerate(recent):
+                    con.execute(annotated_leads.update().values(  # pylint: disable=no-value-for-parameter
+                        published_dt=datetime.now() - timedelta(days=i)).where(annotated_leads.c.lead_id == lead_id))
+                init_search(InvertedIndexSearch.build(con))
+
+        words = sorted({token for name in names for token in tokenize(name)})
+        alerts = make_alerts(int(args['--alerts']), words)
+        distinct = {alert_criteria(alert): alert for alert in alerts}
+        print(f'{len(alerts)} alerts with {len(distinct)} distinct criteria')
+
+        with app.app_context():
+            def query_each():
+                return {key: find_alert_leads(alert) for (key, alert) in distinct.items()}
+
+            def percolate():
+                with engine.connect() as con:
+                    return AlertPercolator(distinct).percolate(con)
+
+            expected = query_each()
+            matched = percolate()
+            # MySQL's fulltext search can disagree with the percolator's approximation of it
+            differ = sum(sorted(expected[key], key=lambda lead: lead['id']) != matched[key] for key in distinct)
+            print(f'{sum(len(leads) for leads in matched.values())} matches, {differ} criteria with different results')
+
+            baseline = measure(query_each, repeat)
+            report('query per alert', baseline)
+            report('percolate', measure(percolate, repeat), baseline)
@@ -0,0 +1,78 @@
+"""Measure the time taken to render alert emails.
+
+Compares rendering both templates from scratch for every alert (as
+render_alert used to) against render_alert, which renders each distinct
+alert once and splices in the private links.
+
+Usage:
+    bench-render.py [options]
+
+Options:
+    -h --help               Show this screen.
+    -n --count=<n>          Number of alerts to render [default: 10000].
+    -d --distinct=<n>       Number of distinct alert criteria among them [default: 50].
+"""
+import time
+
+from docopt import docopt
+from flask import render_template
+
+from benchutil import api_client, database
+
+
+def make_alerts(count, distinct):
+    return [{
+        'send_id': i,
+        'user_id': i,
+        'federal_source': None,
+        'regional_source': 'exclude' if i % 2 else None,
+        'local_source': None,
+        'frequency': 0,
+        'recipient': f'test{i}@test.net',
+        'filter': f'keyword{i % distinct}',
+        'alert_id': i,
+    } for i in range(count)]
+
+
+def render_from_scratch(alert, leads):
+    from api.mail import BASE_URL, build_db_url, format_source, get_private_alert_token
+
+    private_token = get_private_alert_token(alert['user_id'], alert['send_id'])
+    kwargs = {
+        'filter_text': alert['filter'],
+        'source_text': format_source(alert),
+        'leads': leads,
+        'links': {
+            'alert': build_db_url(alert),
+            'delete': f"{BASE_URL}/delete-alert?token={private_token}",
+            'unsubscribe': f"{BASE_URL}/unsubscribe?token={private_token}",
+        }
+    }
+    return (render_template('alert.html', **kwargs), render_template('alert.txt', **kwargs))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    from api.mail import init_templates, render_alert, render_alert_shell
+
+    alerts = make_alerts(int(args['--count']), int(args['--distinct']))
+    leads = [{'name': f'Lead {i}', 'link': f'https://db.algorithmtips.org/lead/{i}'} for i in range(5)]
+
+    with database() as engine:
+        app, _ = api_client(engine)
+        with app.app_context():
+            baseline = None
+            for name, render in [('from scratch', render_from_scratch), ('render_alert', render_alert)]:
+                render_alert_shell.cache_clear()
+                init_templates()
+                start = time.perf_counter()
+                for alert in alerts:
+                    render(alert, leads)
+                elapsed = time.perf_counter() - start
+
+                line = f'{name:<14} {len(alerts)} alerts in {elapsed:.3f}s ({elapsed / len(alerts) * 1e6:.1f}us per alert)'
+                if baseline is not None:
+                    line += f', {baseline / elapsed:.1f}x faster'
+                print(line)
+                baseline = baseline or elapsed
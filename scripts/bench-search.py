@@ -0,0 +1,67 @@
+"""Compare the latency of filtered /leads requests with each search backend.
+
+The MySQL backend can only be measured against a MySQL database (pass
+--db). The index backend works with any database, including the default
+copy of test-db.sqlite. Index build time and raw lookup time are also
+reported.
+
+Usage:
+    bench-search.py [options]
+
+Options:
+    -h --help           Show this screen.
+    -n --repeat=<n>     Requests per backend and query [default: 200].
+    --db=<url>          SQLAlchemy database URL. Defaults to a copy of test-db.sqlite.
+"""
+import time
+
+from docopt import docopt
+
+from benchutil import api_client, database, measure, report
+
+QUERIES = [
+    'risk',
+    'police algorithm',
+    '+risk -health',
+    '"risk assessment"',
+    'predict*',
+]
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+
+    from api.cache import RESPONSE_CACHE, invalidate_lead_caches
+    from api.search import InvertedIndexSearch, MySQLSearch, init_search
+
+    with database(args['--db']) as engine:
+        start = time.perf_counter()
+        with engine.connect() as con:
+            index = InvertedIndexSearch.build(con)
+        print(f'built index of {len(index)} leads in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        # measure the lookups themselves, not the cache of recent matches
+        index.match_cache_size = 0
+        report('index lookup', measure(lambda: [index.matches(query) for query in QUERIES], repeat))
+        del index.match_cache_size
+
+        backends = [('index', index)]
+        if engine.dialect.name == 'mysql':
+            backends.insert(0, ('mysql', MySQLSearch()))
+
+        _, client = api_client(engine)
+        baseline = None
+        for (name, backend) in backends:
+            init_search(backend)
+            invalidate_lead_caches()
+            RESPONSE_CACHE.maxsize = 0
+
+            def run():
+                for query in QUERIES:
+                    assert client.get('/leads', query_string={'filter': query}).status_code == 200
+
+            run()  # warm up
+            times = measure(run, repeat)
+            report(f'/leads ({name})', times, baseline)
+            baseline = baseline or times
@@ -0,0 +1,69 @@
+"""Helpers shared by the bench-*.py scripts.
+
+Benchmarks run against a temporary copy of test-db.sqlite by default. Pass a
+SQLAlchemy URL (e.g. the MySQL database from keys.conf) to measure against a
+real server instead."""
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+@contextmanager
+def database(url=None):
+    """Yields an engine for `url`, or for a scratch copy of test-db.sqlite if `url` is None."""
+    from sqlalchemy import create_engine
+
+    if url is not None:
+        yield create_engine(url)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.sqlite') as tmp:
+        shutil.copy('test-db.sqlite', tmp.name)
+        yield create_engine(f'sqlite:///{tmp.name}')
+
+
+def api_client(engine, **config):
+    """Build a test client for the API blueprints, backed by `engine`."""
+    import api.alerts
+    import api.api
+    from flask import Flask
+
+    api.api.engine = lambda: engine
+    api.alerts.engine = lambda: engine
+
+    app = Flask('bench', template_folder=os.path.join(ROOT, 'api', 'templates'))
+    app.secret_key = b'benchmark'
+    app.config.update(config)
+    app.register_blueprint(api.api.main)
+    app.register_blueprint(api.alerts.alerts)
+    return app, app.test_client()
+
+
+def measure(fn, repeat):
+    """Call `fn` `repeat` times, returning the duration of each call in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times, baseline=None):
+    """Print summary statistics for the output of `measure`."""
+    mean = statistics.mean(times) * 1000
+    median = statistics.median(times) * 1000
+    p95 = sorted(times)[int(len(times) * 0.95) - 1] * 1000
+    line = f'{name:<24} mean {mean:8.3f}ms  median {median:8.3f}ms  p95 {p95:8.3f}ms'
+    if baseline is not None:
+        delta = mean - statistics.mean(baseline) * 1000
+        line += f'  delta {delta:+8.3f}ms'
+    print(line)
@@ -0,0 +1,36 @@
+"""Update lead scores and caches for newly published leads and new ratings.
+
+The ingestion pipeline should run this after loading leads. Only the leads
+published since the last run (as recorded in change_feed_marks) are
+processed, so the first run processes every published lead. Search indices
+are updated by the processes that hold them.
+
+Usage:
+    process-changes.py [options]
+
+Options:
+    -h --help               Show this screen.
+    -c --consumer=<name>    Name under which progress is recorded [default: pipeline].
+"""
+import os
+import sys
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from api.cache import init_cache  # noqa: E402
+from api.db import engine, init_pool  # noqa: E402
+from api.feed import process_changes  # noqa: E402
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    init_pool()
+    # so that shared (sqlite) caches are invalidated
+    init_cache()
+    with engine().begin() as con:
+        summary = process_changes(con, args['--consumer'])
+
+    (last_id, last_published_dt) = summary['mark']
+    print(f'Processed {len(summary["leads"])} new leads, up to annotated lead {last_id} published {last_published_dt}')
@@ -0,0 +1,34 @@
+"""Rebuild the lead_scores table from crowd_ratings.
+
+Run this after bulk-loading ratings without going through api.scores, or to
+repair the table if it is suspected to be out of date.
+
+Usage:
+    rebuild-scores.py [options]
+
+Options:
+    -h --help           Show this screen.
+    -l --leads=<ids>    Only refresh the given comma-separated lead ids.
+"""
+import os
+import sys
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from api.db import engine, init_pool  # noqa: E402
+from api.scores import rebuild_lead_scores, refresh_lead_scores  # noqa: E402
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    init_pool()
+    with engine().begin() as con:
+        if args['--leads']:
+            lead_ids = [int(id_) for id_ in args['--leads'].split(',')]
+            refresh_lead_scores(con, lead_ids)
+            print(f'Refreshed scores for {len(lead_ids)} leads')
+        else:
+            count = rebuild_lead_scores(con)
+            print(f'Rebuilt scores for {count} leads')
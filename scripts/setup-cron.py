@@ -6,7 +6,8 @@ Weekly (every 7 days)
 Semi-Weekly (every 10 days)
 Monthly (every 30 days)
 
-This script sets up cron triggers for each level.
+This script sets up cron triggers for each level. Each trigger queues a job,
+which is run by the alert worker (python -m api.worker).
 
 Usage:
     setup-cron.py [options]
@@ -0,0 +1 @@
+drop table lead_scores;
@@ -0,0 +1,27 @@
+create table lead_scores (
+    lead_id integer not null primary key,
+    num_ratings integer not null default 0,
+    controversy_avg double,
+    controversy_count integer not null default 0,
+    surprise_avg double,
+    surprise_count integer not null default 0,
+    magnitude_avg double,
+    magnitude_count integer not null default 0,
+    societal_impact_avg double,
+    societal_impact_count integer not null default 0,
+    news_value_avg double,
+    news_value_count integer not null default 0,
+    foreign key (lead_id) references leads(id)
+);
+
+create index lead_scores_news_value on lead_scores(news_value_avg);
+
+insert into lead_scores
+    select lead_id, count(*),
+        avg(controversy), count(controversy),
+        avg(surprise), count(surprise),
+        avg(magnitude), count(magnitude),
+        avg(societal_impact), count(societal_impact),
+        avg(news_value), count(news_value)
+    from crowd_ratings
+    group by lead_id;
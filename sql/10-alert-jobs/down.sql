@@ -0,0 +1,7 @@
+drop index sent_alerts_job on sent_alerts;
+
+alter table sent_alerts
+    drop column job_id,
+    drop column delivered_dt;
+
+drop table alert_jobs;
@@ -0,0 +1,19 @@
+create table alert_jobs (
+    id integer not null primary key auto_increment,
+    frequency smallint, -- null means all frequencies
+    status varchar(16) not null default 'pending', -- pending, running, done or failed
+    created_dt datetime not null,
+    started_dt datetime,
+    finished_dt datetime,
+    report text
+);
+
+create index alert_jobs_status on alert_jobs(status);
+
+-- sends are recorded before they are delivered, so that an interrupted job
+-- can deliver the remainder when it is resumed
+alter table sent_alerts
+    add column job_id integer,
+    add column delivered_dt datetime;
+
+create index sent_alerts_job on sent_alerts(job_id, delivered_dt);
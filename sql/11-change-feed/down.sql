@@ -0,0 +1 @@
+drop table change_feed_marks;
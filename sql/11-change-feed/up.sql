@@ -0,0 +1,8 @@
+-- how far each consumer of the change feed (see api/feed.py) has read
+-- annotated_leads. leads with a greater id or publish time are new to it
+create table change_feed_marks (
+    consumer varchar(64) not null primary key,
+    last_id integer,
+    last_published_dt datetime,
+    updated_dt datetime not null
+);
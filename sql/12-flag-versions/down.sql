@@ -0,0 +1 @@
+alter table users drop column flags_version;
@@ -0,0 +1,3 @@
+-- incremented whenever the API changes a user's flags, so that cached flag
+-- sets (see api/flags.py) can tell when they are out of date
+alter table users add column flags_version integer not null default 0;
@@ -3,3 +3,5 @@ sudo service nginx restart
 set -e
 source venv/bin/activate
 nohup uwsgi api.ini &>> /var/log/algotips/api.log &
+nohup python -m api.worker &>> /var/log/algotips/worker.log &
+echo $! > worker.pid
@@ -2,3 +2,7 @@
 set -e
 source venv/bin/activate
 uwsgi --stop api.pid
+if [ -f worker.pid ]; then
+    kill "$(cat worker.pid)" || true
+    rm worker.pid
+fi